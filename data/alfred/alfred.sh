@@ -1,8 +1,5 @@
 #!/bin/bash
 
-# Iterate through all TSV files in the data/alfred folder.
+# Load all TSV files in the data/alfred folder, in a single process.
 SCRIPT_DIR=$(dirname "$0")
-for f in ${SCRIPT_DIR}/*.tsv; do
-    echo "File: $f"
-    python3 ${SCRIPT_DIR}/alfred.py ${f} -f "${1:-data/observed.db}"
-done
+python3 ${SCRIPT_DIR}/alfred.py ${SCRIPT_DIR}/*.tsv -f "${1:-data/observed.db}"
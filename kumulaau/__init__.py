@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
-from kumulaau.parameter import Parameter  # Our classes.
+from kumulaau.parameter import Parameter, AdaptiveWalk  # Our classes.
 from kumulaau.record import RecordSQLite
 
 import kumulaau.model  # Our modules.
 import kumulaau.observed
 import kumulaau.distance
+import kumulaau.mcmc
 import kumulaau.abc
 import kumulaau.ele
+import kumulaau.smc
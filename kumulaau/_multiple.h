@@ -0,0 +1,211 @@
+#include <math.h>
+
+// Our graphs are built from the single population machinery of _single.h, which must be included first.
+
+typedef struct DemographicSourceStruct {
+    int child; ///< Index of the population seeded by this source.
+    int parent; ///< Index of the population our seeds are drawn from. Must precede our child.
+    float alpha; ///< Mean fraction of our parent's individuals drawn as seeds.
+    float sigma; ///< Deviation of this fraction. Each simulation draws |N(alpha, sigma)|, clipped to 1.
+} DemographicSource;
+
+typedef struct DemographicGraphStruct {
+    int population_n; ///< Number of populations. The first descends from our seed lengths, the last is sampled.
+    PopulationParameters *theta; ///< Parameters of each population.
+    int *offset; ///< Offset of each population's generation in a worker's generation buffer.
+    int individual_n; ///< Total number of individuals (2n) across all populations.
+    int n_max; ///< Largest population size, which bounds the size of our tree and seed buffers.
+    DemographicSource *sources; ///< Sources of each population (after the first), drawn from in the order given.
+    int source_n; ///< Number of sources.
+} DemographicGraph;
+
+typedef struct GraphJobStruct {
+    DemographicGraph *graph; ///< Graph to simulate.
+    int *i_0; ///< Pointer to the seed lengths of our first population.
+    int i_0_size; ///< Number of seed lengths.
+    int *out; ///< Pointer to the output of this job, holding the last population of each simulation as a row.
+    int simulation_n; ///< Number of simulations (rows) to run.
+    unsigned long long seed; ///< Master seed. Each simulation is run from its own substream of this seed.
+} GraphJob;
+
+typedef struct GraphWorkerStruct {
+    PopulationTree p; ///< Population structure (tree, generation, and RNG) owned by this worker, reused by every stage.
+    gsl_rng *r_split; ///< RNG for our split fractions and founders, separate from the RNG of each population.
+    int *generations; ///< Evolved generation of every population, laid out by our graph's offsets.
+    int *seeds; ///< Seed lengths of the population currently being evolved. Holds 2 * n_max lengths.
+    int *consumed; ///< Number of individuals of each population that have already been drawn as seeds.
+    DemographicGraph *graph; ///< Graph of the job currently being simulated.
+    int *i_0; ///< Pointer to the seed lengths of the first population of the job currently being simulated.
+    int i_0_size; ///< Number of seed lengths.
+    GraphJob *jobs; ///< Jobs shared across all workers.
+    int job; ///< Index of the job holding the first simulation this worker is responsible for.
+    int row; ///< Row (of this job) of the first simulation this worker is responsible for.
+    int simulation_n; ///< Number of simulations this worker is responsible for. These may span several jobs.
+    int kernel; ///< Mutation kernel to evolve with (MUTATE_DRAW, MUTATE_GENERATION, or MUTATE_TABLE).
+    int status; ///< 0 if all of our simulations were completed. -1 if we could not allocate our workspace.
+} GraphWorker;
+
+/**
+ * Gather the seed lengths of the k'th population (k > 0) from the generations of its parents. Each generation is
+ * shuffled after evolving, so we draw from our parent by taking its next unconsumed individuals: two sources that share
+ * a parent (i.e. a split) never share an individual. Each source draws |N(alpha, sigma)| of its parent's individuals
+ * (clipped to 1), limited to what remains. A population that would receive no seeds is instead founded by a single
+ * random individual of its first parent. Seeds beyond 2n are discarded.
+ *
+ * @return: The number of seeds gathered into w->seeds.
+ */
+int _gather_seeds (GraphWorker *w, int k) {
+    DemographicGraph *g = w->graph;
+    int seed_n = 0, first = -1;
+
+    for (int s = 0; s < g->source_n; s++) {
+        DemographicSource *source = &g->sources[s];
+        if (source->child != k) continue;
+        first = (first < 0) ? source->parent : first;
+
+        // Determine our fraction, and the number of individuals this fraction represents.
+        int parent_n = 2 * g->theta[source->parent].n;
+        double alpha = source->alpha + ((source->sigma > 0) ? gsl_ran_gaussian(w->r_split, source->sigma) : 0);
+        int take = (int) (MIN(1.0, fabs(alpha)) * parent_n + 0.5);
+        take = MIN(take, MIN(parent_n - w->consumed[source->parent], 2 * g->theta[k].n - seed_n));
+
+        memcpy(w->seeds + seed_n, w->generations + g->offset[source->parent] + w->consumed[source->parent],
+               take * sizeof(int));
+        w->consumed[source->parent] += take, seed_n += take;
+    }
+
+    if (seed_n == 0) { // Our population must be founded by someone.
+        int parent_n = 2 * g->theta[first].n;
+        w->seeds[seed_n++] = w->generations[g->offset[first] + gsl_rng_uniform_int(w->r_split, parent_n)];
+    }
+    return seed_n;
+}
+
+/**
+ * Simulate every population of our graph once, from the given master seed. The k'th population is traced and evolved
+ * from the k'th substream of this seed (as a trace + evolve call given split_seed(seed, k) would be), and our split
+ * fractions are drawn from the substream after our last population. All populations share the same tree buffers, RNG,
+ * and transition table.
+ *
+ * @return: 0 if successful. -1 if we could not allocate the transition table of our kernel.
+ */
+int _simulate_graph_once (GraphWorker *w, unsigned long long seed) {
+    DemographicGraph *g = w->graph;
+    _seed_rng(w->r_split, _substream_seed(seed, (unsigned long long) g->population_n));
+
+    for (int k = 0; k < g->population_n; k++) {
+        // Our first population descends from our seed lengths. The rest descend from their parents.
+        int seed_n = (k == 0) ? w->i_0_size : _gather_seeds(w, k);
+        w->consumed[k] = 0;
+
+        w->p.theta = g->theta[k];
+        _seed_rng(w->p.r, _substream_seed(seed, (unsigned long long) k));
+        _trace_tree(w->p.coalescent_tree, w->p.theta.n, w->p.r);
+        if (_evolve((k == 0) ? w->i_0 : w->seeds, seed_n, &w->p, w->kernel) != 0) return -1;
+
+        memcpy(w->generations + g->offset[k], w->p.individuals, 2 * w->p.theta.n * sizeof(int));
+    }
+    return 0;
+}
+
+/**
+ * Thread entry point for our graph simulation. Simulate each graph this worker is responsible for, copying the
+ * generation of our last population directly into the associated row of each job.
+ */
+void *_simulate_graph_worker (void *args) {
+    GraphWorker *w = (GraphWorker *) args;
+    int j = w->job, row = w->row;
+
+    w->status = 0;
+    for (int k = 0; k < w->simulation_n && w->status == 0; k++, row++) {
+        while (row >= w->jobs[j].simulation_n) j++, row = 0; // Move on to the next job with simulations left.
+        GraphJob *job = &w->jobs[j];
+        DemographicGraph *g = job->graph;
+        int last = g->population_n - 1, last_n = 2 * g->theta[last].n;
+
+        w->graph = g, w->i_0 = job->i_0, w->i_0_size = job->i_0_size;
+        w->status = _simulate_graph_once(w, _substream_seed(job->seed, (unsigned long long) row));
+        memcpy(job->out + (size_t) row * last_n, w->generations + g->offset[last], last_n * sizeof(int));
+    }
+
+    return NULL;
+}
+
+void _cleanup_graph_worker (GraphWorker *w) {
+    _cleanup(&w->p);
+    if (w->r_split != NULL) gsl_rng_free(w->r_split);
+    free(w->generations), free(w->seeds), free(w->consumed);
+}
+
+/**
+ * Simulate the graphs of several jobs, split across thread_n threads. The simulations of all jobs are treated as a
+ * single sequence of rows, which we partition into contiguous blocks (one per thread). Each thread is given its own
+ * buffers (sized for the largest of our graphs) and RNGs, which are reused across every population and simulation.
+ * The k'th simulation of a job is run from the k'th substream of the job's master seed, and the generation of its last
+ * population is written to out[k * 2n : (k + 1) * 2n] of that job. If thread_n is not positive, we use the number of
+ * online processors.
+ *
+ * @return: 0 if successful. -1 if we could not allocate our workers (or their workspace).
+ */
+int _simulate_graphs (GraphJob *jobs, int job_n, int thread_n, int kernel) {
+    int status = 0, simulation_n = 0, n_max = 1, individual_n = 1, population_n = 1;
+    for (int j = 0; j < job_n; j++) {
+        simulation_n += jobs[j].simulation_n;
+        n_max = MAX(n_max, jobs[j].graph->n_max);
+        individual_n = MAX(individual_n, jobs[j].graph->individual_n);
+        population_n = MAX(population_n, jobs[j].graph->population_n);
+    }
+    if (simulation_n == 0) return 0;
+
+    thread_n = _thread_count(thread_n, simulation_n);
+    GraphWorker *workers = (GraphWorker *) malloc(thread_n * sizeof(GraphWorker));
+    if (workers == NULL) return -1;
+
+    // Partition the rows of all of our jobs into contiguous blocks, one per worker.
+    for (int t = 0, j = 0, row = 0; t < thread_n; t++) {
+        GraphWorker *w = &workers[t];
+        w->simulation_n = simulation_n / thread_n + ((t < simulation_n % thread_n) ? 1 : 0);
+        w->jobs = jobs, w->job = j, w->row = row;
+        w->kernel = kernel, w->status = -1;
+        for (row += w->simulation_n; j < job_n && row >= jobs[j].simulation_n; j++) row -= jobs[j].simulation_n;
+
+        // Each worker owns its buffers and RNGs. Our tree buffers are sized for our largest population.
+        w->p.coalescent_tree = (int *) malloc((2 * n_max - 1) * sizeof(int));
+        w->p.individuals = (int *) malloc(2 * n_max * sizeof(int));
+        w->p.r = gsl_rng_alloc(gsl_rng_taus2);
+        w->p.capacity = n_max;
+        w->p.table = NULL;
+        w->r_split = gsl_rng_alloc(gsl_rng_taus2);
+        w->generations = (int *) malloc((size_t) individual_n * sizeof(int));
+        w->seeds = (int *) malloc(2 * n_max * sizeof(int));
+        w->consumed = (int *) malloc(population_n * sizeof(int));
+    }
+
+    // Fan out to our workers, if all of their workspace could be allocated.
+    for (int t = 0; t < thread_n; t++) {
+        GraphWorker *w = &workers[t];
+        if (w->p.coalescent_tree == NULL || w->p.individuals == NULL || w->p.r == NULL || w->r_split == NULL ||
+            w->generations == NULL || w->seeds == NULL || w->consumed == NULL) status = -1;
+    }
+    if (status == 0) status = _run_workers(workers, sizeof(GraphWorker), thread_n, _simulate_graph_worker);
+
+    for (int t = 0; t < thread_n; t++) {
+        status = (workers[t].status != 0) ? workers[t].status : status;
+        _cleanup_graph_worker(&workers[t]);
+    }
+    free(workers);
+    return status;
+}
+
+/**
+ * Simulate our demographic graph simulation_n times, split across thread_n threads. The k'th simulation is run from
+ * the k'th substream of the given master seed, and the generation of our last population is written to
+ * out[k * 2n : (k + 1) * 2n]. See "_simulate_graphs".
+ *
+ * @return: 0 if successful. -1 if we could not allocate our workers (or their workspace).
+ */
+int _simulate_graph (DemographicGraph *g, int *i_0, int i_0_size, int *out, int simulation_n, int thread_n,
+                     unsigned long long seed, int kernel) {
+    GraphJob job = {g, i_0, i_0_size, out, simulation_n, seed};
+    return _simulate_graphs(&job, 1, thread_n, kernel);
+}
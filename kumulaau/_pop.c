@@ -1,5 +1,254 @@
 #include <Python.h>
+#include <ctype.h>
 #include "_single.h"
+#include "_multiple.h"
+
+/**
+ * Generate a seed for some population when one is not given. We mix the current time of day, our process ID, and a
+ * per-process counter, so workers that start in the same microsecond are not given identical streams.
+ *
+ * @return: A seed that is unique to this call.
+ */
+static unsigned long long _entropy_seed (void) {
+    static unsigned long long counter = 0;
+    struct timeval tv;
+    gettimeofday(&tv, 0);
+
+    unsigned long long s = (unsigned long long) tv.tv_sec * 1000000ULL + (unsigned long long) tv.tv_usec;
+    s = _substream_seed(s, (unsigned long long) getpid());
+    return _substream_seed(s, __sync_fetch_and_add(&counter, 1));
+}
+
+/**
+ * Parse an optional Python integer seed. If the seed is None (or not given), we generate a seed from _entropy_seed.
+ *
+ * @param seed_object: Python integer holding our seed, None, or NULL.
+ * @param seed: Output, the parsed seed.
+ * @return: 0 if successful. -1 if an error occurred.
+ */
+static int _parse_seed (PyObject *seed_object, unsigned long long *seed) {
+    if (seed_object == NULL || seed_object == Py_None) {
+        *seed = _entropy_seed();
+        return 0;
+    }
+
+    // We only use the lower 64 bits of our seed.
+    *seed = PyLong_AsUnsignedLongLongMask(seed_object);
+    return (PyErr_Occurred()) ? -1 : 0;
+}
+
+// Name of our population capsules. Evolved capsules are renamed, so they can no longer be opened.
+#define TREE_CAPSULE "pop.tree"
+#define EVOLVED_CAPSULE "pop.evolved"
+
+// Number of population structures we keep around for reuse.
+#define POOL_SIZE 8
+
+// Pool of released population structures (buffers and RNG included). This is only touched while holding the GIL.
+static PopulationTree *_pool[POOL_SIZE];
+static int _pool_n = 0;
+
+/**
+ * Obtain a population structure whose buffers can hold a population of size n. We reuse the smallest pooled structure
+ * that fits, and only allocate a new structure (and RNG) if there is none.
+ *
+ * @param n: Population size our buffers must hold.
+ * @return: A pointer to the population structure (owned by the caller), or NULL if we could not allocate one.
+ */
+static PopulationTree *_acquire_tree (int n) {
+    int best = -1;
+    for (int k = 0; k < _pool_n; k++) {
+        if (_pool[k]->capacity >= n && (best < 0 || _pool[k]->capacity < _pool[best]->capacity)) best = k;
+    }
+    if (best >= 0) {
+        PopulationTree *p = _pool[best];
+        _pool[best] = _pool[--_pool_n];
+        return p;
+    }
+
+    // Nothing fits. Reserve space for our ancestor chain and our generation of individuals. Both grow linearly with n.
+    PopulationTree *p = (PopulationTree *) malloc(sizeof(PopulationTree));
+    if (p == NULL) return NULL;
+    p->coalescent_tree = (int *) malloc((2 * n - 1) * sizeof(int));
+    p->individuals = (int *) malloc(2 * n * sizeof(int));
+    p->r = gsl_rng_alloc(gsl_rng_taus2);
+    p->capacity = n, p->table = NULL;
+
+    if (p->coalescent_tree == NULL || p->individuals == NULL || p->r == NULL) {
+        if (p->r != NULL) gsl_rng_free(p->r);
+        free(p->coalescent_tree), free(p->individuals), free(p);
+        return NULL;
+    }
+    return p;
+}
+
+/**
+ * Return a population structure to our pool. If our pool is full, the structure is freed instead.
+ *
+ * @param p: Population structure obtained from _acquire_tree.
+ */
+static void _release_tree (PopulationTree *p) {
+    if (_pool_n < POOL_SIZE) {
+        _pool[_pool_n++] = p;
+        return;
+    }
+
+    _cleanup(p);
+    free(p);
+}
+
+/**
+ * Destructor for our population capsules. Capsules that were never evolved return their structure to our pool.
+ *
+ * @param p_capsule: Capsule being destroyed.
+ */
+static void _tree_destructor (PyObject *p_capsule) {
+    if (PyCapsule_IsValid(p_capsule, TREE_CAPSULE)) {
+        _release_tree((PopulationTree *) PyCapsule_GetPointer(p_capsule, TREE_CAPSULE));
+    }
+}
+
+/**
+ * Verify that some number of seed lengths fit in our generation of individuals, and reserve space for them.
+ *
+ * @param i_0_size: Number of seeds to reserve space for.
+ * @param n: Population size, used to verify that our seeds fit in our generation of individuals.
+ * @return: A pointer to space for our seeds (owned by the caller), or NULL if an error occurred.
+ */
+static int *_reserve_i_0 (int i_0_size, int n) {
+    if (i_0_size <= 0) {
+        PyErr_SetString(PyExc_ValueError, "At least one seed length must be given.");
+        return NULL;
+    }
+    if (i_0_size > 2 * n) {
+        PyErr_SetString(PyExc_ValueError, "Number of seed lengths cannot exceed the number of individuals (2n).");
+        return NULL;
+    }
+
+    int *i_0 = (int *) malloc(i_0_size * sizeof(int));
+    if (i_0 == NULL) PyErr_NoMemory();
+    return i_0;
+}
+
+/**
+ * Read the k'th element of some buffer of native integers (of any width and signedness) as a C int.
+ *
+ * @param view: One dimensional (or scalar) buffer holding our integers.
+ * @param k: Index of the element to read.
+ * @param is_unsigned: Flag which indicates that our integers are unsigned.
+ * @return: The k'th element of our buffer.
+ */
+static int _buffer_int (Py_buffer *view, Py_ssize_t k, int is_unsigned) {
+    const char *item = (const char *) view->buf + ((view->ndim == 0) ? 0 : k * view->strides[0]);
+    unsigned long long u = 0;
+
+    // Our items may not be aligned (e.g. records), so we copy them out. Signed items are sign extended.
+    switch (view->itemsize) {
+        case 1: { signed char s; memcpy(&s, item, 1); u = (is_unsigned) ? (unsigned char) s : (long long) s; break; }
+        case 2: { short s; memcpy(&s, item, 2); u = (is_unsigned) ? (unsigned short) s : (long long) s; break; }
+        case 4: { int s; memcpy(&s, item, 4); u = (is_unsigned) ? (unsigned int) s : (long long) s; break; }
+        default: memcpy(&u, item, 8); break;
+    }
+    return (int) (long long) u;
+}
+
+/**
+ * Acquire a writable buffer of C ints from some buffer-protocol object (e.g. a C-contiguous NumPy array of dtype intc)
+ * to store our results in. We request the format of our buffer, so buffers of some other type of the same width (e.g.
+ * float32 or uint32) are rejected instead of being silently reinterpreted.
+ *
+ * @param out_object: Python object exporting our output buffer.
+ * @param out: Output, the acquired buffer. This must be released by the caller if we are successful.
+ * @return: 0 if successful. -1 (with an exception set, and no buffer held) otherwise.
+ */
+static int _get_int_buffer (PyObject *out_object, Py_buffer *out) {
+    if (PyObject_GetBuffer(out_object, out, PyBUF_WRITABLE | PyBUF_FORMAT) != 0) return -1;
+    const char *format = (out->format == NULL) ? "B" : out->format;
+    if (*format == '@' || *format == '=') format++;
+
+    // Verify that we hold signed native integers with the width of a C int.
+    if (strlen(format) != 1 || strchr("bhilqn", *format) == NULL || out->itemsize != sizeof(int)) {
+        PyErr_SetString(PyExc_TypeError, "Output buffer must hold C ints (e.g. a NumPy array of dtype intc).");
+        PyBuffer_Release(out);
+        return -1;
+    }
+    return 0;
+}
+
+/**
+ * Parse the seed lengths of some buffer-protocol object (e.g. a NumPy array, an array.array, or a NumPy integer
+ * scalar) into a C array. Strided one dimensional buffers are accepted, so slices of arrays need not be copied first.
+ *
+ * @param i_0_object: Python object exporting a buffer of native integers.
+ * @param n: Population size, used to verify that our seeds fit in our generation of individuals.
+ * @param i_0_size: Output, the number of seeds parsed.
+ * @return: A pointer to the parsed seeds (owned by the caller), or NULL if an error occurred.
+ */
+static int *_parse_i_0_buffer (PyObject *i_0_object, int n, int *i_0_size) {
+    Py_buffer view;
+    int *i_0 = NULL;
+
+    if (PyObject_GetBuffer(i_0_object, &view, PyBUF_RECORDS_RO) != 0) return NULL;
+    const char *format = (view.format == NULL) ? "B" : view.format;
+    if (*format == '@' || *format == '=') format++;
+
+    // Verify that we hold native integers of some width, and that our seeds fit in our generation of individuals.
+    if (view.ndim > 1 || strlen(format) != 1 || strchr("bBhHiIlLqQnN", *format) == NULL ||
+        (view.itemsize != 1 && view.itemsize != 2 && view.itemsize != 4 && view.itemsize != 8)) {
+        PyErr_SetString(PyExc_TypeError, "Seed lengths must be a one dimensional array of native integers.");
+    }
+    else if ((i_0 = _reserve_i_0(*i_0_size = (int) (view.len / view.itemsize), n)) != NULL) {
+        for (int k = 0; k < *i_0_size; k++) {
+            i_0[k] = _buffer_int(&view, k, isupper(*format));
+        }
+    }
+
+    PyBuffer_Release(&view);
+    return i_0;
+}
+
+/**
+ * Parse our seed lengths into a C array. Seeds may be given as a single integer, as any buffer-protocol object holding
+ * integers (read directly, without creating a Python object per seed), or as any other sequence of integers.
+ *
+ * @param i_0_object: Python integer, buffer of integers, or sequence of integers holding the seed lengths.
+ * @param n: Population size, used to verify that our seeds fit in our generation of individuals.
+ * @param i_0_size: Output, the number of seeds parsed.
+ * @return: A pointer to the parsed seeds (owned by the caller), or NULL if an error occurred.
+ */
+static int *_parse_i_0 (PyObject *i_0_object, int n, int *i_0_size) {
+    int *i_0;
+
+    // Buffers are checked first, as NumPy arrays also define __index__.
+    if (PyObject_CheckBuffer(i_0_object)) return _parse_i_0_buffer(i_0_object, n, i_0_size);
+
+    // A single seed.
+    if (PyIndex_Check(i_0_object)) {
+        if ((i_0 = _reserve_i_0(*i_0_size = 1, n)) == NULL) return NULL;
+        i_0[0] = (int) PyLong_AsLong(i_0_object);
+    }
+
+    // Otherwise, we must have a sequence of integers.
+    else {
+        PyObject *i_0_sequence = PySequence_Fast(i_0_object, "Seed lengths must be an integer or integers.");
+        if (i_0_sequence == NULL) return NULL;
+
+        *i_0_size = (int) PySequence_Fast_GET_SIZE(i_0_sequence);
+        if ((i_0 = _reserve_i_0(*i_0_size, n)) != NULL) {
+            for (int k = 0; k < *i_0_size; k++) {
+                i_0[k] = (int) PyLong_AsLong(PySequence_Fast_GET_ITEM(i_0_sequence, k));
+            }
+        }
+        Py_DECREF(i_0_sequence);
+    }
+
+    // Any non-integer seeds are reported here.
+    if (i_0 != NULL && PyErr_Occurred()) {
+        free(i_0);
+        return NULL;
+    }
+    return i_0;
+}
 
 /**
  * The tree tracing method, to be called directly from Python. We accept 6 parameters here, all a part of the
@@ -11,100 +260,578 @@
  * 4. d -- (float) Linear bias for the downward mutation rate.
  * 5. kappa -- (int) Lower bound of repeat lengths.
  * 6. omega -- (int) Upper bound of repeat lengths.
+ * 7. seed -- (int, optional) Seed for our RNG. If this is not given or None, we generate one from the time of day.
  *
- * We also seed our RNG here using the current time of day and allocate memory for our coalescent tree.
+ * We also seed our RNG here and obtain memory for our coalescent tree. The tree only stores the ancestor that splits at
+ * each coalescent event, so memory grows linearly with the population size. Buffers are reused from previously
+ * released populations of (at least) the same size where possible, and are returned when our capsule is evolved or
+ * destroyed.
  *
  * @param self: Unused, but required in signature I guess.
  * @param args: Arguments from the Python call. See list above.
  * @return: A pointer to the population structure holding the given parameters, the generated coalescent tree, and RNG.
  */
 static PyObject *trace (PyObject *self, PyObject *args) {
-    // Put our population object on the heap, to be shared between the trace and evolve steps.
-    PopulationTree *p = (PopulationTree *) malloc(sizeof(PopulationTree));
+    PopulationParameters theta;
+    PyObject *seed_object = NULL;
+    unsigned long long seed;
 
-    if (!PyArg_ParseTuple(args, "ifffii", &p->theta.n, &p->theta.f, &p->theta.c, &p->theta.d,
-                          &p->theta.kappa, &p->theta.omega))
+    if (!PyArg_ParseTuple(args, "ifffii|O", &theta.n, &theta.f, &theta.c, &theta.d, &theta.kappa, &theta.omega,
+                          &seed_object) || _parse_seed(seed_object, &seed) != 0)
         return NULL;
+    if (theta.n < 1) {
+        PyErr_SetString(PyExc_ValueError, "Population size must be positive.");
+        return NULL;
+    }
 
-    // Generate our random seed based on the current time.
-    gsl_rng_env_setup();
-    struct timeval tv;
-    gettimeofday(&tv, 0);
-    unsigned long s = tv.tv_sec + tv.tv_usec;
-
-    // Setup our generator.
-    const gsl_rng_type *T = gsl_rng_taus2;
-    p->r = gsl_rng_alloc(T);
-    gsl_rng_set(p->r, s);
+    // Put our population object on the heap, to be shared between the trace and evolve steps.
+    PopulationTree *p = _acquire_tree(theta.n);
+    if (p == NULL) return PyErr_NoMemory();
+    p->theta = theta;
 
-    // Reserve space for our ancestor chain.
-    p->coalescent_tree = (int *) malloc(_triangle(2 * p->theta.n) * sizeof(int));
-    memset(p->coalescent_tree, 0, _triangle(2 * p->theta.n) * sizeof(int));
+    // Seed our generator.
+    _seed_rng(p->r, seed);
 
     // Trace our tree. We do not perform repeat length determination at this step.
     _trace_tree(p->coalescent_tree, p->theta.n, p->r);
 
-    return PyCapsule_New(p, NULL, NULL);
+    PyObject *p_capsule = PyCapsule_New(p, TREE_CAPSULE, _tree_destructor);
+    if (p_capsule == NULL) _release_tree(p);
+    return p_capsule;
+}
+
+/**
+ * Verify that some mutation kernel is one of MUTATE_DRAW, MUTATE_GENERATION, or MUTATE_TABLE.
+ *
+ * @param kernel: Mutation kernel to verify.
+ * @return: 0 if valid. -1 (with a ValueError set) otherwise.
+ */
+static int _check_kernel (int kernel) {
+    if (kernel == MUTATE_DRAW || kernel == MUTATE_GENERATION || kernel == MUTATE_TABLE) return 0;
+
+    PyErr_SetString(PyExc_ValueError, "Mutation kernel must be MUTATE_DRAW, MUTATE_GENERATION, or MUTATE_TABLE.");
+    return -1;
+}
+
+/**
+ * Create a new writable memoryview of C ints (format "i"), backed by a bytearray. NumPy wraps such views as intc arrays
+ * without copying, so our results never pass through boxed Python integers.
+ *
+ * @param size: Number of ints our view holds.
+ * @param data: Output, a pointer to the ints of our view.
+ * @return: A new reference to our memoryview, or NULL if an error occurred.
+ */
+static PyObject *_new_int_view (Py_ssize_t size, int **data) {
+    PyObject *bytes = PyByteArray_FromStringAndSize(NULL, size * (Py_ssize_t) sizeof(int));
+    if (bytes == NULL) return NULL;
+
+    PyObject *view = PyMemoryView_FromObject(bytes);
+    Py_DECREF(bytes);
+    if (view == NULL) return NULL;
+
+    PyObject *int_view = PyObject_CallMethod(view, "cast", "s", "i");
+    Py_DECREF(view);
+    if (int_view != NULL) *data = (int *) PyMemoryView_GET_BUFFER(int_view)->buf;
+    return int_view;
 }
 
 /**
- * The repeat length determination method, to be called directly from Python. We accept 2 parameters here:
+ * The repeat length determination method, to be called directly from Python. We accept 4 parameters here:
  *
  * 1. p -- (PopulationTree) The population structure generated from a "trace" call.
- * 2. i_0 -- (list of ints) A Python list of integers holding the seed lengths.
+ * 2. i_0 -- (int, buffer of ints, or sequence of ints) The seed lengths. Buffers (e.g. NumPy arrays, including strided
+ *    slices) are read directly.
+ * 3. kernel -- (int, optional) Mutation kernel to evolve with: MUTATE_DRAW (default), MUTATE_GENERATION, or
+ *    MUTATE_TABLE.
+ * 4. out -- (writable buffer of C ints, optional) C-contiguous buffer of at least 2n ints to store our results in. If
+ *    this is not given or None, a new buffer is created.
  *
  * NOTE: No error checking occurs to see if the number of seeds passed fill in all slots of a given coalescent event.
  * For instance you may pass in 2 lengths, which leaves the individuals of the 2nd coalescent event to be both
  * determined and not determined.
  *
- * After evolving our entire tree, we release the memory incurred by our RNG and the entire tree. The evolved
- * individuals are saved to a Python list and returned.
+ * After evolving our entire tree, we return our RNG, the entire tree, and the population structure itself to our pool.
+ * The evolved individuals are copied to our output buffer, so no Python objects are created per individual. The capsule
+ * is renamed so that it can no longer be opened: evolving the same capsule twice raises a ValueError instead of
+ * touching released memory.
  *
  * @param self: Unused, but required in signature I guess.
  * @param args: Arguments from the Python call. See list above.
- * @return: A Python list containing 2n evolved individuals. The remaining individuals are currently discarded.
+ * @return: The given output buffer, or a new memoryview of C ints, holding 2n evolved individuals.
  */
 static PyObject *evolve (PyObject *self, PyObject *args) {
-    PyObject *i_0_list, *p_capsule = NULL;
+    PyObject *i_0_object, *p_capsule = NULL, *out_object = NULL, *result;
+    int i_0_size, kernel = MUTATE_DRAW, *i_evolved;
     PopulationTree *p;
+    Py_buffer out;
 
     // Parse our arguments.
-    if (!PyArg_ParseTuple(args, "OO", &p_capsule, &i_0_list))
+    if (!PyArg_ParseTuple(args, "OO|iO", &p_capsule, &i_0_object, &kernel, &out_object) || _check_kernel(kernel) != 0)
         return NULL;
 
     // Parse the population object generated from the trace call.
-    if (!(p = (PopulationTree *) PyCapsule_GetPointer(p_capsule, NULL))) return NULL;
+    if (!(p = (PopulationTree *) PyCapsule_GetPointer(p_capsule, TREE_CAPSULE))) return NULL;
+    Py_ssize_t out_n = 2 * (Py_ssize_t) p->theta.n;
 
-    // Verify that our list is not empty.
-    int i_0_size = PyObject_Length(i_0_list);
-    if (i_0_size <= 0) return NULL;
+    // Determine where our results are stored. We verify this before evolving, so our capsule is not consumed on error.
+    if (out_object != NULL && out_object != Py_None) {
+        if (_get_int_buffer(out_object, &out) != 0) return NULL;
+        if (out.len < out_n * (Py_ssize_t) sizeof(int)) {
+            PyErr_SetString(PyExc_ValueError, "Output buffer must hold 2n C ints.");
+            PyBuffer_Release(&out);
+            return NULL;
+        }
+        result = out_object;
+        Py_INCREF(result);
+        i_evolved = (int *) out.buf;
+    }
+    else if ((result = _new_int_view(out_n, &i_evolved)) == NULL) return NULL;
 
-    // Reserve space for our seed array.
-    int *i_0 = (int *) malloc(i_0_size * sizeof(int));
+    // Parse our seed array, and evolve our population.
+    int *i_0 = _parse_i_0(i_0_object, p->theta.n, &i_0_size);
+    int status = (i_0 == NULL) ? -1 : _evolve(i_0, i_0_size, p, kernel);
+    free(i_0);
 
-    // Parse our seed array. We assume that our array are integers.
-    for (int k = 0; k < i_0_size; k++) {
-        i_0[k] = PyLong_AsLong(PyList_GetItem(i_0_list, k));
+    if (status == 0) {  // Store our evolved generation of ancestors, and return our tree to our pool.
+        memcpy(i_evolved, p->individuals, out_n * sizeof(int));
+        PyCapsule_SetName(p_capsule, EVOLVED_CAPSULE);
+        _release_tree(p);
     }
+    if (out_object != NULL && out_object != Py_None) PyBuffer_Release(&out);
+    if (status != 0) {
+        Py_DECREF(result);
+        return (i_0 == NULL) ? NULL : PyErr_NoMemory();
+    }
+    return result;
+}
 
-    // Evolve our population.
-    _evolve(i_0, i_0_size, p);
-    int *i_evolved = &(p->coalescent_tree[_triangle(2 * p->theta.n) - 2 * p->theta.n]);
+/**
+ * Prepare a single job of our batched simulation: parse its master seed, verify that its output buffer can hold all
+ * of its populations, and parse its seed lengths (owned by the caller afterwards). The output buffer is not released.
+ *
+ * @return: 0 if successful. -1 (with an exception set) otherwise.
+ */
+static int _prepare_batch_job (BatchJob *job, PyObject *i_0_object, Py_buffer *out, PyObject *seed_object) {
+    if (_parse_seed(seed_object, &job->seed) != 0) return -1;
+    if (job->theta.n < 1 || job->simulation_n < 0) {
+        PyErr_SetString(PyExc_ValueError, "Population size must be positive, and simulation_n must not be negative.");
+        return -1;
+    }
 
-    // Store our evolved generation of ancestors in a Python list.
-    PyObject *i_evolved_list = PyList_New(2 * p->theta.n);
-    for (size_t k = 0; k != (size_t) 2 * p->theta.n; ++k) {
-        PyList_SET_ITEM(i_evolved_list, k, PyLong_FromLong(i_evolved[k]));
+    // Verify that our output buffer can hold all of our simulated populations.
+    Py_ssize_t out_size = (Py_ssize_t) job->simulation_n * 2 * job->theta.n * (Py_ssize_t) sizeof(int);
+    if (out->len < out_size) {
+        PyErr_SetString(PyExc_ValueError, "Output buffer must hold simulation_n * 2n C ints.");
+        return -1;
     }
 
-    _cleanup(p);
-    return i_evolved_list;
+    job->out = (int *) out->buf;
+    job->i_0 = _parse_i_0(i_0_object, job->theta.n, &job->i_0_size);
+    return (job->i_0 == NULL) ? -1 : 0;
+}
+
+/**
+ * The batched trace and evolve method, to be called directly from Python. We accept 12 parameters here:
+ *
+ * 1-6. n, f, c, d, kappa, omega -- The same population parameters given to "trace".
+ * 7. i_0 -- (int, buffer of ints, or sequence of ints) The seed lengths. See "evolve".
+ * 8. simulation_n -- (int) Number of populations to simulate.
+ * 9. out -- (writable buffer of C ints) C-contiguous buffer of at least simulation_n * 2n ints to store our results.
+ * 10. thread_n -- (int) Number of threads to simulate with. If this is not positive, we use all online processors.
+ * 11. seed -- (int, optional) Master seed. If this is not given or None, we generate one from the time of day.
+ * 12. kernel -- (int, optional) Mutation kernel to evolve with. See "evolve".
+ *
+ * The GIL is released while simulating. Each thread shares a single tree buffer and generation buffer across the
+ * simulations it is responsible for. The k'th simulated population is generated from the k'th substream of our master
+ * seed (this is identical to a trace + evolve call given the seed "split_seed(seed, k)"), and is written to
+ * out[k * 2n : (k + 1) * 2n], so no Python objects are created per simulation.
+ *
+ * @param self: Unused, but required in signature I guess.
+ * @param args: Arguments from the Python call. See list above.
+ * @return: None.
+ */
+static PyObject *simulate_batch (PyObject *self, PyObject *args) {
+    PyObject *i_0_object, *out_object, *seed_object = NULL;
+    int thread_n, status, kernel = MUTATE_DRAW;
+    BatchJob job = {0};
+    Py_buffer out;
+
+    if (!PyArg_ParseTuple(args, "ifffiiOiOi|Oi", &job.theta.n, &job.theta.f, &job.theta.c, &job.theta.d,
+                          &job.theta.kappa, &job.theta.omega, &i_0_object, &job.simulation_n, &out_object, &thread_n,
+                          &seed_object, &kernel) ||
+        _check_kernel(kernel) != 0 || _get_int_buffer(out_object, &out) != 0)
+        return NULL;
+    if (_prepare_batch_job(&job, i_0_object, &out, seed_object) != 0) {
+        PyBuffer_Release(&out);
+        return NULL;
+    }
+
+    // Trace and evolve each population without holding the GIL.
+    Py_BEGIN_ALLOW_THREADS
+    status = _simulate_batches(&job, 1, thread_n, kernel);
+    Py_END_ALLOW_THREADS
+
+    free(job.i_0);
+    PyBuffer_Release(&out);
+    if (status != 0) return PyErr_NoMemory();
+    Py_RETURN_NONE;
+}
+
+/**
+ * Parse a single (n, f, c, d, kappa, omega, i_0, simulation_n, out, seed) job of "simulate_batches". The output buffer
+ * of our job is only held if we are successful.
+ *
+ * @return: 0 if successful. -1 (with an exception set) otherwise.
+ */
+static int _parse_batch_job (PyObject *job_object, BatchJob *job, Py_buffer *out) {
+    PyObject *i_0_object, *out_object, *seed_object = NULL, *item = PySequence_Tuple(job_object);
+    if (item == NULL) return -1;
+
+    int status = PyArg_ParseTuple(item, "ifffiiOiO|O;Jobs must be (n, f, c, d, kappa, omega, i_0, simulation_n, "
+                                        "out, seed) tuples.", &job->theta.n, &job->theta.f, &job->theta.c,
+                                  &job->theta.d, &job->theta.kappa, &job->theta.omega, &i_0_object,
+                                  &job->simulation_n, &out_object, &seed_object) &&
+                 _get_int_buffer(out_object, out) == 0 ? 0 : -1;
+    if (status == 0 && (status = _prepare_batch_job(job, i_0_object, out, seed_object)) != 0) PyBuffer_Release(out);
+
+    Py_DECREF(item);
+    return status;
+}
+
+/**
+ * The batched trace and evolve method for several parameter sets, to be called directly from Python. We accept 3
+ * parameters here:
+ *
+ * 1. jobs -- (sequence of tuples) The (n, f, c, d, kappa, omega, i_0, simulation_n, out, seed) of each parameter set,
+ *    where each element is given to "simulate_batch" as is (seed is optional).
+ * 2. thread_n -- (int) Number of threads to simulate with. If this is not positive, we use all online processors.
+ * 3. kernel -- (int, optional) Mutation kernel to evolve with. See "evolve".
+ *
+ * The populations of every job are simulated in a single parallel step: our threads are split across the populations
+ * of all jobs (rather than across the populations of each job in turn), so many small jobs (e.g. the proposals of
+ * several Markov chains) keep every thread busy. Each job's output is identical to a "simulate_batch" call given the
+ * same arguments.
+ *
+ * @param self: Unused, but required in signature I guess.
+ * @param args: Arguments from the Python call. See list above.
+ * @return: None.
+ */
+static PyObject *simulate_batches (PyObject *self, PyObject *args) {
+    PyObject *jobs_object, *job_list;
+    int thread_n, status = 0, parsed_n = 0, kernel = MUTATE_DRAW;
+
+    if (!PyArg_ParseTuple(args, "Oi|i", &jobs_object, &thread_n, &kernel) || _check_kernel(kernel) != 0) return NULL;
+    if ((job_list = PySequence_Fast(jobs_object, "Jobs must be a sequence.")) == NULL) return NULL;
+
+    // Parse each of our jobs, holding the output buffer of each.
+    int job_n = (int) PySequence_Fast_GET_SIZE(job_list);
+    BatchJob *jobs = (BatchJob *) calloc(MAX(1, job_n), sizeof(BatchJob));
+    Py_buffer *outs = (Py_buffer *) calloc(MAX(1, job_n), sizeof(Py_buffer));
+    if (jobs == NULL || outs == NULL) {
+        PyErr_NoMemory();
+        status = -1;
+    }
+    while (status == 0 && parsed_n < job_n) {
+        status = _parse_batch_job(PySequence_Fast_GET_ITEM(job_list, parsed_n), &jobs[parsed_n], &outs[parsed_n]);
+        parsed_n += (status == 0) ? 1 : 0;
+    }
+
+    // Trace and evolve the populations of every job without holding the GIL.
+    if (status == 0) {
+        Py_BEGIN_ALLOW_THREADS
+        status = _simulate_batches(jobs, job_n, thread_n, kernel);
+        Py_END_ALLOW_THREADS
+        if (status != 0) PyErr_NoMemory();
+    }
+
+    for (int j = 0; j < parsed_n; j++) {
+        free(jobs[j].i_0);
+        PyBuffer_Release(&outs[j]);
+    }
+    free(jobs), free(outs);
+    Py_DECREF(job_list);
+    if (status != 0) return NULL;
+    Py_RETURN_NONE;
+}
+
+static void _free_graph (DemographicGraph *g) {
+    free(g->theta), free(g->offset), free(g->sources);
+}
+
+/**
+ * Parse a Python sequence of (n, f, c, d, kappa, omega) tuples into the populations of our graph, and lay out their
+ * generations.
+ *
+ * @return: 0 if successful. -1 (with an exception set) otherwise.
+ */
+static int _parse_populations (PyObject *population_list, DemographicGraph *g) {
+    g->population_n = (int) PySequence_Fast_GET_SIZE(population_list);
+    if (g->population_n < 1) {
+        PyErr_SetString(PyExc_ValueError, "At least one population must be given.");
+        return -1;
+    }
+
+    g->theta = (PopulationParameters *) malloc(g->population_n * sizeof(PopulationParameters));
+    g->offset = (int *) malloc(g->population_n * sizeof(int));
+    if (g->theta == NULL || g->offset == NULL) {
+        PyErr_NoMemory();
+        return -1;
+    }
+
+    for (int k = 0; k < g->population_n; k++) {
+        PopulationParameters *theta = &g->theta[k];
+        PyObject *item = PySequence_Tuple(PySequence_Fast_GET_ITEM(population_list, k));
+        if (item == NULL) return -1;
+
+        int is_parsed = PyArg_ParseTuple(item, "ifffii;Populations must be (n, f, c, d, kappa, omega) tuples.",
+                                         &theta->n, &theta->f, &theta->c, &theta->d, &theta->kappa, &theta->omega);
+        Py_DECREF(item);
+        if (!is_parsed) return -1;
+        if (theta->n < 1) {
+            PyErr_SetString(PyExc_ValueError, "Population size must be positive.");
+            return -1;
+        }
+
+        g->offset[k] = g->individual_n;
+        g->individual_n += 2 * theta->n;
+        g->n_max = MAX(g->n_max, theta->n);
+    }
+    return 0;
+}
+
+/**
+ * Parse a Python sequence of (child, parent, alpha, sigma) tuples into the sources of our graph. Every parent must
+ * precede its child, and every population after our first must have at least one source.
+ *
+ * @return: 0 if successful. -1 (with an exception set) otherwise.
+ */
+static int _parse_sources (PyObject *source_list, DemographicGraph *g) {
+    g->source_n = (int) PySequence_Fast_GET_SIZE(source_list);
+    g->sources = (DemographicSource *) malloc(MAX(1, g->source_n) * sizeof(DemographicSource));
+    if (g->sources == NULL) {
+        PyErr_NoMemory();
+        return -1;
+    }
+
+    for (int s = 0; s < g->source_n; s++) {
+        DemographicSource *source = &g->sources[s];
+        PyObject *item = PySequence_Tuple(PySequence_Fast_GET_ITEM(source_list, s));
+        if (item == NULL) return -1;
+
+        int is_parsed = PyArg_ParseTuple(item, "iiff;Sources must be (child, parent, alpha, sigma) tuples.",
+                                         &source->child, &source->parent, &source->alpha, &source->sigma);
+        Py_DECREF(item);
+        if (!is_parsed) return -1;
+        if (source->parent < 0 || source->child <= source->parent || source->child >= g->population_n ||
+            source->sigma < 0) {
+            PyErr_SetString(PyExc_ValueError, "Sources must draw from an earlier population, with sigma >= 0.");
+            return -1;
+        }
+    }
+
+    for (int k = 1; k < g->population_n; k++) {
+        int source_n = 0;
+        for (int s = 0; s < g->source_n; s++) source_n += (g->sources[s].child == k) ? 1 : 0;
+        if (source_n == 0) {
+            PyErr_SetString(PyExc_ValueError, "Every population after the first must have at least one source.");
+            return -1;
+        }
+    }
+    return 0;
+}
+
+/**
+ * Parse a Python description of a demographic graph into a C structure. See "simulate_graph" for this description.
+ *
+ * @param populations: Python sequence of population parameters.
+ * @param sources: Python sequence of population sources.
+ * @param g: Output, the parsed graph (zeroed beforehand). This must be freed with _free_graph, even on error.
+ * @return: 0 if successful. -1 (with an exception set) otherwise.
+ */
+static int _parse_graph (PyObject *populations, PyObject *sources, DemographicGraph *g) {
+    PyObject *population_list = PySequence_Fast(populations, "Populations must be a sequence.");
+    PyObject *source_list = (population_list == NULL) ? NULL : PySequence_Fast(sources, "Sources must be a sequence.");
+
+    int status = (source_list == NULL) ? -1 : _parse_populations(population_list, g);
+    if (status == 0) status = _parse_sources(source_list, g);
+
+    Py_XDECREF(population_list);
+    Py_XDECREF(source_list);
+    return status;
+}
+
+/**
+ * Prepare a single job of our graph simulation: parse its master seed and graph (into job->graph, which must be zeroed
+ * beforehand), verify that its output buffer can hold the last population of all of its simulations, and parse the
+ * seed lengths of its first population (owned by the caller afterwards). The output buffer is not released.
+ *
+ * @return: 0 if successful. -1 (with an exception set) otherwise.
+ */
+static int _prepare_graph_job (GraphJob *job, PyObject *populations, PyObject *sources, PyObject *i_0_object,
+                               Py_buffer *out, PyObject *seed_object) {
+    DemographicGraph *g = job->graph;
+    if (_parse_seed(seed_object, &job->seed) != 0 || _parse_graph(populations, sources, g) != 0) return -1;
+    if (job->simulation_n < 0) {
+        PyErr_SetString(PyExc_ValueError, "simulation_n must not be negative.");
+        return -1;
+    }
+
+    // Verify that our output buffer can hold the last population of all of our simulations.
+    Py_ssize_t out_size = (Py_ssize_t) job->simulation_n * 2 * g->theta[g->population_n - 1].n *
+                          (Py_ssize_t) sizeof(int);
+    if (out->len < out_size) {
+        PyErr_SetString(PyExc_ValueError, "Output buffer must hold simulation_n * 2n C ints (of our last population).");
+        return -1;
+    }
+
+    job->out = (int *) out->buf;
+    job->i_0 = _parse_i_0(i_0_object, g->theta[0].n, &job->i_0_size);
+    return (job->i_0 == NULL) ? -1 : 0;
+}
+
+/**
+ * The demographic graph simulation method, to be called directly from Python. We accept 8 parameters here:
+ *
+ * 1. populations -- (sequence of tuples) The (n, f, c, d, kappa, omega) parameters of each population, ordered such
+ *    that every population follows the populations it descends from. The first population descends from our seed
+ *    lengths, and the last population is the one sampled.
+ * 2. sources -- (sequence of tuples) The (child, parent, alpha, sigma) sources of each population after the first. A
+ *    source seeds its child with |N(alpha, sigma)| (clipped to 1) of its parent's individuals. Sources that share a
+ *    parent draw disjoint individuals in the order given, so a split into a fraction alpha and the remainder is given
+ *    as (a, p, alpha, sigma), (b, p, 1, 0). Admixed populations are given one source per parent.
+ * 3. i_0 -- (int, buffer of ints, or sequence of ints) The seed lengths of our first population. See "evolve".
+ * 4. simulation_n -- (int) Number of times to simulate our graph.
+ * 5. out -- (writable buffer of C ints) C-contiguous buffer of at least simulation_n * 2n ints to store our results,
+ *    where n is the size of our last population.
+ * 6. thread_n -- (int) Number of threads to simulate with. If this is not positive, we use all online processors.
+ * 7. seed -- (int, optional) Master seed. If this is not given or None, we generate one from the time of day.
+ * 8. kernel -- (int, optional) Mutation kernel to evolve with. See "evolve".
+ *
+ * The GIL is released while simulating. Each thread reuses a single tree buffer, generation buffer, and transition
+ * table across every population (stage) and every simulation it is responsible for, so no Python objects are created
+ * between stages. The k'th simulation is run from the k'th substream of our master seed, and its last population is
+ * written to out[k * 2n : (k + 1) * 2n].
+ *
+ * @param self: Unused, but required in signature I guess.
+ * @param args: Arguments from the Python call. See list above.
+ * @return: None.
+ */
+static PyObject *simulate_graph (PyObject *self, PyObject *args) {
+    PyObject *populations, *sources, *i_0_object, *out_object, *seed_object = NULL;
+    int thread_n, status, kernel = MUTATE_DRAW;
+    DemographicGraph g = {0};
+    GraphJob job = {.graph = &g};
+    Py_buffer out;
+
+    if (!PyArg_ParseTuple(args, "OOOiOi|Oi", &populations, &sources, &i_0_object, &job.simulation_n, &out_object,
+                          &thread_n, &seed_object, &kernel) || _get_int_buffer(out_object, &out) != 0)
+        return NULL;
+    if (_check_kernel(kernel) != 0 || _prepare_graph_job(&job, populations, sources, i_0_object, &out,
+                                                         seed_object) != 0) {
+        _free_graph(&g);
+        PyBuffer_Release(&out);
+        return NULL;
+    }
+
+    // Simulate each graph without holding the GIL.
+    Py_BEGIN_ALLOW_THREADS
+    status = _simulate_graphs(&job, 1, thread_n, kernel);
+    Py_END_ALLOW_THREADS
+
+    free(job.i_0);
+    _free_graph(&g);
+    PyBuffer_Release(&out);
+    if (status != 0) return PyErr_NoMemory();
+    Py_RETURN_NONE;
+}
+
+/**
+ * Parse a single (populations, sources, i_0, simulation_n, out, seed) job of "simulate_graphs" into the given job,
+ * whose graph must be zeroed beforehand (and freed with _free_graph, even on error). The output buffer of our job is
+ * only held if we are successful.
+ *
+ * @return: 0 if successful. -1 (with an exception set) otherwise.
+ */
+static int _parse_graph_job (PyObject *job_object, GraphJob *job, Py_buffer *out) {
+    PyObject *populations, *sources, *i_0_object, *out_object, *seed_object = NULL;
+    PyObject *item = PySequence_Tuple(job_object);
+    if (item == NULL) return -1;
+
+    int status = PyArg_ParseTuple(item, "OOOiO|O;Jobs must be (populations, sources, i_0, simulation_n, out, seed) "
+                                        "tuples.", &populations, &sources, &i_0_object, &job->simulation_n,
+                                  &out_object, &seed_object) && _get_int_buffer(out_object, out) == 0 ? 0 : -1;
+    if (status == 0 && (status = _prepare_graph_job(job, populations, sources, i_0_object, out, seed_object)) != 0)
+        PyBuffer_Release(out);
+
+    Py_DECREF(item);
+    return status;
+}
+
+/**
+ * The demographic graph simulation method for several graphs, to be called directly from Python. We accept 3
+ * parameters here:
+ *
+ * 1. jobs -- (sequence of tuples) The (populations, sources, i_0, simulation_n, out, seed) of each graph, where each
+ *    element is given to "simulate_graph" as is (seed is optional).
+ * 2. thread_n -- (int) Number of threads to simulate with. If this is not positive, we use all online processors.
+ * 3. kernel -- (int, optional) Mutation kernel to evolve with. See "evolve".
+ *
+ * The simulations of every job are run in a single parallel step, with our threads split across the simulations of
+ * all jobs. Each job's output is identical to a "simulate_graph" call given the same arguments.
+ *
+ * @param self: Unused, but required in signature I guess.
+ * @param args: Arguments from the Python call. See list above.
+ * @return: None.
+ */
+static PyObject *simulate_graphs (PyObject *self, PyObject *args) {
+    PyObject *jobs_object, *job_list;
+    int thread_n, status = 0, parsed_n = 0, kernel = MUTATE_DRAW;
+
+    if (!PyArg_ParseTuple(args, "Oi|i", &jobs_object, &thread_n, &kernel) || _check_kernel(kernel) != 0) return NULL;
+    if ((job_list = PySequence_Fast(jobs_object, "Jobs must be a sequence.")) == NULL) return NULL;
+
+    // Parse each of our jobs, holding the output buffer of each. Our graphs are zeroed, so each can always be freed.
+    int job_n = (int) PySequence_Fast_GET_SIZE(job_list);
+    GraphJob *jobs = (GraphJob *) calloc(MAX(1, job_n), sizeof(GraphJob));
+    DemographicGraph *graphs = (DemographicGraph *) calloc(MAX(1, job_n), sizeof(DemographicGraph));
+    Py_buffer *outs = (Py_buffer *) calloc(MAX(1, job_n), sizeof(Py_buffer));
+    if (jobs == NULL || graphs == NULL || outs == NULL) {
+        PyErr_NoMemory();
+        status = -1;
+    }
+    while (status == 0 && parsed_n < job_n) {
+        jobs[parsed_n].graph = &graphs[parsed_n];
+        status = _parse_graph_job(PySequence_Fast_GET_ITEM(job_list, parsed_n), &jobs[parsed_n], &outs[parsed_n]);
+        parsed_n += (status == 0) ? 1 : 0;
+    }
+
+    // Simulate the graphs of every job without holding the GIL.
+    if (status == 0) {
+        Py_BEGIN_ALLOW_THREADS
+        status = _simulate_graphs(jobs, job_n, thread_n, kernel);
+        Py_END_ALLOW_THREADS
+        if (status != 0) PyErr_NoMemory();
+    }
+
+    for (int j = 0; j < parsed_n; j++) {
+        free(jobs[j].i_0);
+        PyBuffer_Release(&outs[j]);
+    }
+    for (int j = 0; graphs != NULL && j < job_n; j++) _free_graph(&graphs[j]);
+    free(jobs), free(graphs), free(outs);
+    Py_DECREF(job_list);
+    if (status != 0) return NULL;
+    Py_RETURN_NONE;
 }
 
 static PyMethodDef popMethods[] = {
-        {"trace",  trace,  METH_VARARGS, "Creates an evolutionary tree."},
-        {"evolve", evolve, METH_VARARGS, "Evolves a given evolutionary tree."},
-        {NULL,     NULL,   0,            NULL}
+        {"trace",            trace,            METH_VARARGS, "Creates an evolutionary tree."},
+        {"evolve",           evolve,           METH_VARARGS, "Evolves a given evolutionary tree."},
+        {"simulate_batch",   simulate_batch,   METH_VARARGS, "Traces and evolves several trees into a given buffer."},
+        {"simulate_graph",   simulate_graph,   METH_VARARGS, "Simulates a demographic graph several times."},
+        {"simulate_batches", simulate_batches, METH_VARARGS, "Traces and evolves the trees of several parameter sets."},
+        {"simulate_graphs",  simulate_graphs,  METH_VARARGS, "Simulates several demographic graphs."},
+        {NULL,               NULL,             0,            NULL}
 };
 static struct PyModuleDef popModule = {
         PyModuleDef_HEAD_INIT,
@@ -114,5 +841,15 @@ static struct PyModuleDef popModule = {
         popMethods
 };
 PyMODINIT_FUNC PyInit_pop (void) {
-    return PyModule_Create(&popModule);
+    PyObject *m = PyModule_Create(&popModule);
+    if (m == NULL) return NULL;
+
+    // Expose our mutation kernels.
+    if (PyModule_AddIntConstant(m, "MUTATE_DRAW", MUTATE_DRAW) != 0 ||
+        PyModule_AddIntConstant(m, "MUTATE_GENERATION", MUTATE_GENERATION) != 0 ||
+        PyModule_AddIntConstant(m, "MUTATE_TABLE", MUTATE_TABLE) != 0) {
+        Py_DECREF(m);
+        return NULL;
+    }
+    return m;
 }
@@ -1,6 +1,7 @@
 #include <pthread.h>
 #include <stdlib.h>
 #include <string.h>
+#include <unistd.h>
 
 #include <gsl/gsl_math.h>
 #include <gsl/gsl_rng.h>
@@ -21,12 +22,107 @@ typedef struct PopulationParametersStruct {
 
 typedef struct CoalescentStruct {
     PopulationParameters theta; ///< Mutation model parameters.
-    int *coalescent_tree; ///< Pointer to our tree, stored as an array.
-    int offset; ///< We generalize to include 1+ ancestors. Determine the offset for array representation of tree.
+    int *coalescent_tree; ///< Pointer to our tree, stored as the index of the splitting ancestor for each event.
+    int *individuals; ///< Pointer to the repeat lengths of the current generation. Holds 2n individuals.
+    int offset; ///< We generalize to include 1+ ancestors. Determine the first coalescent event to evolve from.
     gsl_rng *r; ///< Pointer to our RNG. This is preserved across the trace and evolve steps.
+    int capacity; ///< Largest population size our tree and generation buffers can hold.
+    struct TransitionTableStruct *table; ///< Cached transition matrices of the table kernel. NULL until first used.
 } PopulationTree;
 
+// Number of cached transition matrices (by time) and powers of our single generation matrix in a transition table.
+// Times below TABLE_DIRECT (the vast majority of our events) each have their own slot, and larger times share the rest.
+#define TABLE_SLOTS 128
+#define TABLE_DIRECT 96
+#define TABLE_POWERS 31
+
+typedef struct TransitionTableStruct {
+    PopulationParameters theta; ///< Mutation model our matrices were built for.
+    int k; ///< Size of our repeat length space, omega - kappa + 1.
+    double *powers; ///< Powers P^(2^j) of our single generation matrix P, for j < powers_n.
+    int powers_n; ///< Number of powers computed so far.
+    double *slots; ///< Cumulative transition matrices over some number of generations, one per slot.
+    int *slot_t; ///< Number of generations held by each slot. 0 if the slot is empty.
+    double *work; ///< Scratch matrix for our products.
+} TransitionTable;
+
+// Mutation kernels available to our evolve step.
+#define MUTATE_DRAW 0 ///< Poisson approximation: two draws per individual per event, regardless of the time elapsed.
+#define MUTATE_GENERATION 1 ///< Exact: two uniform draws per individual per generation (cost grows with time elapsed).
+#define MUTATE_TABLE 2 ///< Exact: one uniform draw per individual per event, from a cached transition matrix.
+
+typedef struct BatchJobStruct {
+    PopulationParameters theta; ///< Parameters of every population of this job.
+    int *i_0; ///< Pointer to the seed lengths of this job.
+    int i_0_size; ///< Number of seed lengths.
+    int *out; ///< Pointer to the output of this job, holding one row of 2n individuals per population.
+    int simulation_n; ///< Number of populations (rows) to simulate.
+    unsigned long long seed; ///< Master seed. Each population is simulated from its own substream of this seed.
+} BatchJob;
+
+typedef struct BatchWorkerStruct {
+    PopulationTree p; ///< Population structure (tree, generation, and RNG) owned by this worker.
+    BatchJob *jobs; ///< Jobs shared across all workers.
+    int job; ///< Index of the job holding the first population this worker is responsible for.
+    int row; ///< Row (of this job) of the first population this worker is responsible for.
+    int simulation_n; ///< Number of populations this worker is responsible for. These may span several jobs.
+    int kernel; ///< Mutation kernel to evolve with (MUTATE_DRAW, MUTATE_GENERATION, or MUTATE_TABLE).
+    int status; ///< 0 if all of our populations were simulated. -1 if we could not allocate our workspace.
+} BatchWorker;
+
 int _triangle (int a) { return (int) (a * (a + 1) / 2.0); }
+
+/**
+ * SplitMix64 finalizer. Used to derive statistically independent seeds from a master seed.
+ */
+unsigned long long _splitmix64 (unsigned long long z) {
+    z += 0x9E3779B97F4A7C15ULL;
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL;
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL;
+    return z ^ (z >> 31);
+}
+
+/**
+ * Derive the seed of the stream'th substream of some master seed. This must match "split_seed" in "model.py".
+ */
+unsigned long long _substream_seed (unsigned long long seed, unsigned long long stream) {
+    return _splitmix64(seed ^ _splitmix64(stream));
+}
+/**
+ * Mirror of GSL's (private) taus2 state, three 32-bit words held in unsigned longs.
+ */
+typedef struct {
+    unsigned long s1, s2, s3;
+} Taus2State;
+
+/**
+ * Seed our generator from all 64 bits of the given seed. "gsl_rng_set" only uses the low 32 bits of the seed for
+ * taus2 (expanded with an LCG), so distinct substream seeds could collide. Instead, we fill the three state words of
+ * taus2 directly from SplitMix64 outputs, respecting the minimum values taus2 requires of each word (s1 > 1, s2 > 7,
+ * s3 > 15) and warming up our generator as GSL does. Any other generator type is seeded with "gsl_rng_set".
+ */
+void _seed_rng (gsl_rng *r, unsigned long long seed) {
+    if (r->type != gsl_rng_taus2 || gsl_rng_size(r) != sizeof(Taus2State)) {
+        gsl_rng_set(r, (unsigned long) seed);
+        return;
+    }
+
+    // taus2 ignores the lowest 1, 3, and 4 bits of each word, so we spread our (bijectively) mixed seed across the
+    // bits that are used: 31 bits in s1, 29 bits in s2, and the top 4 bits of s3.
+    unsigned long long z = _splitmix64(seed), w = _splitmix64(z);
+    Taus2State *state = (Taus2State *) gsl_rng_state(r);
+    state->s1 = (unsigned long) ((z << 1) & 0xffffffffULL);
+    state->s2 = (unsigned long) (((z >> 31) << 3) & 0xffffffffULL);
+    state->s3 = (unsigned long) (((z >> 60) << 28) | (1ULL << 25) | ((w & 0x1fffffULL) << 4));
+
+    // Words below their minimum are bumped. We record this in s3 so distinct seeds always give distinct states.
+    if (state->s1 < 2) state->s1 = 2UL, state->s3 |= 1UL << 27;
+    if (state->s2 < 8) state->s2 = 8UL, state->s3 |= 1UL << 26;
+
+    // Warm up our generator, as "gsl_rng_set" does.
+    for (int k = 0; k < 6; k++) gsl_rng_get(r);
+}
+
 int _round_num (int a) { return (a < 0) ? (int) (a - 0.5) : (int) (a + 0.5); }
 typedef int (*_mutate_f) (int, int, float, float, int, int, const gsl_rng *);
 
@@ -44,74 +140,364 @@ int _mutate_generation (int t, int ell, float c, float d, int kappa, int omega,
 }
 
 int _mutate_draw (int t, int ell, float c, float d, int kappa, int omega, const gsl_rng *r) {
-    return MIN((unsigned) omega, MAX((unsigned) kappa, ell + gsl_ran_poisson(r, t * c) -
-                                                       gsl_ran_poisson(r, t * ell * d)));
+    // Draw our upward and downward mutations once (MIN and MAX evaluate their arguments more than once), and keep our
+    // arithmetic signed so that large downward steps are bounded by kappa.
+    int ell_next = ell + (int) gsl_ran_poisson(r, t * c) - (int) gsl_ran_poisson(r, t * ell * d);
+    return MIN(omega, MAX(kappa, ell_next));
 }
 
-void _trace_tree (int *coalescent_tree, int n, const gsl_rng *r) {
-    for (int tau = 0; tau < 2 * n - 1; tau++) { // Diploid!
-        int tau_0 = _triangle(tau + 0), tau_1 = _triangle(tau + 1); // Start at 2nd coalescence.
+/**
+ * Multiply the k x k matrices a and b, storing the result in out. Out must not overlap a or b.
+ */
+void _multiply_matrix (const double *a, const double *b, double *out, int k) {
+    for (int i = 0; i < k; i++) {
+        for (int j = 0; j < k; j++) out[i * k + j] = 0;
+        for (int m = 0; m < k; m++) {
+            if (a[i * k + m] == 0) continue;
+            for (int j = 0; j < k; j++) out[i * k + j] += a[i * k + m] * b[m * k + j];
+        }
+    }
+}
+
+/**
+ * Compute the transition matrix of our bounded [kappa, omega] chain over a single generation, the exact equivalent of
+ * one step of _mutate_generation: we mutate upward with probability c, and then downward with probability ell * d. Row
+ * i holds the distribution of repeat lengths after one generation, given a starting length of kappa + i.
+ */
+void _generation_matrix (double *out, PopulationParameters theta) {
+    int k = theta.omega - theta.kappa + 1;
+    double c = MIN(1.0, MAX(0.0, theta.c));
 
-        // We save the indices of our ancestors to our descendants.
-        for (int k = 0; k < tau_1 - tau_0; k++) {
-        	coalescent_tree[tau_1 + k + 1] = tau_0 + k;
+    for (int i = 0; i < k * k; i++) out[i] = 0;
+    for (int i = 0; i < k; i++) {
+        for (int up = 0; up < 2; up++) {
+            int j = (up) ? MIN(k - 1, i + 1) : i;
+            double p_up = (up) ? c : 1 - c, p_down = MIN(1.0, MAX(0.0, (theta.kappa + j) * theta.d));
+
+            out[i * k + MAX(0, j - 1)] += p_up * p_down;
+            out[i * k + j] += p_up * (1 - p_down);
         }
+    }
+}
 
-        // Determine the individual whose frequency increases.
-        gsl_ran_choose(r, &coalescent_tree[tau_1], 1, &coalescent_tree[tau_1 + 1], tau_1 - tau_0, sizeof(int));
+/**
+ * Determine if the given transition table was built for the same mutation model as theta (n and f do not matter).
+ */
+int _is_table_for (const TransitionTable *table, PopulationParameters theta) {
+    return table->theta.c == theta.c && table->theta.d == theta.d && table->theta.kappa == theta.kappa &&
+           table->theta.omega == theta.omega;
+}
 
-        // Finally, shuffle the individuals in this generation.
-        gsl_ran_shuffle(r, &coalescent_tree[tau_1], tau_1 - tau_0 + 1, sizeof(int));
+void _free_table (TransitionTable *table) {
+    if (table == NULL) return;
+    free(table->powers), free(table->slots), free(table->slot_t), free(table->work), free(table);
+}
+
+/**
+ * Prepare the transition table of some population for the mutation model theta. Tables are kept across evolve calls,
+ * so a table built for the same mutation model is reused as is (cached matrices included). Otherwise, our table is
+ * emptied, and its buffers are only reallocated if our repeat length space has changed size.
+ *
+ * @return: 0 if successful. -1 if we could not allocate our table.
+ */
+int _prepare_table (TransitionTable **table, PopulationParameters theta) {
+    int k = theta.omega - theta.kappa + 1;
+    if (k < 1) return -1;
+    if (*table != NULL && _is_table_for(*table, theta)) return 0;
+
+    if (*table != NULL && (*table)->k != k) {
+        _free_table(*table);
+        *table = NULL;
+    }
+    if (*table == NULL) {
+        TransitionTable *t = (TransitionTable *) calloc(1, sizeof(TransitionTable));
+        if (t == NULL) return -1;
+        t->k = k;
+        t->powers = (double *) malloc((size_t) TABLE_POWERS * k * k * sizeof(double));
+        t->slots = (double *) malloc((size_t) TABLE_SLOTS * k * k * sizeof(double));
+        t->slot_t = (int *) malloc(TABLE_SLOTS * sizeof(int));
+        t->work = (double *) malloc((size_t) k * k * sizeof(double));
+        if (t->powers == NULL || t->slots == NULL || t->slot_t == NULL || t->work == NULL) {
+            _free_table(t);
+            return -1;
+        }
+        *table = t;
     }
+
+    // Empty our cache. Only the single generation matrix is computed up front.
+    (*table)->theta = theta;
+    for (int j = 0; j < TABLE_SLOTS; j++) (*table)->slot_t[j] = 0;
+    _generation_matrix((*table)->powers, theta);
+    (*table)->powers_n = 1;
+    return 0;
 }
 
-void _evolve_individual (int k, int *descendants, int t_coalescence, _mutate_f mutate, PopulationTree *p) {
-    int *descendant_to_evolve = &(p->coalescent_tree[descendants[k]]);
+/**
+ * Obtain the cumulative transition matrix of our chain over t generations (t must be positive): row i holds the CDF of
+ * the repeat length after t generations, given a starting length of kappa + i. Matrices are cached by t, so every
+ * coalescent event (of every population) that shares a time reuses the same matrix. On a miss, the matrix is built
+ * from the cached powers P^(2^j) of our single generation matrix P, which costs one product per set bit of t (as
+ * opposed to t steps of _mutate_generation).
+ */
+const double *_lookup_table (TransitionTable *table, int t) {
+    int k = table->k, slot = (t < TABLE_DIRECT) ? t : TABLE_DIRECT + t % (TABLE_SLOTS - TABLE_DIRECT);
+    double *out = table->slots + (size_t) slot * k * k;
+    if (table->slot_t[slot] == t) return out;
+
+    // Multiply together the powers of P associated with each set bit of t. Powers are computed as they are needed.
+    int is_first = 1;
+    for (int j = 0; (t >> j) > 0 && j < TABLE_POWERS; j++) {
+        if (j >= table->powers_n) {
+            double *previous = table->powers + (size_t) (j - 1) * k * k;
+            _multiply_matrix(previous, previous, table->powers + (size_t) j * k * k, k);
+            table->powers_n = j + 1;
+        }
+        if (!((t >> j) & 1)) continue;
 
-    // Evolve each ancestor according to the average time to coalescence and the scaling factor f.
-    *descendant_to_evolve = (*mutate)(t_coalescence, *descendant_to_evolve, p->theta.c, p->theta.d,
-                                      p->theta.kappa, p->theta.omega, p->r);
+        double *power = table->powers + (size_t) j * k * k;
+        if (is_first) {
+            memcpy(out, power, k * k * sizeof(double));
+            is_first = 0;
+        } else {
+            _multiply_matrix(out, power, table->work, k);
+            memcpy(out, table->work, k * k * sizeof(double));
+        }
+    }
 
-    // Save our descendant state.
-    descendants[k] = *descendant_to_evolve;
+    // Convert each row into a CDF. Each CDF is normalized, so a uniform draw in [0, 1) always lands on some length.
+    for (int i = 0; i < k; i++) {
+        double *row = out + (size_t) i * k;
+        for (int j = 1; j < k; j++) row[j] += row[j - 1];
+        for (int j = 0; j < k - 1; j++) row[j] /= row[k - 1];
+        row[k - 1] = 1;
+    }
+
+    table->slot_t[slot] = t;
+    return out;
 }
 
 /**
- * We assumed our tree has been traced. Given the population tree structure and a pointer to a mutation function,
- * determine the repeat length of all individuals in our tree. We do so by iterating through each coalescent event.
+ * Sample a repeat length from row (ell - kappa) of some cumulative transition matrix, using a single uniform draw and
+ * a binary search. Lengths outside of [kappa, omega] are first bounded.
  */
-void _evolve_event (PopulationTree *p, _mutate_f mutate) {
-    int descendants_size, expected_time, t_coalescence;
-    int *descendants = NULL;
+int _mutate_table (const double *cdf, int ell, int kappa, int omega, const gsl_rng *r) {
+    int k = omega - kappa + 1, low = 0, high = k - 1;
+    const double *row = cdf + (size_t) (MIN(omega, MAX(kappa, ell)) - kappa) * k;
+    double u = gsl_rng_uniform(r);
 
-    for (int tau = p->offset; tau < 2 * p->theta.n - 1; tau++) {
-        // We define our descendants for the tau'th coalescent.
-        descendants = &(p->coalescent_tree[_triangle(tau + 1)]);
-        descendants_size = _triangle(tau + 2) - _triangle(tau + 1);
+    // Find the first length whose cumulative probability exceeds u.
+    while (low < high) {
+        int middle = (low + high) / 2;
+        if (u < row[middle]) high = middle;
+        else low = middle + 1;
+    }
+    return kappa + low;
+}
 
+/**
+ * Trace our tree. At the tau'th coalescent event there exist tau + 1 ancestors, one of which splits into two
+ * descendants. We only need to record which ancestor splits: the remaining tau ancestors carry over to the next
+ * generation in place. This gives us a tree whose memory grows linearly with n, as opposed to storing every generation.
+ */
+void _trace_tree (int *coalescent_tree, int n, const gsl_rng *r) {
+    for (int tau = 0; tau < 2 * n - 1; tau++) { // Diploid!
+        // Determine the individual whose frequency increases.
+        coalescent_tree[tau] = (int) gsl_rng_uniform_int(r, (unsigned long) tau + 1);
+    }
+}
+
+/**
+ * We assumed our tree has been traced. Given the population tree structure and a mutation kernel, determine the repeat
+ * length of all individuals in our tree. We do so by iterating through each coalescent event, evolving our generation
+ * of individuals in place. Every ancestor of an event shares the same time to coalescence, so the table kernel looks up
+ * a single transition matrix per event (our table must be prepared beforehand).
+ */
+void _evolve_event (PopulationTree *p, int kernel) {
+    _mutate_f mutate = (kernel == MUTATE_GENERATION) ? _mutate_generation : _mutate_draw;
+    int expected_time, t_coalescence;
+    int *individuals = p->individuals;
+
+    for (int tau = p->offset; tau < 2 * p->theta.n - 1; tau++) {
         // Determine time to coalescence. This is exponentially distributed, but the mean stays the same. Scale by f.
         expected_time = (int) (p->theta.f * 2 * p->theta.n / (float) _triangle(tau + 1));
-        t_coalescence = MAX(1, _round_num(gsl_ran_exponential(p->r, expected_time)));
+        t_coalescence = _round_num(gsl_ran_exponential(p->r, expected_time));
+        t_coalescence = MAX(1, t_coalescence); // Draw once: MAX evaluates its arguments more than once.
+
+        if (kernel == MUTATE_TABLE) { // Every ancestor (and our new descendant) is sampled from the same matrix.
+            const double *table = _lookup_table(p->table, t_coalescence);
+            for (int k = 0; k < tau + 1; k++) {
+                individuals[k] = _mutate_table(table, individuals[k], p->theta.kappa, p->theta.omega, p->r);
+            }
+            individuals[tau + 1] = _mutate_table(table, individuals[p->coalescent_tree[tau]], p->theta.kappa,
+                                                 p->theta.omega, p->r);
+            continue;
+        }
 
-        // Iterate through each of the descendants (currently indices) and determine each ancestor.
-        for (int k = 0; k < descendants_size; k++) {
-            _evolve_individual(k, descendants, t_coalescence, mutate, p);
+        // Evolve each ancestor according to the average time to coalescence and the scaling factor f.
+        for (int k = 0; k < tau + 1; k++) {
+            individuals[k] = (*mutate)(t_coalescence, individuals[k], p->theta.c, p->theta.d, p->theta.kappa,
+                                       p->theta.omega, p->r);
         }
+
+        // Our new descendant is appended to the generation, and is evolved from its (already evolved) sibling.
+        individuals[tau + 1] = (*mutate)(t_coalescence, individuals[p->coalescent_tree[tau]], p->theta.c,
+                                         p->theta.d, p->theta.kappa, p->theta.omega, p->r);
     }
 }
 
-void _evolve (int *i_0, int i_0_size, PopulationTree *p) {
+/**
+ * Evolve our traced tree from the given seed lengths, using the given mutation kernel.
+ *
+ * @return: 0 if successful. -1 if we could not allocate the transition table of our kernel.
+ */
+int _evolve (int *i_0, int i_0_size, PopulationTree *p, int kernel) {
+    // Only the table kernel requires a table. This is kept with our population structure, and reused across calls.
+    if (kernel == MUTATE_TABLE && _prepare_table(&p->table, p->theta) != 0)
+        return -1;
+
     // Determine our offset, and seed our ancestors for the tree.
     p->offset = i_0_size - 1;
     for (int k = 0; k < i_0_size; k++) {
-        p->coalescent_tree[k + _triangle(p->offset)] = i_0[k];
+        p->individuals[k] = i_0[k];
     }
 
     // From our common ancestors, descend forward in time and populate our tree with repeat lengths.
-    _evolve_event(p, _mutate_draw);
+    _evolve_event(p, kernel);
+
+    // Descendants are always appended to the end of our generation. Shuffle to remove this ordering.
+    gsl_ran_shuffle(p->r, p->individuals, 2 * p->theta.n, sizeof(int));
+    return 0;
 }
 
 void _cleanup (PopulationTree *p) {
     free(p->coalescent_tree);
-    gsl_rng_free(p->r);
+    free(p->individuals);
+    if (p->r != NULL) gsl_rng_free(p->r);
+    _free_table(p->table);
+}
+
+/**
+ * Thread entry point for our batched simulation. Trace and evolve each population this worker is responsible for,
+ * reusing the same tree and generation buffers. Results are copied directly into the associated row of each job.
+ */
+void *_simulate_worker (void *args) {
+    BatchWorker *w = (BatchWorker *) args;
+    int j = w->job, row = w->row;
+
+    w->status = 0;
+    for (int k = 0; k < w->simulation_n && w->status == 0; k++, row++) {
+        while (row >= w->jobs[j].simulation_n) j++, row = 0; // Move on to the next job with populations left.
+        BatchJob *job = &w->jobs[j];
+
+        // Each population has its own substream, so our results do not depend on the number of workers (or jobs).
+        w->p.theta = job->theta;
+        _seed_rng(w->p.r, _substream_seed(job->seed, (unsigned long long) row));
+
+        _trace_tree(w->p.coalescent_tree, job->theta.n, w->p.r);
+        w->status = _evolve(job->i_0, job->i_0_size, &w->p, w->kernel);
+        memcpy(job->out + (size_t) row * 2 * job->theta.n, w->p.individuals, 2 * job->theta.n * sizeof(int));
+    }
+
+    return NULL;
+}
+
+/**
+ * Run thread_n workers (each an element of size worker_size in the given array) through the given thread entry point.
+ * The first worker runs on the calling thread, as do workers that could not be spawned.
+ *
+ * @return: 0 if successful. -1 if we could not allocate our threads.
+ */
+int _run_workers (void *workers, size_t worker_size, int thread_n, void *(*worker) (void *)) {
+    pthread_t *threads = (pthread_t *) malloc(thread_n * sizeof(pthread_t));
+    int *is_spawned = (int *) calloc(thread_n, sizeof(int));
+    if (threads == NULL || is_spawned == NULL) {
+        free(threads), free(is_spawned);
+        return -1;
+    }
+
+    for (int t = 1; t < thread_n; t++) {
+        is_spawned[t] = pthread_create(&threads[t], NULL, worker, (char *) workers + t * worker_size) == 0;
+    }
+    (*worker)(workers);
+    for (int t = 1; t < thread_n; t++) {
+        if (is_spawned[t]) pthread_join(threads[t], NULL);
+        else (*worker)((char *) workers + t * worker_size);
+    }
+
+    free(threads), free(is_spawned);
+    return 0;
+}
+
+/**
+ * Determine the number of threads to simulate simulation_n populations with. If thread_n is not positive, we use the
+ * number of online processors. We never use more threads than populations.
+ */
+int _thread_count (int thread_n, int simulation_n) {
+    thread_n = (thread_n > 0) ? thread_n : (int) MAX(1, sysconf(_SC_NPROCESSORS_ONLN));
+    return MAX(1, MIN(thread_n, simulation_n));
+}
+
+/**
+ * Simulate the populations of several jobs, split across thread_n threads. The populations of all jobs are treated as
+ * a single sequence of rows, which we partition into contiguous blocks (one per thread), so jobs with few populations
+ * do not leave our threads idle. Each thread is given its own tree buffers (sized for our largest population) and its
+ * own RNG. The k'th population of a job is simulated using the k'th substream of the job's master seed, and is written
+ * to out[k * 2n : (k + 1) * 2n] of that job. If thread_n is not positive, we use the number of online processors.
+ *
+ * @return: 0 if successful. -1 if we could not allocate our workers (or their workspace).
+ */
+int _simulate_batches (BatchJob *jobs, int job_n, int thread_n, int kernel) {
+    int status = 0, simulation_n = 0, n_max = 1;
+    for (int j = 0; j < job_n; j++) {
+        simulation_n += jobs[j].simulation_n;
+        n_max = MAX(n_max, jobs[j].theta.n);
+    }
+    if (simulation_n == 0) return 0;
+
+    thread_n = _thread_count(thread_n, simulation_n);
+    BatchWorker *workers = (BatchWorker *) malloc(thread_n * sizeof(BatchWorker));
+    if (workers == NULL) return -1;
+
+    // Partition the rows of all of our jobs into contiguous blocks, one per worker.
+    for (int t = 0, j = 0, row = 0; t < thread_n; t++) {
+        BatchWorker *w = &workers[t];
+        w->simulation_n = simulation_n / thread_n + ((t < simulation_n % thread_n) ? 1 : 0);
+        w->jobs = jobs, w->job = j, w->row = row;
+        w->kernel = kernel, w->status = -1;
+        for (row += w->simulation_n; j < job_n && row >= jobs[j].simulation_n; j++) row -= jobs[j].simulation_n;
+
+        // Each worker owns its buffers and RNG.
+        w->p.coalescent_tree = (int *) malloc((2 * n_max - 1) * sizeof(int));
+        w->p.individuals = (int *) malloc(2 * n_max * sizeof(int));
+        w->p.r = gsl_rng_alloc(gsl_rng_taus2);
+        w->p.capacity = n_max;
+        w->p.table = NULL;
+    }
+
+    // Fan out to our workers, if all of their workspace could be allocated.
+    for (int t = 0; t < thread_n; t++) {
+        BatchWorker *w = &workers[t];
+        if (w->p.coalescent_tree == NULL || w->p.individuals == NULL || w->p.r == NULL) status = -1;
+    }
+    if (status == 0) status = _run_workers(workers, sizeof(BatchWorker), thread_n, _simulate_worker);
+
+    for (int t = 0; t < thread_n; t++) {
+        status = (workers[t].status != 0) ? workers[t].status : status;
+        _cleanup(&workers[t].p);
+    }
+    free(workers);
+    return status;
+}
+
+/**
+ * Simulate simulation_n populations of a single parameter set, split across thread_n threads. The k'th population is
+ * simulated using the k'th substream of the given master seed, and is written to out[k * 2n : (k + 1) * 2n]. See
+ * "_simulate_batches".
+ *
+ * @return: 0 if successful. -1 if we could not allocate our workers (or their workspace).
+ */
+int _simulate_batch (PopulationParameters theta, int *i_0, int i_0_size, int *out, int simulation_n, int thread_n,
+                     unsigned long long seed, int kernel) {
+    BatchJob job = {theta, i_0, i_0_size, out, simulation_n, seed};
+    return _simulate_batches(&job, 1, thread_n, kernel);
 }
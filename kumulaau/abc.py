@@ -1,40 +1,127 @@
 #!/usr/bin/env python3
-from kumulaau.distance import populate_d
 from typing import Callable, Sequence
-from numpy import ndarray
+from numpy import ndarray, zeros, log, inf
+from numba import jit
 
 
-def _populate_h(h: ndarray, d: ndarray, epsilon: float) -> None:
-    """ If the distance between a observation and generated sample falls below epsilon, we count this as a matched
-    (marked 1 in the matrix H). Otherwise, we count this as a zero. This is the ABC portion.
+@jit(nopython=True, nogil=True)
+def _match_counts(d: ndarray, epsilon: float) -> ndarray:
+    """ If the distance between a observation and generated sample falls below epsilon, we count this as a match. For
+    each observation (column of D), count the number of generated samples that match. This is the ABC portion,
+    computed directly from D (we never build a matched matrix). Optimized by Numba.
 
-    :param h: Binary match matrix of generated x observation to populate. Must be the same size as D.
     :param d: **Populated** D matrix, holding all distances between a generated and observed population.
     :param epsilon: The minimum distance between frequencies to label as a match.
-    :return: None.
+    :return: Vector holding the number of matches of each observation.
     """
+    matched = zeros(d.shape[1])
+
+    # Walk D row by row (in memory order), so each row is only read once.
     for i in range(d.shape[0]):
         for j in range(d.shape[1]):
-            h[i, j] = 1 if d[i, j] < epsilon else 0
+            if d[i, j] < epsilon:
+                matched[j] += 1
+
+    return matched
 
 
-def _likelihood_from_h(h: ndarray) -> float:
-    """ 'j' specifies the column or associated observed microsatellite sample in the matched matrix. To determine
-    the probability of a model (parameters) matching this observed sample, we compute the average of this column.
-    Repeat this for all 'j's, and take the product (assumes each is independent).
+@jit(nopython=True, nogil=True)
+def _acceptance_rates(d: ndarray, epsilon: float) -> ndarray:
+    """ For each observation (column of D), determine the fraction of generated samples that match.
 
-    :param h: Matrix of instances where a observation - generated match and don't (matched matrix).
-    :return: The likelihood the generated sample set matches our observations.
+    :param d: **Populated** D matrix, holding all distances between a generated and observed population.
+    :param epsilon: The minimum distance between frequencies to label as a match.
+    :return: Vector holding the acceptance rate of each observation.
     """
-    from numpy import log, exp, mean
+    return _match_counts(d, epsilon) / d.shape[0]
+
+
+@jit(nopython=True, nogil=True)
+def _log_likelihood_from_rates(rates: ndarray) -> float:
+    """ To determine the probability of a model (parameters) matching some observed sample, we use the acceptance rate
+    of its column. Repeat this for all observations, and take the product (assumes each is independent). We work with
+    logarithms to avoid underflow, and skip observations that were never matched to avoid log(0) errors. If no
+    observation was matched at all, our proposal has no support (-inf).
+
+    :param rates: Vector holding the acceptance rate of each observation.
+    :return: The log-likelihood the generated sample set matches our observations.
+    """
+    col_sum, matched_n = 0.0, 0
+    for j in range(rates.shape[0]):
+        if rates[j] > 0:
+            col_sum += log(rates[j])
+            matched_n += 1
+
+    return col_sum if matched_n > 0 else -inf
+
+
+def _log_likelihood_from_d(d: ndarray, epsilon: float) -> float:
+    """ Determine the log-likelihood of our proposal from a populated D matrix, using the acceptance rate of each
+    observation.
+
+    :param d: **Populated** D matrix, holding all distances between a generated and observed population.
+    :param epsilon: The minimum distance between frequencies to label as a match.
+    :return: The log-likelihood the generated sample set matches our observations.
+    """
+    return _log_likelihood_from_rates(_acceptance_rates(d, epsilon))
+
+
+@jit(nopython=True, nogil=True)
+def _log_likelihood_bound(d: ndarray, epsilon: float, simulation_n: int) -> float:
+    """ Given the first rows of some D matrix, determine the largest log-likelihood our proposal can still achieve once
+    all 'simulation_n' rows are populated. This is the case where every remaining simulation matches every observation
+    that has already been matched (observations that are never matched are skipped, and contribute nothing).
+
+    :param d: The first rows of some D matrix, already populated.
+    :param epsilon: The minimum distance between frequencies to label as a match.
+    :param simulation_n: Number of rows the full D matrix holds.
+    :return: An upper bound on the log-likelihood of our proposal.
+    """
+    matched, remaining_n = _match_counts(d, epsilon), simulation_n - d.shape[0]
+
+    col_sum, matched_n = 0.0, 0
+    for j in range(matched.shape[0]):
+        if matched[j] > 0:
+            col_sum += log((matched[j] + remaining_n) / simulation_n)
+            matched_n += 1
 
-    # Avoid floating point error, use logarithms. Avoid log(0) errors.
-    col_sum = sum(map(lambda a: 0 if a == 0 else log(a), mean(h, axis=0)))
-    return 0 if col_sum == 0 else exp(col_sum)
+    return col_sum if matched_n > 0 or remaining_n > 0 else -inf
+
+
+def run_chains(walk: Callable, sample: Callable, delta: Callable, log_handlers: Sequence, theta_0s: Sequence,
+               observed: Sequence, simulation_n: int, boundaries: Sequence, epsilon: float,
+               sample_batch: Callable = None, seed=None, chunk_n: int = None, **kwargs) -> int:
+    """ Population-based version of our ABC-MCMC approach (see run). Several independent chains are advanced together,
+    and the proposals of all chains are simulated in one parallel step.
+
+    :param walk: Function that accepts some parameter set and returns another parameter set (or one per chain).
+    :param sample: Function that produces a collection of repeat lengths (i.e. the model function).
+    :param delta: Frequency distribution distance function. 0 = exact match, 1 = maximally dissimilar.
+    :param log_handlers: Functions that handle what occurs with each Markov chain and results (one per chain).
+    :param theta_0s: Initial starting point of each chain. Ignored if we resume from a checkpoint (see mcmc.run).
+    :param observed: 2D list of (int, float) tuples representing the (repeat length, frequency) tuples.
+    :param simulation_n: Number of simulations to use to obtain a distance.
+    :param boundaries: Starting and ending iteration for this specific MCMC run.
+    :param epsilon: Maximum acceptance value for distance between [0, 1].
+    :param sample_batch: Optional function that produces the populations of several parameter sets in one call (used in
+        place of sample). See populate_d_all in distance.py.
+    :param seed: Master seed for this run. If specified, our walk, acceptance, and simulations are all reproducible.
+    :param chunk_n: If specified, we draw our uniform first and simulate in chunks of 'chunk_n', rejecting a proposal
+        as soon as it can no longer be accepted (early rejection).
+    :param kwargs: Additional options for our MCMC engine (buffer_n, checkpoint, checkpoint_n, cache). See mcmc.run.
+    :return: The number of simulations saved by early rejection.
+    """
+    from kumulaau.mcmc import run as run_mcmc
+
+    return run_mcmc(walk=walk, sample=sample, delta=delta, log_handlers=log_handlers, theta_0s=theta_0s,
+                    observed=observed, simulation_n=simulation_n, boundaries=boundaries,
+                    log_likelihood=lambda d: _log_likelihood_from_d(d, epsilon), sample_batch=sample_batch, seed=seed,
+                    log_likelihood_bound=lambda d, n: _log_likelihood_bound(d, epsilon, n), chunk_n=chunk_n, **kwargs)
 
 
 def run(walk: Callable, sample: Callable, delta: Callable, log_handler: Callable, theta_0,
-        observed: Sequence, simulation_n: int, boundaries: Sequence, epsilon: float) -> None:
+        observed: Sequence, simulation_n: int, boundaries: Sequence, epsilon: float,
+        sample_batch: Callable = None, seed=None, **kwargs) -> int:
     """ A MCMC algorithm to approximate the posterior distribution of a generic model, whose acceptance to the
     chain is determined by some distance between repeat length distributions. My interpretation of this
     ABC-MCMC approach is given below:
@@ -50,6 +137,9 @@ def run(walk: Callable, sample: Callable, delta: Callable, log_handler: Callable
         c) If this probability is greater than the probability of the previous, we accept.
         d) Otherwise, we accept our proposed with probability p(proposed) / p(prev).
 
+    With early rejection (chunk_n), our uniform is drawn before step (a), and step (a) stops once the best probability
+    our proposal can still reach falls below the probability needed to accept it.
+
     :param walk: Function that accepts some parameter set and returns another parameter set.
     :param sample: Function that produces a collection of repeat lengths (i.e. the model function).
     :param delta: Frequency distribution distance function. 0 = exact match, 1 = maximally dissimilar.
@@ -59,40 +149,12 @@ def run(walk: Callable, sample: Callable, delta: Callable, log_handler: Callable
     :param simulation_n: Number of simulations to use to obtain a distance.
     :param boundaries: Starting and ending iteration for this specific MCMC run.
     :param epsilon: Maximum acceptance value for distance between [0, 1].
-    :return: None.
+    :param sample_batch: Optional function that produces the populations of several parameter sets in one call (used in
+        place of sample). See populate_d_all in distance.py.
+    :param seed: Master seed for this run. If specified, our walk, acceptance, and simulations are all reproducible.
+    :param kwargs: Additional options (chunk_n, buffer_n, checkpoint, checkpoint_n, cache). See run_chains and mcmc.run.
+    :return: The number of simulations saved by early rejection.
     """
-    from numpy import zeros, mean, nextafter
-    from types import SimpleNamespace
-    from numpy.random import uniform
-    from datetime import datetime
-
-    # Save our results according to the namespace below.
-    a_record = lambda a_1, b_1, c_1, d_1, e_1, f_1: SimpleNamespace(theta=a_1, time_r=b_1, waiting_time=c_1,
-                                                                    p_proposed=d_1, expected_delta=e_1,
-                                                                    proposed_time=f_1)
-
-    # Seed our Markov chain with our initial guess.
-    x = [a_record(theta_0, 0, 1, 0, 0, 0)]
-
-    for i in range(boundaries[0] + 1, boundaries[1]):
-        theta_proposed = walk(x[-1].theta)  # Walk from our previous state.
-
-        # Prepare our H and D matrices.
-        h = zeros((simulation_n, len(observed)), dtype='int8')
-        d = zeros((simulation_n, len(observed)), dtype='float64')
-
-        # Populate D, then H.
-        populate_d(d, observed, sample, delta, theta_proposed, [theta_proposed.kappa, theta_proposed.omega])
-        _populate_h(h, d, epsilon)
-
-        # Accept our proposal according to our alpha value. Metropolis sampling.
-        p_proposed, p_k = _likelihood_from_h(h), x[-1].p_proposed
-        if abs(0 - p_k) < nextafter(0, 1) or p_proposed / p_k > uniform(0, 1):
-            x = x + [a_record(theta_proposed, datetime.now(), 1, p_proposed, mean(d), i)]
-
-        # Reject our proposal. We keep our current state and increment our waiting times.
-        else:
-            x[-1].waiting_time += 1
-
-        # We record to our chain. This is dependent on the current iteration of MCMC.
-        log_handler(x, i)
+    return run_chains(walk=walk, sample=sample, delta=delta, log_handlers=[log_handler], theta_0s=[theta_0],
+                      observed=observed, simulation_n=simulation_n, boundaries=boundaries, epsilon=epsilon,
+                      sample_batch=sample_batch, seed=seed, **kwargs)
@@ -1,15 +1,38 @@
 #!/usr/bin/env python3
-from numpy import ndarray, zeros, mean, std, int8, arccos, dot, pi
+from numpy import ndarray, zeros, mean, std, arccos, dot, pi, sqrt
 from typing import Callable, Sequence
 from argparse import Namespace
 from numpy.linalg import norm
-from numba import jit
+from numba import jit, prange
+from os.path import isdir
 
 _pool_singleton = None
 _observed_matrix = None
 
+# Directory used to share simulated populations between our pool workers and our main process. Prefer tmpfs.
+_SHARED_DIRECTORY = '/dev/shm' if isdir('/dev/shm') else None
 
-@jit(nopython=True, nogil=True, target='cpu', parallel=True)
+
+@jit(nopython=True, nogil=True)
+def _frequencies(sample_g: ndarray, kappa: int, omega: int, generated: ndarray) -> None:
+    """ Fit the simulated population into a sparse vector of frequencies, indexed by repeat length. This is a single
+    pass over our population. Individuals outside of [kappa, omega] are not counted. Optimized by Numba.
+
+    :param sample_g: Generated sample vector, which holds the sampled simulated population.
+    :param kappa: Lower bound of the repeat unit space.
+    :param omega: Upper bound of the repeat unit space.
+    :param generated: Zeroed frequency vector of size omega - kappa + 1 to populate.
+    :return: None.
+    """
+    for ell in sample_g:
+        if kappa <= ell <= omega:
+            generated[ell - kappa] += 1
+
+    for k in range(generated.size):
+        generated[k] /= float(sample_g.size)
+
+
+@jit(nopython=True, nogil=True, parallel=True)
 def cosine_delta(sample_g: ndarray, observation: ndarray, bounds: ndarray) -> float:
     """ Given individuals from the simulated population and the frequencies of individuals from an observed sample,
     determine the differences in distribution for each different simulated sample. All vectors passed MUST be of
@@ -23,21 +46,15 @@ def cosine_delta(sample_g: ndarray, observation: ndarray, bounds: ndarray) -> fl
     """
     kappa, omega = bounds  # Unpack our bounds.
 
-    # Prepare the storage vector for our generated frequency vector.
+    # Prepare and populate the storage vector for our generated frequency vector.
     generated = zeros(omega - kappa + 1)
-
-    # Fit the simulated population into a sparse vector of frequencies.
-    for repeat_unit in range(kappa, omega + 1):
-        ell_count = 0
-        for ell in sample_g:  # Ugly code, but I'm trying to fit this to Numba constraints. ):
-            ell_count += 1 if ell == repeat_unit else 0
-        generated[repeat_unit - kappa] = ell_count / float(sample_g.size)
+    _frequencies(sample_g, kappa, omega, generated)
 
     # Determine the angular distance. 0 = identical, 1 = maximally dissimilar.
     return 2.0 * arccos(dot(generated, observation) / (norm(generated) * norm(observation))) / pi
 
 
-@jit(nopython=True, nogil=True, target='cpu', parallel=True)
+@jit(nopython=True, nogil=True, parallel=True)
 def euclidean_delta(sample_g: ndarray, observation: ndarray, bounds: ndarray) -> float:
     """ Given individuals from the simulated population and the frequencies of individuals from an observed sample,
     determine the differences in distribution for each different simulated sample. All vectors passed MUST be of
@@ -51,55 +68,349 @@ def euclidean_delta(sample_g: ndarray, observation: ndarray, bounds: ndarray) ->
     """
     kappa, omega = bounds  # Unpack our bounds.
 
-    # Prepare the storage vector for our generated frequency vector.
+    # Prepare and populate the storage vector for our generated frequency vector.
     generated = zeros(omega - kappa + 1)
-
-    # Fit the simulated population into a sparse vector of frequencies.
-    for repeat_unit in range(kappa, omega + 1):
-        ell_count = 0
-        for ell in sample_g:
-            ell_count += 1 if ell == repeat_unit else 0
-        generated[repeat_unit - kappa] = ell_count / float(sample_g.size)
+    _frequencies(sample_g, kappa, omega, generated)
 
     # Determine the Euclidean distance. 0 = identical, 1 = maximally dissimilar.
     return norm(generated - observation)
 
 
-def populate_d(d: ndarray, observations: Sequence, sample: Callable, delta: Callable, theta_proposed, bounds: Sequence,
-               is_cache_observed_summary: bool = True) -> None:
-    """ Compute the expected distance for all observations to a model generated by our proposed parameter set.
+@jit(nopython=True, nogil=True, parallel=True)
+def _generated_matrix(sample_all: ndarray, bounds: ndarray) -> ndarray:
+    """ Fit each simulated population (row) into a sparse vector of frequencies. Each population is only visited once,
+    regardless of the number of observations we are to compare to. Optimized by Numba.
+
+    :param sample_all: Matrix of simulated populations, where each row is a population.
+    :param bounds: Lower and upper bound (in that order) of the repeat unit space.
+    :return: Matrix of frequencies (row = simulation, column = repeat length).
+    """
+    kappa, omega = bounds[0], bounds[1]  # Unpack our bounds.
+
+    generated = zeros((sample_all.shape[0], omega - kappa + 1))
+    for i in prange(sample_all.shape[0]):
+        _frequencies(sample_all[i], kappa, omega, generated[i])
+
+    return generated
+
+
+@jit(nopython=True, nogil=True, parallel=True)
+def cosine_delta_matrix(d: ndarray, sample_all: ndarray, observed_matrix: ndarray, bounds: ndarray) -> None:
+    """ Batched version of cosine_delta. Populate the entire D matrix (row = simulation, column = observation) with the
+    angular cosine distance between each simulated population and each observed sample. Optimized by Numba.
+
+    :param d: D matrix to populate, of size (number of simulations, number of observations).
+    :param sample_all: Matrix of simulated populations, where each row is a population.
+    :param observed_matrix: Sparse frequency matrix of our observations (row = observation, column = repeat length).
+    :param bounds: Lower and upper bound (in that order) of the repeat unit space.
+    :return: None.
+    """
+    generated = _generated_matrix(sample_all, bounds)
+
+    # Compute the norms of our observations once.
+    observed_norm = zeros(observed_matrix.shape[0])
+    for j in range(observed_matrix.shape[0]):
+        observed_norm[j] = sqrt(dot(observed_matrix[j], observed_matrix[j]))
+
+    # Determine the angular distance. 0 = identical, 1 = maximally dissimilar.
+    for i in prange(d.shape[0]):
+        generated_norm = sqrt(dot(generated[i], generated[i]))
+        for j in range(d.shape[1]):
+            similarity = dot(generated[i], observed_matrix[j]) / (generated_norm * observed_norm[j])
+            d[i, j] = 2.0 * arccos(min(similarity, 1.0)) / pi
+
+
+@jit(nopython=True, nogil=True, parallel=True)
+def euclidean_delta_matrix(d: ndarray, sample_all: ndarray, observed_matrix: ndarray, bounds: ndarray) -> None:
+    """ Batched version of euclidean_delta. Populate the entire D matrix (row = simulation, column = observation) with
+    the Euclidean distance between each simulated population and each observed sample. Optimized by Numba.
+
+    :param d: D matrix to populate, of size (number of simulations, number of observations).
+    :param sample_all: Matrix of simulated populations, where each row is a population.
+    :param observed_matrix: Sparse frequency matrix of our observations (row = observation, column = repeat length).
+    :param bounds: Lower and upper bound (in that order) of the repeat unit space.
+    :return: None.
+    """
+    generated = _generated_matrix(sample_all, bounds)
+
+    # Determine the Euclidean distance. 0 = identical, 1 = maximally dissimilar.
+    for i in prange(d.shape[0]):
+        for j in range(d.shape[1]):
+            difference = generated[i] - observed_matrix[j]
+            d[i, j] = sqrt(dot(difference, difference))
+
+
+# Batched versions of our distance functions, used by populate_d to compute D in a single call.
+_DELTA_MATRIX = {cosine_delta: cosine_delta_matrix, euclidean_delta: euclidean_delta_matrix}
+
+
+class DistanceCache(object):
+    """ Least recently used cache of the D matrix rows simulated for each parameter set. Proposals that revisit an
+    earlier point (or differ from one only by rounding, see 'digits') reuse the rows we have already simulated, and
+    only the rows we are missing are simulated. Each entry grows as more rows are requested of it. Once the cache holds
+    more than 'max_bytes', the least recently used entries are evicted.
+
+    Note that reusing rows freezes the simulation noise of each cached parameter set: a revisited proposal is given the
+    same D (and thus the same likelihood estimate) every time, instead of a fresh, independent estimate. Pseudo-marginal
+    MCMC is only exact if every visit draws new noise, so with a cache our chains target a fixed-noise approximation of
+    our posterior (biased toward parameter sets whose cached estimates happened to be favorable), and with 'digits' our
+    nearby proposals share the noise of one parameter set as well. Only use a cache when this bias is small relative to
+    the simulations saved (e.g. a large simulation_n). """
+
+    def __init__(self, max_bytes: int = 256 * 2 ** 20, digits: int = None):
+        """ Create an empty cache.
+
+        :param max_bytes: Maximum number of bytes of D rows to hold at once.
+        :param digits: If specified, real parameters are rounded to this many significant digits before lookup. Integer
+            parameters are always compared exactly.
+        """
+        from collections import OrderedDict
+
+        self.max_bytes, self.digits = max_bytes, digits
+        self.entries, self.bytes_n = OrderedDict(), 0
+        self.hit_n, self.miss_n, self.reused_n = 0, 0, 0
+
+    def _key(self, theta, delta: Callable) -> tuple:
+        """ Determine the key of a parameter set and distance function.
+
+        :param theta: Parameter set to describe.
+        :param delta: Distance function used to populate D.
+        :return: A hashable key.
+        """
+        from numbers import Integral
+
+        return (delta,) + tuple((a, b if self.digits is None or isinstance(b, Integral) else
+                                 float(f'{b:.{self.digits}g}')) for a, b in vars(theta).items())
+
+    def get(self, theta, delta: Callable):
+        """ Lookup the rows of D we have already simulated for some parameter set, and mark them as recently used.
+
+        :param theta: Parameter set to lookup.
+        :param delta: Distance function used to populate D.
+        :return: The cached rows of D (read-only), or None if we have none.
+        """
+        d = self.entries.get(self._key(theta, delta))
+        if d is None:
+            self.miss_n += 1
+            return None
+
+        self.entries.move_to_end(self._key(theta, delta))
+        self.hit_n += 1
+        return d
+
+    def put(self, theta, delta: Callable, d: ndarray) -> None:
+        """ Store the rows of D simulated for some parameter set, if we hold fewer rows for it. Evict the least recently
+        used entries until we fit in memory again. Entries larger than our cache are never stored.
+
+        :param theta: Parameter set these rows belong to.
+        :param delta: Distance function used to populate D.
+        :param d: Populated rows of D.
+        :return: None.
+        """
+        key = self._key(theta, delta)
+        if d.nbytes > self.max_bytes or (key in self.entries and self.entries[key].shape[0] >= d.shape[0]):
+            return
+
+        if key in self.entries:
+            self.bytes_n -= self.entries.pop(key).nbytes
+        self.entries[key], self.bytes_n = d.copy(), self.bytes_n + d.nbytes
+        self.entries[key].setflags(write=False)
+
+        while self.bytes_n > self.max_bytes:
+            self.bytes_n -= self.entries.popitem(last=False)[1].nbytes
+
+    def fill(self, d: ndarray, theta, delta: Callable) -> int:
+        """ Copy the rows of D we have already simulated for some parameter set into the first rows of d.
+
+        :param d: D matrix to populate.
+        :param theta: Parameter set to lookup.
+        :param delta: Distance function used to populate D.
+        :return: The number of rows of d that were populated.
+        """
+        cached = self.get(theta, delta)
+        filled_n = 0 if cached is None or cached.shape[1] != d.shape[1] else min(cached.shape[0], d.shape[0])
+
+        if filled_n > 0:
+            d[:filled_n] = cached[:filled_n]
+
+        self.reused_n += filled_n
+        return filled_n
+
+
+def _sample_to_shared(sample: Callable, theta, rows: range, seed, directory: str) -> tuple:
+    """ Pool worker for populate_d. Simulate the populations associated with the given rows, and write each directly
+    into a memory-mapped matrix (row = simulation) that our main process can read in place. Only the location and
+    shape of this matrix are sent back to our main process.
 
-    :param d: D matrix to populate. Columns must match the length of observations. Rows indicate simulations.
-    :param observations: 2D list of (int, float) tuples representing the (repeat length, frequency) tuples.
     :param sample: Function such that a population is produced with some parameter set.
+    :param theta: The parameters to simulate with.
+    :param rows: Indices of the simulations (rows of D) to produce.
+    :param seed: Master seed for our simulations. If specified, the i'th simulation uses the substream
+        split_seed(seed, i).
+    :param directory: Directory to create the memory-mapped matrix in. If None, the default temporary directory is used.
+    :return: The filename and shape of the memory-mapped matrix holding our populations. If we fail, no file is left.
+    """
+    from kumulaau.model import split_seed
+    from numpy import memmap, intc
+    from tempfile import mkstemp
+    from os import close, remove
+
+    shared, filename = None, None
+    try:
+        for k, i in enumerate(rows):
+            sample_g = sample(theta) if seed is None else sample(theta, split_seed(seed, i))
+
+            if shared is None:  # Our population size is only known after our first simulation.
+                descriptor, filename = mkstemp(suffix='.kumulaau', dir=directory)
+                close(descriptor)
+                shared = memmap(filename, dtype=intc, mode='w+', shape=(len(rows), len(sample_g)))
+
+            shared[k] = sample_g
+
+    except BaseException:  # Do not leave a partially written matrix behind in shared memory.
+        del shared
+        if filename is not None:
+            remove(filename)
+        raise
+
+    del shared  # Release our mapping. The file itself is removed by our main process.
+    return filename, (len(rows), len(sample_g))
+
+
+def _populate_d_rows(d: ndarray, sample_all: ndarray, observed_matrix: ndarray, delta: Callable,
+                     bounds: Sequence) -> None:
+    """ Compute the distance between each simulated population (row of sample_all) and each observation, storing the
+    results in the associated rows of D.
+
+    :param d: Rows of the D matrix to populate. Columns must match the rows of observed_matrix.
+    :param sample_all: Matrix of simulated populations, where each row is a population.
+    :param observed_matrix: Sparse frequency matrix of our observations (row = observation, column = repeat length).
     :param delta: Frequency distribution distance function. 0 = exact match, 1 = maximally dissimilar.
-    :param theta_proposed: The parameters associated with this matrix instance.
     :param bounds: Upper and lower bound (in that order) of the repeat unit space.
+    :return: None.
+    """
+    from numpy import array
+
+    # Use the batched version of our distance function if one exists.
+    if delta in _DELTA_MATRIX:
+        _DELTA_MATRIX[delta](d, sample_all, observed_matrix, array(bounds))
+    else:
+        for i in range(d.shape[0]):
+            for j in range(d.shape[1]):
+                d[i, j] = delta(sample_all[i], observed_matrix[j], array(bounds))
+
+
+def populate_d_all(d_all: Sequence, observations: Sequence, sample: Callable, delta: Callable, thetas: Sequence,
+                   bounds_all: Sequence, is_cache_observed_summary: bool = True, sample_batch: Callable = None,
+                   seeds: Sequence = None, cache: DistanceCache = None) -> None:
+    """ Compute the expected distance for all observations to the models generated by several parameter sets (e.g. the
+    proposals of several Markov chains), populating one D matrix per parameter set. If no sample_batch function is
+    given, the populations of every parameter set are simulated in one step by a process pool that writes directly to
+    shared memory, from which each D is computed in place. Otherwise, the populations of every parameter set are
+    simulated in one sample_batch call. If a cache is given, only the rows we have not simulated
+    before are simulated (if the first 'start' rows of the k'th parameter set are cached, its remaining rows use the
+    master seed split_seed(seeds[k], start)).
+
+    :param d_all: D matrices to populate, one per parameter set. Columns must match the length of observations.
+    :param observations: 2D list of (int, float) tuples representing the (repeat length, frequency) tuples.
+    :param sample: Function such that a population is produced with some parameter set.
+    :param delta: Frequency distribution distance function. 0 = exact match, 1 = maximally dissimilar.
+    :param thetas: The parameters associated with each matrix instance.
+    :param bounds_all: Upper and lower bound (in that order) of the repeat unit space, for each parameter set.
     :param is_cache_observed_summary: Indicates whether or not we should cache the summary statistics for observations.
+    :param sample_batch: Optional function that produces the populations of several parameter sets in one call, given
+        a sequence of parameter sets, the number of populations to simulate for each, and the master seed of each. One
+        matrix (row = population) must be returned per parameter set. If specified, this is used in place of sample.
+    :param seeds: Master seeds for the simulations of each parameter set. If specified, the i'th simulation of the k'th
+        parameter set uses the substream split_seed(seeds[k], i) and sample must accept this seed as its second
+        argument.
+    :param cache: Optional DistanceCache holding the rows of D we have already simulated for each parameter set.
     :return: None.
     """
     global _pool_singleton, _observed_matrix
 
     from kumulaau.observed import tuples_to_sparse_matrix
-    from multiprocessing import Pool
-    from numpy import array
+    from numpy import array_split, arange, memmap, asarray, intc
+    from multiprocessing import Pool, cpu_count
+    from kumulaau.model import split_seed
+    from tempfile import mkdtemp
+    from shutil import rmtree
+
+    seeds = [None for _ in thetas] if seeds is None else seeds
+
+    # Reuse the rows we have already simulated, and only simulate the rows we are missing. Remember these afterwards.
+    if cache is not None:
+        filled_all = [cache.fill(d, theta, delta) for d, theta in zip(d_all, thetas)]
+        missing = [k for k, (d, filled_n) in enumerate(zip(d_all, filled_all)) if filled_n < d.shape[0]]
+        if len(missing) > 0:
+            populate_d_all([d_all[k][filled_all[k]:] for k in missing], observations, sample, delta,
+                           [thetas[k] for k in missing], [bounds_all[k] for k in missing], is_cache_observed_summary,
+                           sample_batch, [seeds[k] if filled_all[k] == 0 else split_seed(seeds[k], filled_all[k])
+                                          for k in missing])
+        for k in missing:
+            cache.put(thetas[k], delta, d_all[k])
+        return
+
+    # Collect the observed summary statistics into a single vector. Pull / load from cache if desired.
+    if _observed_matrix is None and is_cache_observed_summary:
+        _observed_matrix = tuples_to_sparse_matrix(observations, bounds_all[0])
+    observed_all = [_observed_matrix if is_cache_observed_summary else tuples_to_sparse_matrix(observations, a)
+                    for a in bounds_all]
+
+    # Generate all of our populations and save the generated data we are to compare to (bottleneck is here!!).
+    if sample_batch is not None:  # The batches of every parameter set are simulated in one parallel step natively.
+        samples = sample_batch(thetas, [d.shape[0] for d in d_all], seeds)
+        for d, sample_all, bounds, observed_matrix in zip(d_all, samples, bounds_all, observed_all):
+            _populate_d_rows(d, sample_all, observed_matrix, delta, bounds)
+        return
 
     # We cannot compile this portion below, but we can parallelize it! Create a multiprocessing pool singleton.
     if _pool_singleton is None:
         _pool_singleton = Pool()
 
-    # Generate all of our populations and save the generated data we are to compare to (bottleneck is here!!).
-    sample_all = array(_pool_singleton.map(sample, [theta_proposed for _ in range(d.shape[0])]), dtype=int8)
+    # Each worker writes a contiguous block of simulations to shared memory. Nothing is pickled but the block location.
+    block_n = max(1, cpu_count() // len(thetas))
+    blocks = [(k, range(a[0], a[-1] + 1)) for k, d in enumerate(d_all)
+              for a in array_split(arange(d.shape[0]), block_n) if a.size > 0]
 
-    # Collect the observed summary statistics into a single vector. Pull / load from cache if desired.
-    if _observed_matrix is None and is_cache_observed_summary:
-        _observed_matrix = tuples_to_sparse_matrix(observations, bounds)
-    observed_matrix = _observed_matrix if is_cache_observed_summary else tuples_to_sparse_matrix(observations, bounds)
+    # All of our blocks live in a private directory, removed however we exit (i.e. if a worker or delta fails).
+    directory = mkdtemp(prefix='kumulaau-', dir=_SHARED_DIRECTORY)
+    try:
+        for (k, rows), (filename, shape) in zip(blocks, _pool_singleton.starmap(_sample_to_shared, [
+            (sample, thetas[k], rows, seeds[k], directory) for k, rows in blocks
+        ])):
+            # Compute the rows of our D matrix associated with this block, reading our populations in place.
+            sample_block = asarray(memmap(filename, dtype=intc, mode='r', shape=shape))
+            _populate_d_rows(d_all[k][rows.start:rows.stop], sample_block, observed_all[k], delta, bounds_all[k])
+            del sample_block
 
-    # Compute our D matrix.
-    for i in range(d.shape[0]):
-        for j in range(d.shape[1]):
-            d[i, j] = delta(sample_all[i], observed_matrix[j], array(bounds))
+    finally:
+        rmtree(directory, ignore_errors=True)
+
+
+def populate_d(d: ndarray, observations: Sequence, sample: Callable, delta: Callable, theta_proposed, bounds: Sequence,
+               is_cache_observed_summary: bool = True, sample_batch: Callable = None, seed=None,
+               cache: DistanceCache = None) -> None:
+    """ Compute the expected distance for all observations to a model generated by our proposed parameter set. If no
+    sample_batch function is given, our populations are simulated by a process pool that writes directly to shared
+    memory, from which D is computed in place.
+
+    :param d: D matrix to populate. Columns must match the length of observations. Rows indicate simulations.
+    :param observations: 2D list of (int, float) tuples representing the (repeat length, frequency) tuples.
+    :param sample: Function such that a population is produced with some parameter set.
+    :param delta: Frequency distribution distance function. 0 = exact match, 1 = maximally dissimilar.
+    :param theta_proposed: The parameters associated with this matrix instance.
+    :param bounds: Upper and lower bound (in that order) of the repeat unit space.
+    :param is_cache_observed_summary: Indicates whether or not we should cache the summary statistics for observations.
+    :param sample_batch: Optional function that produces the populations of several parameter sets in one call. See
+        populate_d_all. If specified, this is used in place of sample.
+    :param seed: Master seed for our simulations. If specified, the i'th simulation uses the substream
+        split_seed(seed, i) and sample must accept this seed as its second argument.
+    :param cache: Optional DistanceCache holding the rows of D we have already simulated for each parameter set.
+    :return: None.
+    """
+    populate_d_all([d], observations, sample, delta, [theta_proposed], [bounds], is_cache_observed_summary,
+                   sample_batch, [seed], cache)
 
 
 def get_arguments() -> Namespace:
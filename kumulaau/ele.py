@@ -1,62 +1,147 @@
 #!/usr/bin/env python3
-from kumulaau.distance import populate_d
-from typing import Callable, Sequence
+from typing import Callable, Sequence, Tuple
+from functools import lru_cache
 from numpy import ndarray
 
 
+@lru_cache(maxsize=16)
+def _regression_weights(r: float, bin_n: int) -> Tuple[ndarray, ndarray]:
+    """ Generate the domain of our regression and the weights of each point, using an exponential decay function. We
+    weigh distances closer to 0 more. These only depend on r and bin_n, so they are computed once and cached.
+
+    :param r: Exponential decay rate for weight vector used in regression (a=1).
+    :param bin_n: Number of bins used to construct histogram.
+    :return: The domain (normalized to [0, 1]) and the weight of each point, in that order. Both are read-only.
+    """
+    from numpy import linspace
+
+    domain = linspace(0, 1, bin_n)
+    w = (1 - r) ** domain
+
+    domain.setflags(write=False), w.setflags(write=False)
+    return domain, w
+
+
+def _column_histograms(d: ndarray, bin_n: int) -> ndarray:
+    """ Compute the histogram of every column of D at once, using 'bin_n' equal bins over [0, 1]. Bin assignment
+    follows numpy.histogram exactly (the last bin is closed, and points outside of [0, 1] are ignored).
+
+    :param d: **Populated** D matrix, holding all distances between a generated and observed population.
+    :param bin_n: Number of bins used to construct histogram.
+    :return: Matrix of counts, where each column is the histogram of the associated column of D.
+    """
+    from numpy import linspace, arange, bincount, broadcast_to, intp
+
+    edges = linspace(0, 1, bin_n + 1)
+    is_inside = (d >= 0) & (d <= 1)
+    distances = d[is_inside]
+
+    # Determine our bins, and correct for floating point error at our edges (as numpy.histogram does).
+    bins = (distances * bin_n).astype(intp)
+    bins[bins == bin_n] -= 1
+    bins[distances < edges[bins]] -= 1
+    bins[(distances >= edges[bins + 1]) & (bins != bin_n - 1)] += 1
+
+    # Count every (bin, column) pair in a single pass.
+    columns = broadcast_to(arange(d.shape[1]), d.shape)[is_inside]
+    return bincount(columns * bin_n + bins, minlength=d.shape[1] * bin_n).reshape(d.shape[1], bin_n).T
+
+
 def _generate_v(d: ndarray, r: float, bin_n: int) -> ndarray:
     """ Populate the V vector, a collection of likelihoods found using the populated D matrix and our weighted linear
-    regression likelihood approximator approach (dubbed ELE: Efficient Likelihood Extrapolator). WLSR approach found
-    here:
-
-    https://stackoverflow.com/questions/27128688/how-to-use-least-squares-with-weight-matrix-in-python
+    regression likelihood approximator approach (dubbed ELE: Efficient Likelihood Extrapolator). For each column, we
+    fit a line to the log CDF of its distances, and take the intercept. The intercepts of all columns are solved for
+    at once with the closed form of weighted least squares (weights are applied to residuals, as numpy.polyfit does).
 
     :param d: **Populated** D matrix, holding all distances between a generated and observed population.
     :param r: Exponential decay rate for weight vector used in regression (a=1).
     :param bin_n: Number of bins used to construct histogram.
-    :return: None.
+    :return: The V vector, holding the likelihood associated with each observation.
     """
-    from numpy import zeros, fromiter, linspace, histogram, cumsum, polyfit, log, zeros_like, inf, exp
+    from numpy import cumsum, log, exp, zeros, errstate
 
-    v = zeros(d.shape[1])  # Our resulting V vector.
+    domain, w = _regression_weights(r, bin_n)
 
-    # Generate our weights using an exponential decay function. We weigh distances closer to 0 more.
-    domain = fromiter(linspace(0, 1, bin_n), float, bin_n)  # Normalized to [0, 1].
-    w = fromiter(map(lambda a: (1 - r) ** a, domain), float, bin_n)
+    # Determine the CDF of each column. Columns without any (valid) distances have an all-zero CDF.
+    hist = _column_histograms(d, bin_n)
+    cdf = cumsum(hist, axis=0) / hist.sum(axis=0).clip(min=1)
 
-    # Iterate through our columns (w/ transpose of D).
-    for i, distances in enumerate(d.T):
-        hist, edges = histogram(distances, bins=bin_n, range=(0.0, 1.0), density=True)
-        cdf = cumsum(hist) * (edges[1] - edges[0])
-        log_cdf = log(cdf, out=zeros_like(cdf) + inf, where=(cdf != 0))  # Reduce this to the log scale.
+    # Reduce this to the log scale. Remove all invalid points (i.e. where the CDF is zero).
+    is_valid = cdf != 0
+    log_cdf = zeros(cdf.shape)
+    log_cdf[is_valid] = log(cdf[is_valid])
 
-        # Remove all invalid points (i.e. where cdf is inf at this step).
-        cdf_c, domain_c, w_c = list(zip(*[a for a in zip(log_cdf, domain, w) if a[0] != inf]))
+    # Gather the weighted sums for every column at once (w/ squared weights, equivalent to polyfit's w).
+    w_2, m = w ** 2, is_valid.astype('float64')
+    s, s_x, s_xx = w_2 @ m, (w_2 * domain) @ m, (w_2 * domain ** 2) @ m
+    s_y, s_xy = w_2 @ log_cdf, (w_2 * domain) @ log_cdf
 
-        if len(cdf_c) > 1:  # Perform our WLSR, get the intercept of this line, and bring out of log scale.
-            v[i] = exp(polyfit(domain_c, cdf_c, 1, w=w_c)[1])
-        else:  # Enforce that we have enough points to make a prediction.
-            v[i] = 0
+    # Perform our WLSR, get the intercept of each line, and bring out of log scale. Enforce that we have enough points.
+    v = zeros(d.shape[1])
+    is_fit = m.sum(axis=0) > 1
+    with errstate(divide='ignore', invalid='ignore'):
+        v[is_fit] = exp(((s_xx * s_y - s_x * s_xy) / (s * s_xx - s_x ** 2))[is_fit])
 
     return v
 
 
-def _likelihood_from_v(v: ndarray) -> float:
+def _log_likelihood_from_v(v: ndarray) -> float:
     """ Each entry in v corresponds to the probability a model (parameters) match this observed sample. Taking the
-    product gives us the likelihood (assumes each is independent).
+    product gives us the likelihood (assumes each is independent). We work with logarithms to avoid underflow, and skip
+    zero entries to avoid log(0) errors. If every entry is zero, our proposal has no support (-inf).
 
     :param v: **Populated** v vector, holding all probabilities associated with a given observation.
-    :return: The likelihood the generated sample set matches our observations.
+    :return: The log-likelihood the generated sample set matches our observations.
+    """
+    from numpy import log, inf
+
+    return log(v[v != 0]).sum() if (v != 0).any() else -inf
+
+
+def _log_likelihood_from_d(d: ndarray, r: float, bin_n: int) -> float:
+    """ Determine the log-likelihood of our proposal from a populated D matrix, by first generating our V vector.
+
+    :param d: **Populated** D matrix, holding all distances between a generated and observed population.
+    :param r: Exponential decay rate for weight vector used in regression (a=1).
+    :param bin_n: Number of bins used to construct histogram.
+    :return: The log-likelihood the generated sample set matches our observations.
     """
-    from numpy import log, exp
+    return _log_likelihood_from_v(_generate_v(d, r, bin_n))
 
-    # Avoid floating point error, use logarithms. Avoid log(0) errors.
-    col_sum = sum(map(lambda a: 0 if a == 0 else log(a), v))
-    return 0 if col_sum == 0 else exp(col_sum)
+
+def run_chains(walk: Callable, sample: Callable, delta: Callable, log_handlers: Sequence, theta_0s: Sequence,
+               observed: Sequence, simulation_n: int, boundaries: Sequence, r: float, bin_n: int,
+               sample_batch: Callable = None, seed=None, **kwargs) -> int:
+    """ Population-based version of our ELE-MCMC approach (see run). Several independent chains are advanced together,
+    and the proposals of all chains are simulated in one parallel step.
+
+    :param walk: Function that accepts some parameter set and returns another parameter set (or one per chain).
+    :param sample: Function that produces a collection of repeat lengths (i.e. the model function).
+    :param delta: Frequency distribution distance function. 0 = exact match, 1 = maximally dissimilar.
+    :param log_handlers: Functions that handle what occurs with each Markov chain and results (one per chain).
+    :param theta_0s: Initial starting point of each chain. Ignored if we resume from a checkpoint (see mcmc.run).
+    :param observed: 2D list of (int, float) tuples representing the (repeat length, frequency) tuples.
+    :param simulation_n: Number of simulations to use to obtain a distance.
+    :param boundaries: Starting and ending iteration for this specific MCMC run.
+    :param r: Exponential decay rate for weight vector used in regression (a=1).
+    :param bin_n: Number of bins used to construct histogram.
+    :param sample_batch: Optional function that produces the populations of several parameter sets in one call (used in
+        place of sample). See populate_d_all in distance.py.
+    :param seed: Master seed for this run. If specified, our walk, acceptance, and simulations are all reproducible.
+    :param kwargs: Additional options for our MCMC engine (buffer_n, checkpoint, checkpoint_n, cache). See mcmc.run.
+    :return: The number of simulations saved by early rejection (always 0 for ELE).
+    """
+    from kumulaau.mcmc import run as run_mcmc
+
+    return run_mcmc(walk=walk, sample=sample, delta=delta, log_handlers=log_handlers, theta_0s=theta_0s,
+                    observed=observed, simulation_n=simulation_n, boundaries=boundaries,
+                    log_likelihood=lambda d: _log_likelihood_from_d(d, r, bin_n), sample_batch=sample_batch, seed=seed,
+                    **kwargs)
 
 
 def run(walk: Callable, sample: Callable, delta: Callable, log_handler: Callable, theta_0,
-        observed: Sequence, simulation_n: int, boundaries: Sequence, r: float, bin_n: int) -> None:
+        observed: Sequence, simulation_n: int, boundaries: Sequence, r: float, bin_n: int,
+        sample_batch: Callable = None, seed=None, **kwargs) -> int:
     """ Our approach: a weighted regression-based likelihood approximator using MCMC to walk around our posterior
     distribution. My interpretation of this approach is given below:
 
@@ -80,43 +165,12 @@ def run(walk: Callable, sample: Callable, delta: Callable, log_handler: Callable
     :param boundaries: Starting and ending iteration for this specific MCMC run.
     :param r: Exponential decay rate for weight vector used in regression (a=1).
     :param bin_n: Number of bins used to construct histogram.
-    :return: None.
+    :param sample_batch: Optional function that produces the populations of several parameter sets in one call (used in
+        place of sample). See populate_d_all in distance.py.
+    :param seed: Master seed for this run. If specified, our walk, acceptance, and simulations are all reproducible.
+    :param kwargs: Additional options for our MCMC engine (buffer_n, checkpoint, checkpoint_n, cache). See mcmc.run.
+    :return: The number of simulations saved by early rejection (always 0 for ELE).
     """
-    from numpy import zeros, mean, nextafter, RankWarning
-    from types import SimpleNamespace
-    from warnings import simplefilter
-    from numpy.random import uniform
-    from datetime import datetime
-
-    # We need to filter out all of the rank warnings.
-    simplefilter('ignore', RankWarning)
-
-    # Save our results according to the namespace below.
-    a_record = lambda a_1, b_1, c_1, d_1, e_1, f_1: SimpleNamespace(theta=a_1, time_r=b_1, waiting_time=c_1,
-                                                                    p_proposed=d_1, expected_delta=e_1,
-                                                                    proposed_time=f_1)
-
-    # Seed our Markov chain with our initial guess.
-    x = [a_record(theta_0, 0, 1, 0, 0, 0)]
-
-    for i in range(boundaries[0] + 1, boundaries[1]):
-        theta_proposed = walk(x[-1].theta)  # Walk from our previous state.
-
-        # Generate our D matrix.
-        d = zeros((simulation_n, len(observed)), dtype='float64')
-        populate_d(d, observed, sample, delta, theta_proposed, [theta_proposed.kappa, theta_proposed.omega])
-
-        # Compute our likelihood vector.
-        v = _generate_v(d, r, bin_n)
-
-        # Accept our proposal according to our alpha value.
-        p_proposed, p_k = _likelihood_from_v(v), x[-1].p_proposed
-        if abs(0 - p_k) < nextafter(0, 1) or p_proposed / p_k > uniform(0, 1):
-            x = x + [a_record(theta_proposed, datetime.now(), 1, p_proposed, mean(d), i)]
-
-        # Reject our proposal. We keep our current state and increment our waiting times.
-        else:
-            x[-1].waiting_time += 1
-
-        # We record to our chain. This is dependent on the current iteration of MCMC.
-        log_handler(x, i)
+    return run_chains(walk=walk, sample=sample, delta=delta, log_handlers=[log_handler], theta_0s=[theta_0],
+                      observed=observed, simulation_n=simulation_n, boundaries=boundaries, r=r, bin_n=bin_n,
+                      sample_batch=sample_batch, seed=seed, **kwargs)
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+from kumulaau.distance import populate_d_all, DistanceCache
+from kumulaau.parameter import AdaptiveWalk
+from typing import Callable, Sequence
+
+
+class ChainBuffer(object):
+    """ Ring of records holding the states of a Markov chain that have not been flushed yet. All records are allocated
+    up front and are reused as our chain grows, so a chain whose log handler flushes (and removes) its records more
+    often than every 'capacity - 1' iterations runs for an arbitrary number of iterations in constant memory. Records
+    are never overwritten before they are removed: once full, our buffer doubles in capacity. """
+
+    def __init__(self, capacity: int):
+        """ Allocate every record our buffer will ever hold.
+
+        :param capacity: Maximum number of records to hold at once. Must be at least 1.
+        """
+        from types import SimpleNamespace
+        if capacity < 1:
+            raise ValueError('Chain buffer must hold at least one record.')
+
+        self.records = [SimpleNamespace(theta=None, time_r=0, waiting_time=0, log_p_proposed=0, expected_delta=0,
+                                        proposed_time=0) for _ in range(capacity)]
+        self.start, self.size = 0, 0
+
+    def append(self, theta, time_r, waiting_time: int, log_p_proposed: float, expected_delta: float,
+               proposed_time: int) -> None:
+        """ Record a new state to the end of our chain, reusing the slot of a removed record. If every slot holds a
+        record we have not removed, we double our capacity first.
+
+        :return: None.
+        """
+        from types import SimpleNamespace
+
+        if self.size == len(self.records):  # Unroll our ring, and allocate as many records as we hold.
+            self.records = self.records[self.start:] + self.records[:self.start] + \
+                [SimpleNamespace(theta=None, time_r=0, waiting_time=0, log_p_proposed=0, expected_delta=0,
+                                 proposed_time=0) for _ in range(len(self.records))]
+            self.start = 0
+
+        a = self.records[(self.start + self.size) % len(self.records)]
+        a.theta, a.time_r, a.waiting_time = theta, time_r, waiting_time
+        a.log_p_proposed, a.expected_delta, a.proposed_time = log_p_proposed, expected_delta, proposed_time
+        self.size += 1
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self[j] for j in range(*k.indices(self.size))]
+        if not -self.size <= k < self.size:
+            raise IndexError('Chain buffer index out of range.')
+
+        return self.records[(self.start + k % self.size) % len(self.records)]
+
+    def __delitem__(self, k: slice):
+        """ Remove the oldest records of our chain (e.g. "del x[:-1]"). Only prefixes can be removed.
+
+        :param k: Slice describing the oldest records to remove.
+        :return: None.
+        """
+        removed = range(*k.indices(self.size))
+        if len(removed) > 0 and (removed.start != 0 or removed.step != 1):
+            raise ValueError('Only the oldest records of a chain buffer can be removed.')
+
+        self.start, self.size = (self.start + len(removed)) % len(self.records), self.size - len(removed)
+
+
+def _walk_state(walk: AdaptiveWalk) -> dict:
+    """ Determine what an adaptive walk has learned from its chain. Our parameter class and transform are given anew
+    each run (and a transform need not be picklable), so these are not saved.
+
+    :param walk: Adaptive walk to save.
+    :return: Dictionary of the learned state of our walk.
+    """
+    return {k: v for k, v in vars(walk).items() if k not in ('cls', 'transform')}
+
+
+def _save_checkpoint(checkpoint: str, i: int, boundaries: Sequence, x_all: Sequence, walk_all: Sequence) -> None:
+    """ Save the current state of each chain (and of its walk, if adaptive), the iteration we are on (and the boundaries
+    of our run), and the state of the NumPy RNG. We write to a temporary file first and rename it, so a run interrupted
+    mid-write never leaves a corrupt checkpoint behind.
+
+    :param checkpoint: Location of the checkpoint file.
+    :param i: Iteration we have completed.
+    :param boundaries: Starting and ending iteration of our run.
+    :param x_all: Chain buffers of each chain.
+    :param walk_all: Walk function of each chain.
+    :return: None.
+    """
+    from numpy.random import get_state
+    from os import replace
+    from pickle import dump
+
+    with open(checkpoint + '.tmp', 'wb') as f:
+        dump({'i': i, 'boundaries': list(boundaries), 'chains': [vars(x[-1]).copy() for x in x_all],
+              'random': get_state(), 'walks': [_walk_state(a) if isinstance(a, AdaptiveWalk) else None
+                                               for a in walk_all]}, f)
+    replace(checkpoint + '.tmp', checkpoint)
+
+
+def _populate_d_early(d_all: Sequence, observed: Sequence, sample: Callable, delta: Callable, thetas: Sequence,
+                      sample_batch: Callable, seeds: Sequence, thresholds: Sequence, log_likelihood_bound: Callable,
+                      chunk_n: int, cache: DistanceCache = None) -> tuple:
+    """ Populate the D matrix of each chain 'chunk_n' rows at a time. After each chunk, a chain whose best achievable
+    log-likelihood can no longer exceed its acceptance threshold is rejected, and its remaining rows are not simulated.
+    If a cache is given, rows we have already simulated for a proposal are reused, and the rows we do simulate are
+    remembered (even for proposals rejected early).
+
+    :param d_all: D matrices to populate, one per chain.
+    :param observed: 2D list of (int, float) tuples representing the (repeat length, frequency) tuples.
+    :param sample: Function that produces a collection of repeat lengths (i.e. the model function).
+    :param delta: Frequency distribution distance function. 0 = exact match, 1 = maximally dissimilar.
+    :param thetas: Proposal of each chain.
+    :param sample_batch: Optional function that produces the populations of several parameter sets in one call (used in
+        place of sample). See populate_d_all in distance.py.
+    :param seeds: Master seed of each chain's simulations. Each chunk is given its own substream of this seed.
+    :param thresholds: Log-likelihood each chain's proposal must exceed to be accepted.
+    :param log_likelihood_bound: Function that accepts the populated rows of a D matrix and the total number of rows,
+        and returns an upper bound on the log-likelihood of the proposal.
+    :param chunk_n: Number of rows to simulate at a time.
+    :param cache: Optional DistanceCache holding the rows of D we have already simulated for each parameter set.
+    :return: A list of flags indicating which chains were rejected early, and the number of simulations saved.
+    """
+    from kumulaau.model import split_seed
+    from numpy import isneginf
+
+    is_rejected_all, saved_n, simulation_n = [False for _ in d_all], 0, d_all[0].shape[0]
+    filled_all = [0 if cache is None else cache.fill(d, theta, delta) for d, theta in zip(d_all, thetas)]
+    populated_all = list(filled_all)
+    for start in range(0, simulation_n, chunk_n):
+        active = [k for k, is_rejected in enumerate(is_rejected_all) if not is_rejected]
+        if len(active) == 0:
+            break
+
+        # Populate the next chunk of rows for every chain still in the running (skipping the rows that are cached).
+        end = min(start + chunk_n, simulation_n)
+        missing = [k for k in active if filled_all[k] < end]
+        if len(missing) > 0:
+            populate_d_all([d_all[k][max(start, filled_all[k]):end] for k in missing], observed, sample, delta,
+                           [thetas[k] for k in missing], [[thetas[k].kappa, thetas[k].omega] for k in missing],
+                           sample_batch=sample_batch, seeds=[split_seed(seeds[k], max(start, filled_all[k]))
+                                                             for k in missing])
+
+        for k in active:  # A threshold of -inf is always exceeded (our previous state has no support).
+            populated_all[k] = max(populated_all[k], end)
+            if not isneginf(thresholds[k]) and log_likelihood_bound(d_all[k][:end], simulation_n) <= thresholds[k]:
+                is_rejected_all[k] = True  # Rows beyond our chunk that are cached were never to be simulated.
+                saved_n += simulation_n - max(end, filled_all[k])
+
+    if cache is not None:  # Remember every row we have simulated.
+        for d, theta, populated_n in zip(d_all, thetas, populated_all):
+            cache.put(theta, delta, d[:populated_n])
+
+    return is_rejected_all, saved_n
+
+
+def run(walk: Callable, sample: Callable, delta: Callable, log_handlers: Sequence, theta_0s: Sequence,
+        observed: Sequence, simulation_n: int, boundaries: Sequence, log_likelihood: Callable,
+        sample_batch: Callable = None, seed=None, log_likelihood_bound: Callable = None, chunk_n: int = None,
+        buffer_n: int = 1024, checkpoint: str = None, checkpoint_n: int = 1000, cache: DistanceCache = None) -> int:
+    """ A population-based MCMC engine, advancing several independent Markov chains together. Each chain performs
+    Metropolis sampling, where the likelihood of a proposal is approximated from some D matrix (e.g. using ABC or ELE).
+    The proposals of all chains are simulated together in one parallel step:
+
+    1) We start with some initial guess theta_0 for each chain. Right off the bat, we move to another theta.
+    2) For 'boundaries[1] - boundaries[0]' iterations...
+        a) Each chain proposes a new theta from its current state.
+        b) For all proposals at once, we simulate 'simulation_n' populations and populate one D matrix per chain.
+        c) For each chain, we approximate the likelihood of its proposal from its D matrix.
+        d) If this probability is greater than the probability of the previous, we accept.
+        e) Otherwise, we accept our proposed with probability p(proposed) / p(prev).
+
+    Likelihoods are carried in log space from end to end (i.e. we accept if log(u) < log p(proposed) - log p(prev)), so
+    likelihoods over many observations never underflow. A log-likelihood of -inf marks a proposal with no support.
+
+    If 'chunk_n' is given, we run in early rejection mode: the uniform of each chain is drawn before simulating, and
+    simulations are performed 'chunk_n' at a time. Once the bound on a proposal's log-likelihood can no longer exceed
+    log(u) + log p(prev), the proposal is rejected and its remaining simulations are skipped.
+
+    Each chain is held in a ChainBuffer, so memory stays constant for long runs (given our log handlers flush their
+    chains). If a checkpoint file is given, the state of every chain is saved to it every 'checkpoint_n' iterations. If
+    this file already exists when we start, we resume from it instead: our chains, the iteration we are on, and the
+    boundaries of our run are all taken from our checkpoint (theta_0s and boundaries are then ignored).
+
+    Instead of a single walk function, one walk can be given per chain. Walks that are AdaptiveWalk instances are told
+    the outcome of every iteration of their chain, and learn their proposal from it (adaptive Metropolis).
+
+    :param walk: Function that accepts some parameter set and returns another parameter set, or one such function per
+        chain (e.g. AdaptiveWalk instances).
+    :param sample: Function that produces a collection of repeat lengths (i.e. the model function).
+    :param delta: Frequency distribution distance function. 0 = exact match, 1 = maximally dissimilar.
+    :param log_handlers: Functions that handle what occurs with each Markov chain and results (one per chain).
+    :param theta_0s: Initial starting point of each chain. Ignored (and may hold None) if we resume from a checkpoint.
+    :param observed: 2D list of (int, float) tuples representing the (repeat length, frequency) tuples.
+    :param simulation_n: Number of simulations to use to obtain a distance.
+    :param boundaries: Starting and ending iteration for this specific MCMC run.
+    :param log_likelihood: Function that accepts a **populated** D matrix and returns the log-likelihood of the
+        proposal.
+    :param sample_batch: Optional function that produces the populations of several parameter sets in one call (used in
+        place of sample). See populate_d_all in distance.py.
+    :param seed: Master seed for this run. If specified, our walk, acceptance, and simulations are all reproducible.
+    :param log_likelihood_bound: Function that accepts the first rows of a D matrix and the total number of rows, and
+        returns an upper bound on the log-likelihood of the proposal. Required for early rejection.
+    :param chunk_n: If specified, the number of simulations to perform at a time in early rejection mode.
+    :param buffer_n: Number of records each chain buffer starts with. Should exceed the flush interval of our log
+        handlers, otherwise our buffers grow.
+    :param checkpoint: Optional location of a checkpoint file to periodically save to (and resume from).
+    :param checkpoint_n: Number of iterations to run before saving a checkpoint.
+    :param cache: Optional DistanceCache. If given, proposals we have visited before reuse the rows of D simulated for
+        them, and only the rows we are missing are simulated.
+    :return: The number of simulations saved by early rejection.
+    """
+    from numpy import zeros, mean, log, inf, isneginf
+    from kumulaau.model import split_seed
+    from numpy.random import uniform, seed as seed_numpy, set_state
+    from datetime import datetime
+    from os.path import isfile
+    from pickle import load
+
+    if chunk_n is not None and log_likelihood_bound is None:
+        raise ValueError('Early rejection requires a bound on our log-likelihood.')
+
+    # Seed each Markov chain with its initial guess. Every chain is given its own walk function.
+    walk_all = list(walk) if isinstance(walk, Sequence) else [walk for _ in theta_0s]
+    if len(walk_all) != len(theta_0s):
+        raise ValueError(f'{len(walk_all)} walk functions were given for {len(theta_0s)} chains.')
+    x_all = [ChainBuffer(buffer_n) for _ in theta_0s]
+    for x, theta_0 in zip(x_all, theta_0s):
+        x.append(theta_0, 0, 1, -inf, 0, 0)
+
+    # Our walk and acceptance use the NumPy RNG. Seed this using the iteration we start from (allows for resuming).
+    if seed is not None:
+        seed_numpy(split_seed(split_seed(seed, 0), boundaries[0]) % 2 ** 32)
+    i_start, saved_n = boundaries[0], 0
+
+    # If we have a checkpoint, pick up exactly where we left off: the state of each chain and of our RNG are restored.
+    if checkpoint is not None and isfile(checkpoint):
+        with open(checkpoint, 'rb') as f:
+            state = load(f)
+        if len(state['chains']) != len(x_all):
+            raise ValueError(f'Checkpoint holds {len(state["chains"])} chains, but {len(x_all)} were given.')
+
+        for x, a in zip(x_all, state['chains']):
+            del x[:]
+            x.append(**a)
+        for w, a in zip(walk_all, state.get('walks', [None for _ in walk_all])):
+            if isinstance(w, AdaptiveWalk) and a is not None:
+                vars(w).update(a)
+        set_state(state['random'])
+        i_start, boundaries = state['i'], state.get('boundaries', boundaries)
+
+    for i in range(i_start + 1, boundaries[1]):
+        theta_proposed_all = [w(x[-1].theta) for w, x in zip(walk_all, x_all)]  # Walk each chain from its state.
+
+        # Generate the D matrix of every chain in a single step. Each chain is given its own substream.
+        d_all = [zeros((simulation_n, len(observed)), dtype='float64') for _ in x_all]
+        seeds = [split_seed(split_seed(split_seed(seed, 1), i), k) for k in range(len(x_all))]
+        if chunk_n is None:
+            populate_d_all(d_all, observed, sample, delta, theta_proposed_all,
+                           [[a.kappa, a.omega] for a in theta_proposed_all], sample_batch=sample_batch, seeds=seeds,
+                           cache=cache)
+            log_u_all, is_rejected_all = [None for _ in x_all], [False for _ in x_all]
+
+        else:  # Draw our uniforms first, and stop simulating for a chain once its proposal cannot be accepted.
+            log_u_all = [-inf if isneginf(x[-1].log_p_proposed) else log(uniform(0, 1)) for x in x_all]
+            is_rejected_all, chunk_saved_n = _populate_d_early(
+                d_all, observed, sample, delta, theta_proposed_all, sample_batch, seeds,
+                [log_u + x[-1].log_p_proposed for log_u, x in zip(log_u_all, x_all)], log_likelihood_bound, chunk_n,
+                cache)
+            saved_n += chunk_saved_n
+
+        for x, theta_proposed, d, log_u, is_rejected, log_handler, w in \
+                zip(x_all, theta_proposed_all, d_all, log_u_all, is_rejected_all, log_handlers, walk_all):
+
+            # Accept our proposal according to our alpha value. Metropolis sampling, in log space.
+            log_p_proposed, log_p_k = -inf if is_rejected else log_likelihood(d), x[-1].log_p_proposed
+            is_accepted = not is_rejected and (isneginf(log_p_k) or
+                                               (log(uniform(0, 1)) if log_u is None else log_u) <
+                                               log_p_proposed - log_p_k)
+            if is_accepted:
+                x.append(theta_proposed, datetime.now(), 1, log_p_proposed, mean(d), i)
+
+            # Reject our proposal. We keep our current state and increment our waiting times.
+            else:
+                x[-1].waiting_time += 1
+
+            # Our adaptive walks learn from the current state of their chain. Proposals are always accepted while our
+            # chain has no support, so we only start learning once it does.
+            if isinstance(w, AdaptiveWalk) and not isneginf(log_p_k):
+                w.update(x[-1].theta, is_accepted)
+
+            # We record to our chain. This is dependent on the current iteration of MCMC.
+            log_handler(x, i)
+
+        # Save the state of every chain, after our log handlers have seen this iteration.
+        if checkpoint is not None and i % checkpoint_n == 0:
+            _save_checkpoint(checkpoint, i, boundaries, x_all, walk_all)
+
+    return saved_n
@@ -1,13 +1,40 @@
 #!/usr/bin/env python3
-from numpy import ndarray, asarray
+from numpy import ndarray, asarray, empty, intc
 from argparse import Namespace
-from collections import Sequence
+from collections.abc import Sequence
 import pop
 
+# Mutation kernels available to evolve. The draw kernel (Poisson approximation) costs the same regardless of the time
+# between coalescent events, the generation kernel is exact but its cost grows with this time, and the table kernel is
+# exact with a cost that grows with log(time) and (omega - kappa + 1)^3.
+MUTATION_KERNELS = {'draw': pop.MUTATE_DRAW, 'generation': pop.MUTATE_GENERATION, 'table': pop.MUTATE_TABLE}
 
-def trace(n, f, c, d, kappa, omega):
+
+def split_seed(seed, stream):
+    """ Derive the seed of some substream from a master seed, using the SplitMix64 finalizer. This matches the
+    derivation in the pop module, such that the k'th population of a simulate_batch call given some seed is identical
+    to a trace and evolve call given split_seed(seed, k). If no master seed is given, we return None.
+
+    :param seed: Master seed (an integer) or None.
+    :param stream: Non-negative integer identifying the substream.
+    :return: A 64-bit seed for the given substream, or None if seed is None.
+    """
+    if seed is None:
+        return None
+
+    def _splitmix64(z):
+        z = (z + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+        return z ^ (z >> 31)
+
+    return _splitmix64((int(seed) & 0xFFFFFFFFFFFFFFFF) ^ _splitmix64(int(stream) & 0xFFFFFFFFFFFFFFFF))
+
+
+def trace(n, f, c, d, kappa, omega, seed=None):
     """ A wrapper for the pop module trace method. This returns a C pointer that holds the topology and population
-    parameters from the trace method.
+    parameters from the trace method. The topology requires memory linear in n. The same RNG (and thus the given seed)
+    is used for the evolve step.
 
     :param n: Population size, used for determining the number of generations between events.
     :param f: Scaling factor for the total mutation rate. Smaller = shorter time to coalescence.
@@ -15,20 +42,119 @@ def trace(n, f, c, d, kappa, omega):
     :param d: Linear bias for the downward mutation rate.
     :param kappa: Lower bound of repeat lengths.
     :param omega: Upper bound of repeat lengths.
+    :param seed: Seed for the RNG of this population. If None, a seed unique to this call is generated.
     :return: Pointer to a pop module C structure (tree).
     """
-    return pop.trace(n, f, c, d, kappa, omega)
+    return pop.trace(n, f, c, d, kappa, omega, seed)
 
 
-def evolve(p, i_0) -> ndarray:
+def evolve(p, i_0, kernel: str = 'draw', out: ndarray = None) -> ndarray:
     """ A wrapper for the pop module evolve method. Given the C pointer from a trace call and initial lengths,
-    we resolve our repeat lengths and return our result as a numpy array.
+    we resolve our repeat lengths and return our result as a numpy array. Integer arrays (including slices of previous
+    evolve results) are read directly by the pop module, so populations can be chained without creating a Python
+    object per individual.
+
+    :param p: Pointer to a pop module C structure (tree). This is freed once evolved, and cannot be evolved again.
+    :param i_0: Starting length, or array of starting lengths.
+    :param kernel: Mutation kernel to evolve with. Must be a key of MUTATION_KERNELS.
+    :param out: Optional C-contiguous intc array of (at least) 2n elements to store our results in.
+    :return: Array of repeat lengths (out, if given).
+    """
+    return asarray(pop.evolve(p, i_0, MUTATION_KERNELS[kernel], out))
+
 
-    :param p: Pointer to a pop module C structure (tree)
+def simulate_batch(n, f, c, d, kappa, omega, i_0, simulation_n: int, out: ndarray = None,
+                   thread_n: int = 0, seed=None, kernel: str = 'draw') -> ndarray:
+    """ A wrapper for the pop module simulate_batch method. We trace and evolve simulation_n populations in a single
+    call, storing each population as a row of our resulting matrix. No intermediate Python objects are created, and
+    the GIL is released while our populations are split across thread_n native threads.
+
+    :param n: Population size, used for determining the number of generations between events.
+    :param f: Scaling factor for the total mutation rate. Smaller = shorter time to coalescence.
+    :param c: Constant bias for the upward mutation rate.
+    :param d: Linear bias for the downward mutation rate.
+    :param kappa: Lower bound of repeat lengths.
+    :param omega: Upper bound of repeat lengths.
     :param i_0: Array of starting lengths.
-    :return: Array of repeat lengths.
+    :param simulation_n: Number of populations to simulate.
+    :param out: Optional C-contiguous intc matrix of shape (simulation_n, 2n) to store our results in.
+    :param thread_n: Number of threads to simulate with. If not positive, we use all available processors.
+    :param seed: Master seed. The k'th population uses the substream split_seed(seed, k). If None, one is generated.
+    :param kernel: Mutation kernel to evolve with. Must be a key of MUTATION_KERNELS.
+    :return: Matrix of repeat lengths, where each row is a simulated population.
+    """
+    if out is None:  # Allocate our result matrix if one is not given.
+        out = empty((simulation_n, 2 * n), dtype=intc)
+
+    pop.simulate_batch(n, f, c, d, kappa, omega, i_0, simulation_n, out, thread_n, seed, MUTATION_KERNELS[kernel])
+    return out
+
+
+def simulate_graph(populations: Sequence, sources: Sequence, i_0, simulation_n: int, out: ndarray = None,
+                   thread_n: int = 0, seed=None, kernel: str = 'draw') -> ndarray:
+    """ A wrapper for the pop module simulate_graph method. We simulate a demographic model of several populations
+    (described as a graph) simulation_n times in a single call, storing the last population of each simulation as a row
+    of our resulting matrix. Every stage of every simulation reuses the same native buffers, and no intermediate Python
+    objects are created between stages.
+
+    Sources that share a parent draw disjoint individuals from it (in the order given). For example, an ancestral
+    population 0 that splits into populations 1 (a fraction alpha of 0) and 2 (the rest of 0), which are then admixed
+    into population 3, is described by the sources [(1, 0, alpha, sigma), (2, 0, 1, 0), (3, 1, 1, 0), (3, 2, 1, 0)].
+
+    :param populations: Sequence of (n, f, c, d, kappa, omega) tuples, one per population. Every population must follow
+        the populations it descends from. The first population descends from i_0, and the last population is sampled.
+    :param sources: Sequence of (child, parent, alpha, sigma) tuples. Each seeds the population child with
+        |N(alpha, sigma)| (clipped to 1) of the individuals of population parent. Every population after the first
+        must have a source.
+    :param i_0: Starting length, or array of starting lengths, of the first population.
+    :param simulation_n: Number of times to simulate our model.
+    :param out: Optional C-contiguous intc matrix of shape (simulation_n, 2n) to store our results in, where n is the
+        size of our last population.
+    :param thread_n: Number of threads to simulate with. If not positive, we use all available processors.
+    :param seed: Master seed. The k'th simulation uses the substream split_seed(seed, k). If None, one is generated.
+    :param kernel: Mutation kernel to evolve with. Must be a key of MUTATION_KERNELS.
+    :return: Matrix of repeat lengths, where each row is the last population of a simulation.
+    """
+    if out is None:  # Allocate our result matrix if one is not given.
+        out = empty((simulation_n, 2 * int(populations[-1][0])), dtype=intc)
+
+    pop.simulate_graph(populations, sources, i_0, simulation_n, out, thread_n, seed, MUTATION_KERNELS[kernel])
+    return out
+
+
+def simulate_batches(jobs: Sequence, thread_n: int = 0, kernel: str = 'draw') -> list:
+    """ A wrapper for the pop module simulate_batches method. We simulate the populations of several parameter sets
+    (e.g. the proposals of several Markov chains) in a single call, where our threads are split across the populations
+    of every parameter set. The result of each parameter set is identical to a simulate_batch call given the same
+    arguments.
+
+    :param jobs: Sequence of (n, f, c, d, kappa, omega, i_0, simulation_n, seed) tuples, one per parameter set. See
+        simulate_batch for each of these.
+    :param thread_n: Number of threads to simulate with. If not positive, we use all available processors.
+    :param kernel: Mutation kernel to evolve with. Must be a key of MUTATION_KERNELS.
+    :return: One matrix of repeat lengths per parameter set, where each row is a simulated population.
     """
-    return asarray(pop.evolve(p, [i for i in i_0]) if isinstance(i_0, Sequence) else pop.evolve(p, [i_0]))
+    outs = [empty((a[7], 2 * a[0]), dtype=intc) for a in jobs]
+
+    pop.simulate_batches([tuple(a[:8]) + (b, a[8]) for a, b in zip(jobs, outs)], thread_n, MUTATION_KERNELS[kernel])
+    return outs
+
+
+def simulate_graphs(jobs: Sequence, thread_n: int = 0, kernel: str = 'draw') -> list:
+    """ A wrapper for the pop module simulate_graphs method. We simulate several demographic graphs (e.g. the proposals
+    of several Markov chains) in a single call, where our threads are split across the simulations of every graph. The
+    result of each graph is identical to a simulate_graph call given the same arguments.
+
+    :param jobs: Sequence of (populations, sources, i_0, simulation_n, seed) tuples, one per graph. See simulate_graph
+        for each of these.
+    :param thread_n: Number of threads to simulate with. If not positive, we use all available processors.
+    :param kernel: Mutation kernel to evolve with. Must be a key of MUTATION_KERNELS.
+    :return: One matrix of repeat lengths per graph, where each row is the last population of a simulation.
+    """
+    outs = [empty((a[3], 2 * int(a[0][-1][0])), dtype=intc) for a in jobs]
+
+    pop.simulate_graphs([tuple(a[:4]) + (b, a[4]) for a, b in zip(jobs, outs)], thread_n, MUTATION_KERNELS[kernel])
+    return outs
 
 
 def get_arguments() -> Namespace:
@@ -39,15 +165,16 @@ def get_arguments() -> Namespace:
     from argparse import ArgumentParser
 
     parser = ArgumentParser(description='Simulate the evolution of single population.')
-    list(map(lambda a: parser.add_argument(a[0], help=a[1], type=a[2], nargs=a[3]), [
-        ['-image', 'Image file to save resulting repeat length distribution (histogram) to.', str, None],
-        ['-i_0', 'Repeat lengths of starting ancestors.', int, '+'],
-        ['-n', 'Starting population size.', int, None],
-        ['-f', 'Scaling factor for total mutation rate.', float, None],
-        ['-c', 'Constant bias for the upward mutation rate.', float, None],
-        ['-d', 'Linear bias for the downward mutation rate.', float, None],
-        ['-kappa', 'Lower bound of repeat lengths.', int, None],
-        ['-omega', 'Upper bound of repeat lengths.', int, None]
+    list(map(lambda a: parser.add_argument(a[0], help=a[1], type=a[2], nargs=a[3], default=a[4], choices=a[5]), [
+        ['-image', 'Image file to save resulting repeat length distribution (histogram) to.', str, None, None, None],
+        ['-i_0', 'Repeat lengths of starting ancestors.', int, '+', None, None],
+        ['-n', 'Starting population size.', int, None, None, None],
+        ['-f', 'Scaling factor for total mutation rate.', float, None, None, None],
+        ['-c', 'Constant bias for the upward mutation rate.', float, None, None, None],
+        ['-d', 'Linear bias for the downward mutation rate.', float, None, None, None],
+        ['-kappa', 'Lower bound of repeat lengths.', int, None, None, None],
+        ['-omega', 'Upper bound of repeat lengths.', int, None, None, None],
+        ['-kernel', 'Mutation kernel to evolve with.', str, None, 'draw', list(MUTATION_KERNELS.keys())]
     ]))
 
     return parser.parse_args()
@@ -65,13 +192,13 @@ if __name__ == '__main__':
 
     # Evolve some population 1000 times.
     start_t = timer()
-    main_descendants = [pop.evolve(pop.trace(arguments.n,
-                                             arguments.f,
-                                             arguments.c,
-                                             arguments.d,
-                                             arguments.kappa,
-                                             arguments.omega),
-                                   arguments.i_0) for _ in range(1000)]
+    main_descendants = [evolve(trace(arguments.n,
+                                     arguments.f,
+                                     arguments.c,
+                                     arguments.d,
+                                     arguments.kappa,
+                                     arguments.omega),
+                               arguments.i_0, arguments.kernel) for _ in range(1000)]
     end_t = timer()
     print('Time Elapsed (10000x): [\n\t' + str(end_t - start_t) + '\n]')
 
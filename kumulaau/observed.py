@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
-from typing import List, Iterable, Callable, Sequence
+from typing import List, Iterable, Iterator, Callable, Sequence
+from collections.abc import Sequence as SequenceABC
 from numpy import ndarray, array
 from argparse import Namespace
-from sqlite3 import Cursor
+from sqlite3 import Cursor, Connection
 
 # The name of the tables in the alfred and record databases.
 _ALFRED_TABLE_NAME = 'OBSERVED_ELL'
@@ -14,20 +15,46 @@ _ALFRED_SCHEMA = 'TIME_R TIMESTAMP, POP_NAME TEXT, POP_UID TEXT, SAMPLE_UID TEXT
 # Our table fields for the alfred database.
 ALFRED_FIELDS = 'TIME_R, POP_NAME, POP_UID, SAMPLE_UID, SAMPLE_SIZE, LOCUS, ELL, ELL_FREQ'
 
+# Our index for the alfred database. Samples are always extracted by (sample, locus), ignoring case.
+_ALFRED_INDEX = 'SAMPLE_UID COLLATE NOCASE, LOCUS COLLATE NOCASE'
+
+# Statement used to insert a single record (in ALFRED_FIELDS order) into the alfred database.
+_ALFRED_INSERT = f"""
+    INSERT OR REPLACE INTO {_ALFRED_TABLE_NAME}
+    VALUES ({','.join('?' for _ in ALFRED_FIELDS.split(','))});
+"""
+
 
 def _extract_tuples(cursor: Cursor, uid_loci: Iterable) -> List:
-    """ Query the observation table for (repeat length, frequency) tuples for various uid, locus pairs.
+    """ Query the observation table for (repeat length, frequency) tuples for various uid, locus pairs. All pairs are
+    loaded into a temporary table and joined against our (indexed) observation table in a single query, as opposed to
+    performing one table scan per pair. Samples and loci are matched without regard to case.
 
     :param cursor: Cursor to the observation database.
     :param uid_loci: List of (uid, loci) pairs to query our database with. Order of tuple matters here!!
     :return: 2D List of (int, float) tuples representing the (repeat length, frequency) tuples.
     """
-    return list(map(lambda a: cursor.execute("""
-        SELECT CAST(ELL AS INTEGER), CAST(ELL_FREQ AS FLOAT)
-        FROM OBSERVED_ELL
-        WHERE SAMPLE_UID LIKE ?
-        AND LOCUS LIKE ?
-    """, (a[0], a[1])).fetchall(), uid_loci))
+    uid_loci = list(uid_loci)
+
+    # Record each pair with its position, such that our results can be returned in the order given.
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS REQUESTED_ELL (K INT, SAMPLE_UID TEXT, LOCUS TEXT);')
+    cursor.execute('DELETE FROM REQUESTED_ELL;')
+    cursor.executemany('INSERT INTO REQUESTED_ELL VALUES (?, ?, ?);', ((k, a[0], a[1]) for k, a in enumerate(uid_loci)))
+
+    # Pairs without any observations are given an empty list.
+    tuples = [[] for _ in uid_loci]
+    for k, ell, ell_freq in cursor.execute(f"""
+        SELECT R.K, CAST(O.ELL AS INTEGER), CAST(O.ELL_FREQ AS FLOAT)
+        FROM REQUESTED_ELL AS R
+        INNER JOIN {_ALFRED_TABLE_NAME} AS O
+        ON O.SAMPLE_UID = R.SAMPLE_UID COLLATE NOCASE
+        AND O.LOCUS = R.LOCUS COLLATE NOCASE
+        ORDER BY R.K, O.ROWID
+    """):
+        tuples[k].append((ell, ell_freq))
+
+    cursor.execute('DROP TABLE REQUESTED_ELL;')
+    return tuples
 
 
 def extract_alfred_tuples(uid_loci: Iterable, filename: str = 'data/observed.db') -> List:
@@ -87,12 +114,16 @@ def tuples_to_sparse_matrix(tuples: Iterable, bounds: Sequence) -> ndarray:
     """ Generate the sparse matrix representation (column = repeat length, row = observation) using the tuple
     representation and user-defined boundaries.
 
-    :param tuples: 2D list of (int, float) tuples representing the (repeat length, frequency) tuples.
+    :param tuples: 2D list of (int, float) tuples representing the (repeat length, frequency) tuples, or an
+        ObservedMatrix (whose matrix is used directly).
     :param bounds: Upper and lower bound (in that order) of the repeat unit space.
     :return: Array of numpy arrays holding a set of repeat lengths.
     """
     from numpy import zeros
 
+    if isinstance(tuples, ObservedMatrix):  # Our matrix already exists.
+        return tuples.to_sparse_matrix(bounds)
+
     # Generate a dictionary representation.
     observation_dictionary = tuples_to_dictionaries(tuples)
 
@@ -100,11 +131,116 @@ def tuples_to_sparse_matrix(tuples: Iterable, bounds: Sequence) -> ndarray:
     observations = array([zeros(bounds[1] - bounds[0] + 1) for _ in tuples])
     for j, observation in enumerate(observation_dictionary):
         for repeat_unit in observation.keys():
-            observations[j, repeat_unit - bounds[0] + 1] = observation[repeat_unit]
+            observations[j, repeat_unit - bounds[0]] = observation[repeat_unit]
 
     return observations
 
 
+class ObservedMatrix(SequenceABC):
+    def __init__(self, frequencies: ndarray, ell_min: int, uid_loci: Sequence = None):
+        """ Constructor. A compact representation of our observations: a dense frequency matrix, where each row is an
+        observation and each column is a repeat length (starting from ell_min). This behaves as our base representation
+        (a sequence of (repeat length, frequency) tuple lists) wherever one is expected, but can be saved to disk and
+        memory-mapped back without parsing anything per observation.
+
+        :param frequencies: Frequency matrix (row = observation, column = repeat length - ell_min).
+        :param ell_min: Repeat length of the first column of our frequency matrix.
+        :param uid_loci: Optional list of (uid, locus) pairs identifying each observation.
+        """
+        self.frequencies, self.ell_min = frequencies, int(ell_min)
+        self.uid_loci = None if uid_loci is None else [(a[0], a[1]) for a in uid_loci]
+
+    @classmethod
+    def from_tuples(cls, tuples: Iterable, uid_loci: Sequence = None):
+        """ Build a frequency matrix from our base representation, wide enough to hold every observed repeat length.
+
+        :param tuples: 2D list of (int, float) tuples representing the (repeat length, frequency) tuples.
+        :param uid_loci: Optional list of (uid, locus) pairs identifying each observation.
+        :return: A new ObservedMatrix holding our observations.
+        """
+        from numpy import zeros
+
+        tuples = list(tuples)
+        ells = [int(b[0]) for a in tuples for b in a]
+        ell_min = min(ells) if len(ells) > 0 else 0
+
+        frequencies = zeros((len(tuples), (max(ells) - ell_min + 1) if len(ells) > 0 else 0))
+        for j, observation in enumerate(tuples):
+            for ell, ell_freq in observation:
+                frequencies[j, int(ell) - ell_min] = float(ell_freq)
+
+        return cls(frequencies, ell_min, uid_loci)
+
+    @staticmethod
+    def _sidecar(filename: str) -> str:
+        """ :return: The location of the index (JSON) that accompanies the frequency matrix (.npy) at filename. """
+        from os.path import splitext
+        return splitext(filename)[0] + '.json'
+
+    def save(self, filename: str) -> None:
+        """ Save our frequency matrix to filename (as a .npy file), and our repeat length offset and sample / locus
+        index to a JSON sidecar of the same name.
+
+        :param filename: Location of the .npy file to save to.
+        :return: None.
+        """
+        from numpy import save, ascontiguousarray
+        from json import dump
+
+        save(filename, ascontiguousarray(self.frequencies))
+        with open(self._sidecar(filename), 'w') as sidecar_f:
+            dump({'ell_min': self.ell_min, 'uid_loci': self.uid_loci}, sidecar_f)
+
+    @classmethod
+    def load(cls, filename: str, mmap_mode: str = 'r'):
+        """ Load a frequency matrix saved with save. By default, our matrix is memory-mapped (read-only) rather than
+        read, so loading costs the same regardless of the number of observations.
+
+        :param filename: Location of the .npy file to load from.
+        :param mmap_mode: Memory-map mode given to numpy.load. If None, our matrix is read into memory.
+        :return: A new ObservedMatrix holding our observations.
+        """
+        from numpy import load
+        from json import load as load_json
+
+        with open(cls._sidecar(filename)) as sidecar_f:
+            index = load_json(sidecar_f)
+
+        return cls(load(filename, mmap_mode=mmap_mode), index['ell_min'], index['uid_loci'])
+
+    def to_sparse_matrix(self, bounds: Sequence) -> ndarray:
+        """ Fit our frequency matrix to the given repeat length space. If this space lies within the repeat lengths we
+        hold, this is a view of our (possibly memory-mapped) matrix. Frequencies outside of this space are dropped.
+
+        :param bounds: Lower and upper bound (in that order) of the repeat unit space.
+        :return: Frequency matrix (row = observation, column = repeat length - bounds[0]).
+        """
+        from numpy import zeros
+
+        start, end = int(bounds[0]) - self.ell_min, int(bounds[1]) - self.ell_min + 1
+        if 0 <= start and end <= self.frequencies.shape[1]:
+            return self.frequencies[:, start:end]
+
+        # Otherwise, copy the repeat lengths we share into a new matrix.
+        observations = zeros((self.frequencies.shape[0], end - start))
+        shared_start, shared_end = max(start, 0), min(end, self.frequencies.shape[1])
+        if shared_start < shared_end:
+            observations[:, shared_start - start:shared_end - start] = self.frequencies[:, shared_start:shared_end]
+        return observations
+
+    def __len__(self) -> int:
+        """ :return: The number of observations we hold. """
+        return self.frequencies.shape[0]
+
+    def __getitem__(self, j: int) -> List:
+        """ :return: The j'th observation in our base representation, omitting repeat lengths of frequency zero. """
+        if not -len(self) <= j < len(self):
+            raise IndexError('Observation index out of range.')
+
+        row = self.frequencies[j]
+        return [(int(ell) + self.ell_min, float(row[ell])) for ell in row.nonzero()[0]]
+
+
 def create_record_uid_loci_table(cursor: Cursor, table_name: str, pk_name_type: str) -> None:
     """ Given a cursor to some database, the name of the table, and the primary key associated with the table, create
     a table with the schema: {pk}, UID TEXT, LOCI TEXT.
@@ -137,7 +273,7 @@ def record_uid_loci(cursor: Cursor, table_name: str, pk, uid_loci: Iterable) ->
 
 
 def create_alfred_table(cursor: Cursor) -> None:
-    """ Given a cursor to ALFRED database, create the ALFRED table.
+    """ Given a cursor to ALFRED database, create the ALFRED table and its (sample, locus) index.
 
     :param cursor: Cursor to the observation database to create the table for.
     :return: None.
@@ -146,21 +282,81 @@ def create_alfred_table(cursor: Cursor) -> None:
         CREATE TABLE IF NOT EXISTS {_ALFRED_TABLE_NAME} (
         {_ALFRED_SCHEMA}
     );""")
+    cursor.execute(f"""
+        CREATE INDEX IF NOT EXISTS {_ALFRED_TABLE_NAME}_SAMPLE_LOCUS
+        ON {_ALFRED_TABLE_NAME} ({_ALFRED_INDEX});
+    """)
 
 
 def record_to_alfred_table(cursor: Cursor, record) -> None:
-    """ Given a cursor to the ALFRED database, record some field.
+    """ Given a cursor to the ALFRED database, record some field. To record many fields, see record_alfred_tsv.
 
     :param cursor: Cursor to the observation database to record to.
     :param record: Namespace holding all required fields to record.
     :return: None.
     """
-    fields = [b.lower().strip() for b in ALFRED_FIELDS.split(',')]
+    cursor.execute(_ALFRED_INSERT, tuple(getattr(record, a.lower().strip()) for a in ALFRED_FIELDS.split(',')))
+
+
+def _parse_alfred_tsv(tsv_f: Iterable, anomalies: List) -> Iterator:
+    """ Lazily parse the entries of an ALFRED frequency file (in TSV format) into records, in ALFRED_FIELDS order. We
+    assume the following schema, and skip the header:
+
+    popName, popUId, sampleUId, 2N, locusSymbol, siteName, alleleSymbol, entryDate, frequency
+
+    :param tsv_f: Open ALFRED frequency file.
+    :param anomalies: Output, list to append all entries that could not be parsed to.
+    :return: Iterator of records (tuples) to insert into the ALFRED table.
+    """
+    from csv import reader
+
+    freq_reader = reader(tsv_f, delimiter='\t')
+    next(freq_reader, None)
+
+    for entry in freq_reader:
+        try:
+            yield entry[7], entry[0], entry[1], entry[2], int(entry[3]), entry[4], int(entry[6]), float(entry[8])
+        except (ValueError, IndexError):
+            anomalies.append(entry)
 
-    cursor.execute(f"""
-        INSERT OR REPLACE INTO {_ALFRED_TABLE_NAME}
-        VALUES ({','.join('?' for _ in fields)});
-    """, tuple(getattr(record, a) for a in fields))
+
+def connect_alfred(filename: str = 'data/observed.db') -> Connection:
+    """ Connect to the ALFRED database for bulk loading. The database is put in write-ahead logging mode, and is
+    only synced to disk at checkpoints (as opposed to every transaction).
+
+    :param filename: Location of the observation database.
+    :return: Connection to the observation database, with the ALFRED table created.
+    """
+    from sqlite3 import connect
+
+    connection = connect(filename)
+    connection.execute('PRAGMA journal_mode = WAL;')
+    connection.execute('PRAGMA synchronous = NORMAL;')
+    create_alfred_table(connection.cursor())
+    connection.commit()
+
+    return connection
+
+
+def record_alfred_tsv(connection: Connection, tsv_f: Iterable, chunk_n: int = 100000) -> List:
+    """ Record all entries of an ALFRED frequency file (in TSV format) to the ALFRED table. The file is streamed, and
+    entries are inserted chunk_n at a time (one transaction per chunk), so memory does not grow with the file.
+
+    :param connection: Connection to the observation database to record to (see connect_alfred).
+    :param tsv_f: Open ALFRED frequency file.
+    :param chunk_n: Number of entries to insert per transaction.
+    :return: List of all entries that could not be parsed.
+    """
+    from itertools import islice
+
+    anomalies, cursor = [], connection.cursor()
+    records = _parse_alfred_tsv(tsv_f, anomalies)
+
+    for chunk in iter(lambda: list(islice(records, chunk_n)), []):
+        with connection:  # Commit each chunk as a single transaction.
+            cursor.executemany(_ALFRED_INSERT, chunk)
+
+    return anomalies
 
 
 def get_arguments() -> Namespace:
@@ -176,6 +372,8 @@ def get_arguments() -> Namespace:
         ['-odb', 'Location of the observed database file.', str, None, 'data/observed.db', None],
         ['-uid', 'IDs of observed samples to compare to.', str, '+', None, None],
         ['-loci', 'Loci of observed samples (must match with uid).', str, '+', None, None],
+        ['-out', 'If given, save our observations to this .npy file (see ObservedMatrix) instead of printing them.',
+         str, None, None, None]
     ]))
 
     return parser.parse_args()
@@ -184,4 +382,10 @@ def get_arguments() -> Namespace:
 if __name__ == '__main__':
     arguments = get_arguments()  # Parse our arguments.
 
-    print(extract_alfred_tuples(zip(arguments.uid, arguments.loci), arguments.odb))
+    main_uid_loci = list(zip(arguments.uid, arguments.loci))
+    main_tuples = extract_alfred_tuples(main_uid_loci, arguments.odb)
+
+    if arguments.out is not None:  # Save our observations in their compact form.
+        ObservedMatrix.from_tuples(main_tuples, main_uid_loci).save(arguments.out)
+    else:
+        print(main_tuples)
@@ -74,3 +74,97 @@ class Parameter(ABC):
                     return theta_proposed
 
         return _walkfunction
+
+
+class AdaptiveWalk(object):
+    def __init__(self, cls, theta_sigma: Parameter, target_rate: float = 0.234, adapt_start: int = 100,
+                 transform: Callable = None):
+        """ An adaptive Metropolis walk (Haario et al. 2001, w/ the global scaling of Andrieu and Thoms 2008). We start
+        by walking with independent Gaussian steps of size theta_sigma. After 'adapt_start' iterations, we walk using
+        the covariance of our chain history instead, scaled toward the given target acceptance rate. Parameters with a
+        step size of 0 never move, and integer parameters are rounded. Parameters derived from others (e.g. held equal by
+        the model's walk function) are set by 'transform' before validity is enforced with cls.walkfunction.
+
+        :param cls: Parameter class to generate new points of.
+        :param theta_sigma: Initial step size of each parameter.
+        :param target_rate: Acceptance rate to target.
+        :param adapt_start: Number of iterations to walk with our initial step sizes, before learning our covariance.
+        :param transform: Function accepting our stepped parameter set and returning it with its derived parameters set.
+            If None, no parameters are derived.
+        """
+        from numpy import array
+
+        self.cls, self.target_rate, self.adapt_start, self.transform = cls, target_rate, adapt_start, transform
+
+        # Only parameters with a step size move.
+        self.names = [a for a in theta_sigma.__dict__ if getattr(theta_sigma, a) > 0]
+        self.sigma = array([getattr(theta_sigma, a) for a in self.names], dtype='float64')
+
+        # Running mean and covariance (sum of squares) of our chain history, the number of iterations we have seen,
+        # the number of accepted proposals, and the log of our global scale.
+        self.mean, self.m_2, self.n, self.accepted_n, self.log_scale = None, None, 0, 0, 0.0
+
+    def _covariance(self):
+        """ Determine the covariance of our proposal. This is either diagonal (using our initial step sizes), or learned
+        from our chain history. We always add a small diagonal term so our covariance never becomes singular.
+
+        :return: Covariance matrix of the parameters we walk.
+        """
+        from numpy import diag, exp
+
+        if self.n < self.adapt_start:
+            return exp(2 * self.log_scale) * diag(self.sigma ** 2)
+
+        d = len(self.names)
+        return exp(2 * self.log_scale) * (2.38 ** 2 / d) * (self.m_2 / (self.n - 1) + 1.0e-6 * diag(self.sigma ** 2))
+
+    def _step(self, theta):
+        """ Take one (possibly invalid) Gaussian step from theta, using our current covariance. Our derived parameters
+        are then set from the parameters we stepped.
+
+        :param theta: Current point to walk from.
+        :return: A new parameter set.
+        """
+        from numpy.random import normal
+        from numpy.linalg import cholesky
+        from numbers import Integral
+
+        step = [getattr(theta, a) for a in self.names] + cholesky(self._covariance()) @ normal(size=len(self.names))
+
+        theta_proposed = dict(theta.__dict__)
+        for a, b in zip(self.names, step):
+            theta_proposed[a] = round(b) if isinstance(getattr(theta, a), Integral) else b
+
+        theta_proposed = self.cls(**theta_proposed)
+        return theta_proposed if self.transform is None else self.transform(theta_proposed)
+
+    def __call__(self, theta):
+        """ Generate a new valid point given our current point.
+
+        :param theta: Current point to walk from.
+        :return: A new parameter set.
+        """
+        return self.cls.walkfunction(self._step)(theta)
+
+    def update(self, theta, is_accepted: bool) -> None:
+        """ Inform our walk of the outcome of an iteration. We record the current state of our chain, and move our
+        global scale toward our target acceptance rate (larger if we accept too often, smaller otherwise).
+
+        :param theta: Current state of our chain (after accepting or rejecting our proposal).
+        :param is_accepted: True if our proposal was accepted. False otherwise.
+        :return: None.
+        """
+        from numpy import array, zeros, outer, clip
+
+        x = array([getattr(theta, a) for a in self.names], dtype='float64')
+        if self.mean is None:
+            self.mean, self.m_2 = zeros(len(self.names)), zeros((len(self.names), len(self.names)))
+
+        # Welford's update of our running mean and covariance.
+        self.n, self.accepted_n = self.n + 1, self.accepted_n + int(is_accepted)
+        delta = x - self.mean
+        self.mean = self.mean + delta / self.n
+        self.m_2 = self.m_2 + ((self.n - 1) / self.n) * outer(delta, delta)
+
+        # Robbins-Monro update of our scale, with a diminishing step size.
+        self.log_scale = clip(self.log_scale + (int(is_accepted) - self.target_rate) / self.n ** 0.6, -10, 10)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
-from typing import Sequence, Iterable, List
+from typing import Sequence, Iterable, List, Dict
+from argparse import Namespace
 
 
 class RecordSQLite(object):
@@ -13,7 +14,7 @@ class RecordSQLite(object):
     _RESULTS_SCHEMA = 'RUN_R TEXT, ' \
                       'TIME_R TIMESTAMP, ' \
                       'WAITING_TIME INT, ' \
-                      'P_PROPOSED FLOAT, ' \
+                      'LOG_P_PROPOSED FLOAT, ' \
                       'EXPECTED_DELTA FLOAT, ' \
                       'PROPOSED_TIME INT '
 
@@ -22,49 +23,91 @@ class RecordSQLite(object):
                    'FIELD_NAME TEXT, ' \
                    'FIELD_VAL TEXT '
 
-    def __init__(self, filename: str, model_name: str, model_schema: str, is_new_run: bool):
-        """ There exists four tables here: the observed table, the model table, the results table, and the run table.
+    # Schema for the state table, holding the last result of each run. This is followed by the schema of our model.
+    _STATE_SCHEMA = 'RUN_R TEXT PRIMARY KEY, ' \
+                    'TIME_R TIMESTAMP, ' \
+                    'WAITING_TIME INT, ' \
+                    'LOG_P_PROPOSED FLOAT, ' \
+                    'EXPECTED_DELTA FLOAT, ' \
+                    'PROPOSED_TIME INT, '
+
+    def __init__(self, filename: str, model_name: str, model_schema: str, is_new_run: bool, queue_n: int = None):
+        """ There exists five tables here: the observed table, the model table, the results table, the run table, and
+        the state table.
 
         (a) The first will always maintain the same schema of UID, LOCUS pairing.
         (b) The second is dependent on the model itself, holding all parameters associated with the model.
         (c) The third is dependent on the Markov chain, holding all results produced.
         (d) The fourth is dependent on any experiment parameters that is to be added.
+        (e) The fifth holds the last parameter set and result recorded for each run, and is updated with every flush.
+
+        All tables have a primary key of RUN_R, a randomly generated 10 character key. The model table is indexed by
+        (RUN_R, TIME_R), and the results table by (RUN_R, PROPOSED_TIME). Resuming a run only reads the state table,
+        and cleaning up only visits the runs recorded by this recorder, so neither depends on the length of our chains.
 
-        All tables have a primary key of RUN_R, a randomly generated 10 character key. The model and results table are
-        keyed compositely: (RUN_R, TIME_R).
+        If queue_n is given, the records of our handlers are written asynchronously: each flush only queues a snapshot
+        of its records, and a background thread inserts and commits these batches (in write-ahead logging mode, with
+        relaxed syncing). Every queued batch is committed before __exit__ returns.
 
         :param filename: Location of the results database to record to.
         :param model_name: Prefix to append to all tables associated with this model.
         :param model_schema: Schema of the _MODEL table.
         :param is_new_run: Flag which indicates if the current run to be logged is new or not.
+        :param queue_n: If given, record asynchronously through a queue holding at most this many batches.
         :return: None.
         """
         from sqlite3 import connect
+        from threading import Thread, Lock
+        from queue import Queue
 
-        # Connect to our database.
-        self.connection = connect(filename)
+        # Connect to our database. Asynchronously, our connection is shared with our writer (guarded by our lock).
+        self.connection = connect(filename, check_same_thread=queue_n is None)
         self.cursor = self.connection.cursor()
+        self._lock, self._queue, self._writer, self._writer_error = Lock(), None, None, None
+        if queue_n is not None:
+            self.connection.execute('PRAGMA journal_mode = WAL;')
+            self.connection.execute('PRAGMA synchronous = NORMAL;')
 
         # Determine our table names.
         self.observed_table = model_name + '_OBSERVED'
         self.model_table = model_name + '_MODEL'
         self.results_table = model_name + '_RESULTS'
         self.expr_table = model_name + '_EXPR'
+        self.state_table = model_name + '_STATE'
 
         # Create the tables if they do not already exist.
         list(map(lambda a, b: self._create_table(a, b),
-                 [self.observed_table, self.model_table, self.results_table, self.expr_table],
+                 [self.observed_table, self.model_table, self.results_table, self.expr_table, self.state_table],
                  [self._OBSERVED_SCHEMA, 'RUN_R TEXT, TIME_R TIMESTAMP, ' + model_schema, self._RESULTS_SCHEMA,
-                  self._EXPR_SCHEMA]))
+                  self._EXPR_SCHEMA, self._STATE_SCHEMA + model_schema]))
+
+        # Results recorded before our likelihoods were carried in log space must be migrated first.
+        self._migrate_results()
+
+        # Index our chains by run. Our results are not keyed uniquely, as SMC records a generation per PROPOSED_TIME.
+        list(map(lambda a, b: self._create_index(a, b),
+                 [self.model_table, self.results_table], ['RUN_R, TIME_R', 'RUN_R, PROPOSED_TIME']))
 
         # Determine our fields.
         self.model_fields = self._parse_fields(self.model_table)
         self.results_fields = self._parse_fields(self.results_table)
         self.expr_fields = self._parse_fields(self.expr_table)
+        self.state_fields = self._parse_fields(self.state_table)
         self.model_name = model_name
+        self._runs = set()
+
+        # Databases recorded to before our state table existed must have their state determined once.
+        if self.cursor.execute(f'SELECT 1 FROM {self.state_table} LIMIT 1;').fetchone() is None:
+            self._seed_state()
 
-        # Determine the run key.
-        self.run_r = self._generate_run_key() if is_new_run else self.retrieve_last_result('RUN_R')
+        # Determine the run key. Continued runs pick up the first chain of the last runs recorded.
+        self.run_r = self._generate_run_key() if is_new_run else self.retrieve_runs()[0]
+
+        # Start our writer, if we are recording asynchronously.
+        if queue_n is not None:
+            self._queue = Queue(max(1, queue_n))
+            self._writer = Thread(target=self._write_batches, name=f'{model_name}-writer', daemon=True)
+            self._writer.start()
 
     def __enter__(self):
         """ Required to use class as context manager.
@@ -74,120 +117,228 @@ class RecordSQLite(object):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        """ Required to use class as context manager. Remove any invalid records and close our connection to our
-        database.
+        """ Required to use class as context manager. Wait for our writer to commit every queued batch (if recording
+        asynchronously), remove any invalid records, and close our connection to our database.
 
         :param exc_type: Exception type (not used).
         :param exc_val: Exception value (not used).
         :param exc_tb: Exception throwback (not used).
         :return: None.
         """
-        self.cursor.execute(f"""
-            DELETE FROM {self.model_table}
-            WHERE TIME_R IN (
-                SELECT TIME_R
-                FROM {self.results_table}
-                WHERE TIME_R = 0
-            );
-        """)
-        self.cursor.execute(f"""
-            DELETE FROM {self.results_table}
-            WHERE TIME_R = 0;
-        """)
+        if self._writer is not None:  # Our writer stops once it reaches this marker.
+            self._queue.put(None)
+            self._writer.join()
+
+        # Only the runs we have recorded to could hold invalid records. Our model and results are recorded in pairs, so
+        # these are found through the (RUN_R, TIME_R) index of our model table.
+        for run_r in self._runs:
+            if self.cursor.execute(f"""
+                SELECT 1
+                FROM {self.model_table}
+                WHERE RUN_R = ? AND TIME_R = 0
+                LIMIT 1;
+            """, (run_r,)).fetchone() is None:
+                continue
+
+            for table in [self.model_table, self.results_table, self.state_table]:
+                self.cursor.execute(f"""
+                    DELETE FROM {table}
+                    WHERE RUN_R = ? AND TIME_R = 0;
+                """, (run_r,))
 
         # Commit and close our database connection.
         self.connection.commit(), self.connection.close()
 
-    def record_observed(self, observations: Sequence, pop_ids: Iterable = None):
+        # Report any failure of our writer, unless we are already handling an exception.
+        if self._writer_error is not None and exc_type is None:
+            raise self._writer_error
+
+    def create_run(self) -> str:
+        """ Generate a new run key, used to record an additional chain (e.g. one of several chains run together) with
+        this recorder. The run key of this recorder itself (run_r) is not changed.
+
+        :return: The new run key.
+        """
+        return self._generate_run_key()
+
+    def record_observed(self, observations: Sequence, pop_ids: Iterable = None, run_r: str = None):
         """ Given a set of observations in tuple form, record this to the _OBSERVED table. If pop_ids are specified,
         use these for the POP_ID fields. Otherwise, enumerate our given populations starting from 1.
 
         :param observations: 2D list of (int, float) tuples representing the (repeat length, frequency) tuples.
         :param pop_ids: Optional POP_IDs list to attach to each observed population.
+        :param run_r: Optional run key to record under. Defaults to the run key of this recorder.
         :return: None.
         """
+        run_r = self.run_r if run_r is None else run_r
         if pop_ids is None:  # If not specified, create our POP_IDs to uniquely identify each field.
             pop_ids = [str(a) for a in range(1, len(observations) + 1)]
 
-        for population, pop_id in zip(observations, pop_ids):
-            self.cursor.executemany(f"""
-                INSERT INTO {self.observed_table}
-                VALUES (?, ?, ?, ?);
-            """, ((self.run_r, pop_id, a[0], a[1]) for a in population))
+        with self._lock:
+            for population, pop_id in zip(observations, pop_ids):
+                self.cursor.executemany(f"""
+                    INSERT INTO {self.observed_table}
+                    VALUES (?, ?, ?, ?);
+                """, ((run_r, pop_id, a[0], a[1]) for a in population))
 
-    def record_expr(self, field_names: Sequence, field_vals: Sequence):
+    def record_expr(self, field_names: Sequence, field_vals: Sequence, run_r: str = None):
         """ Given a set of field names and corresponding values, record these to the _EXPR table. We cast everything to
         text here.
 
         :param field_names: Field names to record, whose order matches with field_vals.
         :param field_vals: Field values to record, whose order matches with field_names.
+        :param run_r: Optional run key to record under. Defaults to the run key of this recorder.
+        :return: None.
+        """
+        run_r = self.run_r if run_r is None else run_r
+        with self._lock:
+            self.cursor.executemany(f"""
+                INSERT INTO {self.expr_table}
+                VALUES (?, ?, ?)
+            """, zip([run_r for _ in field_names], [str(a) for a in field_names], [str(a) for a in field_vals]))
+
+    def record_runs(self, runs: Sequence) -> None:
+        """ Record that the given runs (e.g. the chains of a population-based MCMC run) were started together, such that
+        all of them can be restored by retrieve_runs. This is committed immediately, as an interrupted run must be able
+        to find its chains before any of its results are flushed.
+
+        :param runs: Run keys to record together, in order. The first of these identifies the group.
         :return: None.
         """
-        self.cursor.executemany(f"""
-            INSERT INTO {self.expr_table}
-            VALUES (?, ?, ?)
-        """, zip([self.run_r for _ in field_names], [str(a) for a in field_names], [str(a) for a in field_vals]))
+        with self._lock:
+            self.cursor.executemany(f"""
+                INSERT INTO {self.expr_table}
+                VALUES (?, ?, ?)
+            """, [(run_r, 'RUN_GROUP', runs[0]) for run_r in runs])
+            self.connection.commit()
+
+    def retrieve_runs(self) -> List[str]:
+        """ Query our _EXPR table for the last group of runs recorded together (see record_runs), in the order they were
+        recorded. If no groups have been recorded (i.e. only single chains), we return the run of our last result.
 
-    def handler_factory(self, flush_n: int):
+        :return: List of run keys.
+        """
+        runs = [a[0] for a in self.cursor.execute(f"""
+            SELECT RUN_R
+            FROM {self.expr_table}
+            WHERE FIELD_NAME = 'RUN_GROUP' AND FIELD_VAL = (
+                SELECT FIELD_VAL
+                FROM {self.expr_table}
+                WHERE FIELD_NAME = 'RUN_GROUP'
+                ORDER BY ROWID DESC
+                LIMIT 1
+            )
+            ORDER BY ROWID;
+        """).fetchall()]
+
+        return runs if len(runs) > 0 else [self.retrieve_last_result('RUN_R')]
+
+    def handler_factory(self, flush_n: int, run_r: str = None):
         """ Handler factory for a sequence of records, of arbitrary type. We specify how often we flush our record
-        set to dish.
+        set to dish. If we are recording asynchronously, flushing only queues a snapshot of our records (our chain
+        reuses its records), and waits only if our writer has fallen queue_n batches behind.
 
         :param flush_n: Number of iterations to run before flushing to disk.
+        :param run_r: Optional run key to record under. Defaults to the run key of this recorder.
         :return: None.
         """
+        run_r = self.run_r if run_r is None else run_r
+        self._runs.add(run_r)
+
         def _handler(x: Sequence, i: int):
             if i % flush_n != 0 or len(x) == 0:  # Record every flush_n iterations.
                 return
 
-            # Record to our _MODEL table. Do not log our initial result.
-            self.cursor.executemany(f"""
+            # Record every result except our initial result, and remove every record except the last.
+            if self._writer is None:
+                self._write_batch(run_r, [vars(a) for a in x[1:]])
+            elif self._writer_error is not None:
+                raise self._writer_error
+            else:
+                self._queue.put((run_r, [vars(a).copy() for a in x[1:]]))
+            del x[:-1]
+
+        return _handler
+
+    def _write_batch(self, run_r: str, records: Sequence) -> None:
+        """ Record a batch of chain states to our _MODEL and _RESULTS tables, replace the state of our run with the last
+        of these, and commit these on disk. Our writer thread calls this as well, so we use a cursor of our own (not
+        self.cursor).
+
+        :param run_r: Run key to record under.
+        :param records: Dictionaries of chain states, each holding a parameter set (theta) and our _RESULTS fields.
+        :return: None.
+        """
+        with self._lock:
+            # Record to our _MODEL table.
+            self.connection.executemany(f"""
                 INSERT INTO {self.model_table}
                 VALUES ({','.join('?' for _ in self.model_fields)});
-            """, ((self.run_r, a.time_r) + tuple([getattr(a.theta, b) for b in self.model_fields[2:]]) for a in x[1:]))
+            """, ((run_r, a['time_r']) + tuple([getattr(a['theta'], b) for b in self.model_fields[2:]])
+                  for a in records))
 
-            # Record to our _RESULTS table. Do not log our initial result.
-            self.cursor.executemany(f"""
+            # Record to our _RESULTS table.
+            self.connection.executemany(f"""
                 INSERT INTO {self.results_table}
                 VALUES ({','.join('?' for _ in self.results_fields)});
-            """, ((self.run_r,) + tuple([getattr(a, b) for b in self.results_fields[1:]]) for a in x[1:]))
+            """, ((run_r,) + tuple([a[b] for b in self.results_fields[1:]]) for a in records))
 
-            # Remove every record except the last.
-            x[:] = [x[-1]]
+            # Record the last state of our run to our _STATE table.
+            if len(records) > 0:
+                self.connection.execute(f"""
+                    INSERT OR REPLACE INTO {self.state_table} ({','.join(a.upper() for a in self.state_fields)})
+                    VALUES ({','.join('?' for _ in self.state_fields)});
+                """, (run_r,) + tuple([records[-1][b] for b in self.results_fields[1:]]) +
+                    tuple([getattr(records[-1]['theta'], b) for b in self.model_fields[2:]]))
 
             # Record our changes on disk.
             self.connection.commit()
 
-        return _handler
-
-    def retrieve_last_theta(self):
-        """ Query our _MODEL table for the last recorded parameter set according to TIME_R.
+    def _write_batches(self) -> None:
+        """ Entry point of our writer thread. Write each queued batch until we reach our end marker (None). If a batch
+        cannot be written, we remember our error (to be raised by our handlers and __exit__) and discard the remaining
+        batches, so our chains are never left waiting on a full queue.
 
+        :return: None.
+        """
+        for batch in iter(self._queue.get, None):
+            try:
+                if self._writer_error is None:
+                    self._write_batch(*batch)
+            except Exception as e:
+                self._writer_error = e
+
+    def retrieve_last_theta(self, run_r: str = None):
+        """ Query our _STATE table for the last recorded parameter set according to TIME_R. Our state table holds a
+        single row per run, so this does not depend on the length of our chains.
+
+        :param run_r: Run to query. If not specified, we query the last recorded parameter set across all runs.
         :return: A dictionary consisting of the last recorded parameter set.
         """
-        return dict(zip(self.model_fields[2:], self.cursor.execute(f"""
-            SELECT {','.join(a.upper() for a in self.model_fields[2:])}
-            FROM {self.model_table}
-            ORDER BY TIME_R DESC
-            LIMIT 1
-        """).fetchone()))
+        return dict(zip(self.model_fields[2:], self.retrieve_last_result(
+            ','.join(a.upper() for a in self.model_fields[2:]), is_tuple=True, run_r=run_r)))
 
-    def retrieve_last_result(self, select_clause: str):
-        """ Given a select clause, query our _RESULTS table for the last recorded result according to TIME_R.
+    def retrieve_last_result(self, select_clause: str, is_tuple: bool = False, run_r: str = None):
+        """ Given a select clause, query our _STATE table for the last recorded result according to TIME_R. Any field of
+        our _RESULTS or _MODEL tables can be selected.
 
         :param select_clause: Item to query and return.
+        :param is_tuple: Return a tuple even if the select clause only specifies one field.
+        :param run_r: Run to query. If not specified, we query the last recorded result across all runs.
         :return: Tuple of result or the sole item itself if the select clause only specifies one field.
         """
         result = self.cursor.execute(f"""
             SELECT {select_clause}
-            FROM {self.results_table}
+            FROM {self.state_table}
+            {'' if run_r is None else 'WHERE RUN_R = ?'}
             ORDER BY TIME_R DESC
             LIMIT 1
-        """).fetchone()
+        """, () if run_r is None else (run_r, )).fetchone()
 
         if result is None:  # Ensure that we have results to start with.
             raise RuntimeError("Unable to retrieve last result. Is the database seeded?")
 
-        return result[0] if len(result) == 1 else result
+        return result[0] if len(result) == 1 and not is_tuple else result
 
     def _create_table(self, name: str, schema: str) -> None:
         """ Given the name of the table to create and the specific schema, run a DDL and do  not throw errors if it
@@ -202,6 +353,62 @@ class RecordSQLite(object):
             {schema}
         );""")
 
+    def _create_index(self, name: str, columns: str) -> None:
+        """ Given the name of a table and the columns to index it by, create the index (named after both) if it does not
+        already exist. Indexing a table that already holds records takes time linear in its size, but only once.
+
+        :param name: Name of the table to index.
+        :param columns: Comma separated columns to index, in order.
+        :return: None.
+        """
+        self.cursor.execute(f"""
+            CREATE INDEX IF NOT EXISTS {name}_{columns.replace(', ', '_')}
+            ON {name} ({columns});
+        """)
+
+    def _migrate_results(self) -> None:
+        """ Results tables recorded before our likelihoods were carried in log space hold the likelihood of each
+        proposal in P_PROPOSED, in place of LOG_P_PROPOSED. Rename this column and take the log of each of its values
+        (a likelihood of 0 becomes -inf), in one transaction. This is a no-op for tables that are already migrated.
+
+        :return: None.
+        """
+        from math import log, inf
+
+        if 'p_proposed' not in self._parse_fields(self.results_table):
+            return
+
+        self.connection.create_function('KUMULAAU_LOG', 1, lambda a: a if a is None else (log(a) if a > 0 else -inf))
+        self.cursor.execute('BEGIN;')
+        self.cursor.execute(f"""
+            ALTER TABLE {self.results_table}
+            RENAME COLUMN P_PROPOSED TO LOG_P_PROPOSED;
+        """)
+        self.cursor.execute(f"""
+            UPDATE {self.results_table}
+            SET LOG_P_PROPOSED = KUMULAAU_LOG(LOG_P_PROPOSED);
+        """)
+        self.connection.commit()
+
+    def _seed_state(self) -> None:
+        """ Determine the state of every run from our _MODEL and _RESULTS tables (i.e. the last result of each run and
+        its parameter set), and record these to our _STATE table. This is a no-op if no results have been recorded.
+
+        :return: None.
+        """
+        self.cursor.execute(f"""
+            INSERT OR REPLACE INTO {self.state_table} ({','.join(a.upper() for a in self.state_fields)})
+            SELECT {','.join('R.' + a.upper() for a in self.results_fields)},
+                   {','.join('M.' + a.upper() for a in self.model_fields[2:])}
+            FROM (
+                SELECT RUN_R, MAX(TIME_R) AS TIME_R
+                FROM {self.results_table}
+                GROUP BY RUN_R
+            ) AS L
+            JOIN {self.results_table} AS R ON R.RUN_R = L.RUN_R AND R.TIME_R = L.TIME_R
+            JOIN {self.model_table} AS M ON M.RUN_R = L.RUN_R AND M.TIME_R = L.TIME_R;
+        """)
+
     def _parse_fields(self, name: str) -> List:
         """ Given the name of the table in an existing database, retrieve the field names.
 
@@ -222,3 +429,144 @@ class RecordSQLite(object):
         from random import choice
 
         return ''.join(choice(ascii_uppercase + digits) for _ in range(10))
+
+
+def _column_dtype(declared_type: str) -> str:
+    """ Given the declared type of a SQLite column, determine the NumPy type of its exported column. Timestamps (and
+    anything else that is not a number) are exported as text.
+
+    :param declared_type: Type of the column, as declared in its table's schema.
+    :return: NumPy type string of our exported column.
+    """
+    declared_type = declared_type.upper()
+    if 'INT' in declared_type:
+        return 'int64'
+    elif any(a in declared_type for a in ['REAL', 'FLOA', 'DOUB']):
+        return 'float64'
+    else:
+        return 'str'
+
+
+def export_chains(filename: str, model_name: str, out: str, chunk_n: int = 1000000) -> List[str]:
+    """ Export the chains of some model (its _MODEL and _RESULTS tables) from a results database to the directory out,
+    in a columnar form (one column per field). If pyarrow is available, each table is written to an Arrow IPC file
+    (<table>.arrow) holding a record batch per chunk_n rows. Otherwise, every chunk_n rows of each table are written
+    to their own NumPy archive (<table>.<k>.npz) holding one array per field. Our tables are streamed in chunks, so
+    only chunk_n rows are held in memory at once. NULLs are exported as NaN in real columns and as empty strings in text
+    columns. Integer columns that hold any NULL are exported as real columns (with NaN) for the entire table.
+
+    :param filename: Location of the results database to export from.
+    :param model_name: Prefix of the tables associated with our model.
+    :param out: Directory to write our chains to. Any previous export of these tables here is replaced.
+    :param chunk_n: Number of rows per chunk.
+    :return: List of files written to.
+    """
+    from sqlite3 import connect
+    from os import makedirs, remove
+    from os.path import join
+    from glob import glob
+    from numpy import array, savez
+
+    try:  # Our Arrow files can be read by any Arrow / pandas / polars reader.
+        import pyarrow
+        import pyarrow.ipc
+    except ImportError:
+        pyarrow = None
+
+    makedirs(out, exist_ok=True)
+    connection, written = connect(filename), []
+
+    for table in [model_name + '_MODEL', model_name + '_RESULTS']:
+        list(map(remove, glob(join(out, f'{table}.*.npz')) + glob(join(out, f'{table}.arrow'))))
+        fields = connection.execute(f'PRAGMA table_info({table});').fetchall()
+        names, dtypes = [a[1].upper() for a in fields], [_column_dtype(a[2]) for a in fields]
+
+        # NULLs cannot be held by an integer array, so we must know which integer columns hold any before we start.
+        null_ns = connection.execute(f'SELECT {",".join(f"TOTAL({a} IS NULL)" for a in names)} '
+                                     f'FROM {table};').fetchone()
+        dtypes = ['float64' if a == 'int64' and b > 0 else a for a, b in zip(dtypes, null_ns)]
+        cursor, writer = connection.execute(f'SELECT * FROM {table} ORDER BY ROWID;'), None
+
+        for k, rows in enumerate(iter(lambda: cursor.fetchmany(chunk_n), [])):
+            columns = {a: array([('' if c is None else str(c)) for c in b] if d == 'str' else b, dtype=d)
+                       for a, b, d in zip(names, zip(*rows), dtypes)}
+
+            if pyarrow is None:  # Fall back to NumPy archives, one per chunk.
+                written.append(join(out, f'{table}.{k}.npz'))
+                with open(written[-1], 'wb') as f:
+                    savez(f, **columns)
+                continue
+
+            batch = pyarrow.record_batch(list(columns.values()), names=names)
+            if writer is None:
+                written.append(join(out, f'{table}.arrow'))
+                writer = pyarrow.ipc.new_file(written[-1], batch.schema)
+            writer.write_batch(batch)
+
+        if writer is not None:
+            writer.close()
+
+    connection.close()
+    return written
+
+
+def load_chains(out: str, table: str, columns: Iterable = None) -> Dict:
+    """ Load the columns of some table exported by export_chains, concatenating every chunk. Arrow files are memory
+    mapped.
+
+    :param out: Directory our chains were exported to.
+    :param table: Name of the exported table (e.g. ELE1T0S0I_MODEL).
+    :param columns: Names of the columns to load. If not given, every column is loaded.
+    :return: Dictionary of column names to NumPy arrays. This is empty if our table holds no rows.
+    """
+    from os.path import join, isfile
+    from glob import glob
+    from numpy import load, concatenate
+
+    if isfile(join(out, f'{table}.arrow')):
+        import pyarrow
+        import pyarrow.ipc
+
+        # Our map is not closed here, as our columns may be views of it.
+        arrow_table = pyarrow.ipc.open_file(pyarrow.memory_map(join(out, f'{table}.arrow'))).read_all()
+        return {a: arrow_table.column(a).to_numpy() for a in (arrow_table.column_names if columns is None else columns)}
+
+    # Our NumPy archives are loaded in the order they were written.
+    chunks = [load(a) for a in sorted(glob(join(out, f'{table}.*.npz')), key=lambda a: int(a.split('.')[-2]))]
+    if len(chunks) == 0:
+        return {}
+
+    return {a: concatenate([b[a] for b in chunks]) for a in (chunks[0].files if columns is None else columns)}
+
+
+def get_arguments() -> Namespace:
+    """ Create the CLI and parse the arguments.
+
+    :return: Namespace of all values.
+    """
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Export the chains of a results database to columnar files.')
+    list(map(lambda a: parser.add_argument(a[0], help=a[1], type=a[2], nargs=a[3], default=a[4], choices=a[5]), [
+        ['-mdb', 'Location of the results database to export from.', str, None, None, None],
+        ['-model_name', 'Prefix of the tables associated with our model (e.g. ELE1T0S0I).', str, None, None, None],
+        ['-out', 'Directory to export our chains to.', str, None, None, None],
+        ['-chunk_n', 'Number of rows per exported chunk.', int, None, 1000000, None],
+        ['-mean', 'If given, print the mean of these _MODEL columns (integer columns are truncated).', str, '+', None,
+         None]
+    ]))
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from numpy import nanmean
+
+    arguments = get_arguments()  # Parse our arguments.
+
+    export_chains(arguments.mdb, arguments.model_name, arguments.out, arguments.chunk_n)
+
+    if arguments.mean is not None:  # Summarize our parameters, one column at a time.
+        main_columns = load_chains(arguments.out, arguments.model_name + '_MODEL', arguments.mean)
+        print(' '.join(str(int(main_columns[a].mean()) if main_columns[a].dtype.kind in 'iu' else
+                           nanmean(main_columns[a])) for a in arguments.mean))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+from kumulaau.distance import populate_d_all
+from kumulaau.parameter import Parameter
+from typing import Callable, Sequence, Tuple
+from numpy import ndarray
+
+
+def _to_matrix(thetas: Sequence, names: Sequence) -> ndarray:
+    """ Collect a sequence of parameter sets into a matrix, where each row is a parameter set.
+
+    :param thetas: Parameter sets to collect.
+    :param names: Names of the parameters (columns) to collect, in order.
+    :return: Matrix of parameters (row = parameter set, column = parameter).
+    """
+    from numpy import array
+
+    return array([[getattr(theta, a) for a in names] for theta in thetas], dtype='float64')
+
+
+def _kernel_density(theta_to: ndarray, theta_from: ndarray, sigma: ndarray, is_discrete: ndarray) -> ndarray:
+    """ Determine the density of walking from each parameter set in theta_from to each parameter set in theta_to. We
+    assume that our walk is an independent Gaussian step for each parameter (rounded for discrete parameters, as our
+    walk functions do). Parameters with a step size of 0 never move. The truncation of our walk to the valid parameter
+    space (see Parameter.walkfunction) is ignored.
+
+    :param theta_to: Matrix of parameter sets we walk to (row = parameter set, column = parameter).
+    :param theta_from: Matrix of parameter sets we walk from (row = parameter set, column = parameter).
+    :param sigma: Step size of each parameter.
+    :param is_discrete: Flags indicating which parameters are integers.
+    :return: Matrix of densities (row = theta_to, column = theta_from).
+    """
+    from scipy.special import ndtr
+    from numpy import ones, exp, sqrt, pi
+
+    density = ones((theta_to.shape[0], theta_from.shape[0]))
+    for k in range(theta_to.shape[1]):
+        delta = theta_to[:, k, None] - theta_from[None, :, k]
+
+        if sigma[k] == 0:
+            density *= delta == 0
+        elif is_discrete[k]:  # Probability that our rounded step lands on this integer.
+            density *= ndtr((delta + 0.5) / sigma[k]) - ndtr((delta - 0.5) / sigma[k])
+        else:
+            density *= exp(-0.5 * (delta / sigma[k]) ** 2) / (sigma[k] * sqrt(2 * pi))
+
+    return density
+
+
+def run(walk: Callable, sample: Callable, delta: Callable, log_handler: Callable, theta_0: Parameter,
+        theta_sigma: Parameter, observed: Sequence, simulation_n: int, particle_n: int, generation_n: int,
+        alpha: float = 0.5, epsilon_min: float = 0.0, sample_batch: Callable = None, seed=None,
+        max_proposal_n: int = None) -> Tuple[list, ndarray]:
+    """ A population Monte Carlo ABC algorithm (ABC-PMC) to approximate the posterior distribution of a generic model.
+    Instead of a single Markov chain, we evolve a population of weighted particles toward our posterior while
+    shrinking our acceptance threshold epsilon. The particles of a generation are independent, so each batch of
+    proposals is simulated in one parallel step:
+
+    1) Our prior is a walk from theta_0 using the step sizes theta_sigma. We draw 'particle_n' particles from this,
+       each given the same weight.
+    2) For 'generation_n - 1' generations...
+        a) Epsilon is the alpha-quantile of the expected distances of the previous generation (at least epsilon_min).
+        b) Until we have 'particle_n' particles (or have made 'max_proposal_n' proposals this generation)...
+            i) We resample particles from the previous generation according to their weights, and walk from each.
+               The variance of each step is twice the weighted variance of that parameter in the previous generation.
+            ii) For each proposal, we simulate 'simulation_n' populations and populate a D matrix.
+            iii) If the expected distance (mean of D) of a proposal falls below epsilon, we keep this particle.
+        c) Each particle is weighed by prior(theta) / sum_j (w_j * K(theta | theta_j)), where K is our walk kernel.
+
+    Every generation is passed to our log handler in the same manner as our MCMC engine (the first record is never
+    logged). Each record holds the particle (theta), its log weight (log_p_proposed), its expected distance
+    (expected_delta), and its generation (proposed_time).
+
+    :param walk: Walk function accepting some parameter set and the step sizes of each parameter (a Parameter
+        instance), returning another parameter set (e.g. a function decorated with Parameter.walkfunction).
+    :param sample: Function that produces a collection of repeat lengths (i.e. the model function).
+    :param delta: Frequency distribution distance function. 0 = exact match, 1 = maximally dissimilar.
+    :param log_handler: Function that handles each generation of particles, given the records and the generation.
+    :param theta_0: Center of our prior.
+    :param theta_sigma: Step sizes of our prior, about theta_0.
+    :param observed: 2D list of (int, float) tuples representing the (repeat length, frequency) tuples.
+    :param simulation_n: Number of simulations to use to obtain a distance.
+    :param particle_n: Number of particles in each generation.
+    :param generation_n: Number of generations to run for.
+    :param alpha: Quantile of the previous generation's distances to use as our next epsilon.
+    :param epsilon_min: Smallest epsilon to use.
+    :param sample_batch: Optional function that produces the populations of several parameter sets in one call (used in
+        place of sample). See populate_d_all in distance.py.
+    :param seed: Master seed for this run. If specified, our walks, resampling, and simulations are all reproducible.
+    :param max_proposal_n: Largest number of proposals to make in a single generation. If not specified, this is
+        1000 * particle_n. If we cannot fill a generation within this many proposals, we raise a RuntimeError.
+    :return: The particles of our last generation and their (normalized) weights.
+    """
+    from numpy import zeros, mean, log, inf, full, quantile, sqrt, average, array
+    from numpy.random import choice, seed as seed_numpy
+    from kumulaau.model import split_seed
+    from types import SimpleNamespace
+    from numbers import Integral
+    from datetime import datetime
+
+    # Our walks and resampling use the NumPy RNG.
+    if seed is not None:
+        seed_numpy(split_seed(seed, 0) % 2 ** 32)
+
+    max_proposal_n = 1000 * particle_n if max_proposal_n is None else max_proposal_n
+
+    names = list(theta_0.__dict__.keys())
+    is_discrete = array([isinstance(getattr(theta_0, a), Integral) for a in names])
+    sigma_prior, theta_0_matrix = _to_matrix([theta_sigma], names)[0], _to_matrix([theta_0], names)
+
+    particles, weights, distances, epsilon, sigma, x = [], None, None, inf, sigma_prior, [None]
+    for t in range(generation_n):
+        if t > 0:  # Adapt our step sizes and epsilon to the previous generation.
+            particle_matrix = _to_matrix(particles, names)
+            center = average(particle_matrix, axis=0, weights=weights)
+            sigma = sqrt(2 * average((particle_matrix - center) ** 2, axis=0, weights=weights))
+            sigma[sigma_prior == 0] = 0  # Parameters that are fixed by our prior never move.
+            epsilon = max(epsilon_min, quantile(distances, alpha))
+        walk_params = type(theta_0)(**dict(zip(names, sigma)))
+
+        # Propose and simulate batches of particles until we have enough below our epsilon.
+        accepted, accepted_distances, k = [], [], 0
+        while len(accepted) < particle_n:
+            if k >= max_proposal_n:  # Our epsilon (or prior) is too strict to ever fill this generation.
+                raise RuntimeError(f'Only {len(accepted)} of {particle_n} particles were accepted in generation {t} '
+                                   f'after {k} proposals (epsilon = {epsilon}).')
+            proposals = [walk(theta_0, walk_params) for _ in range(particle_n)] if t == 0 else \
+                [walk(particles[j], walk_params) for j in choice(len(particles), size=particle_n, p=weights)]
+
+            d_all = [zeros((simulation_n, len(observed)), dtype='float64') for _ in proposals]
+            populate_d_all(d_all, observed, sample, delta, proposals, [[a.kappa, a.omega] for a in proposals],
+                           sample_batch=sample_batch,
+                           seeds=[split_seed(split_seed(split_seed(seed, 1), t), k + j) for j in range(particle_n)])
+            k += particle_n
+
+            for theta_proposed, d in zip(proposals, d_all):
+                if mean(d) <= epsilon and len(accepted) < particle_n:
+                    accepted.append(theta_proposed), accepted_distances.append(mean(d))
+
+        # Weigh our new particles against the previous generation (our first generation is drawn from our prior).
+        accepted_matrix = _to_matrix(accepted, names)
+        if t == 0:
+            weights_next = full(particle_n, 1.0 / particle_n)
+        else:
+            prior = _kernel_density(accepted_matrix, theta_0_matrix, sigma_prior, is_discrete)[:, 0]
+            weights_next = prior / (_kernel_density(accepted_matrix, _to_matrix(particles, names), sigma,
+                                                    is_discrete) @ weights)
+            weights_next = weights_next / weights_next.sum()
+        particles, weights, distances = accepted, weights_next, array(accepted_distances)
+
+        # Record this generation.
+        x.extend(SimpleNamespace(theta=a, time_r=datetime.now(), waiting_time=1, log_p_proposed=log(b),
+                                 expected_delta=c, proposed_time=t) for a, b, c in zip(particles, weights, distances))
+        log_handler(x, t)
+
+    return particles, weights
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 from argparse import Namespace
 from numpy import ndarray
+from typing import List, Sequence
 from kumulaau import *
 
 # The model name associated with the results database.
@@ -36,13 +37,27 @@ class Parameter1T0S0I(Parameter):
             0 < self.kappa <= self.i_0 <= self.omega
 
 
-def sample_1T0S0I(theta: Parameter1T0S0I) -> ndarray:
+def sample_1T0S0I(theta: Parameter1T0S0I, seed=None) -> ndarray:
     """ Generate a list of lengths of our 1T (one total) 0S (zero splits) 0I (zero intermediates) model.
 
     :param theta: Parameter1T0S0I set to use with tree tracing.
+    :param seed: Seed for our RNG. If None, a seed is generated.
     :return: List of repeat lengths.
     """
-    return model.evolve(model.trace(theta.n, theta.f, theta.c, theta.d, theta.kappa, theta.omega), theta.i_0)
+    return model.evolve(model.trace(theta.n, theta.f, theta.c, theta.d, theta.kappa, theta.omega, seed), theta.i_0)
+
+
+def sample_batch_1T0S0I(thetas: Sequence, simulation_ns: Sequence, seeds: Sequence) -> List[ndarray]:
+    """ Generate the populations of several Parameter1T0S0I sets (e.g. the proposals of several chains) in a single
+    native call.
+
+    :param thetas: Parameter1T0S0I sets to use with tree tracing.
+    :param simulation_ns: Number of populations to generate for each parameter set.
+    :param seeds: Master seed for our RNG, for each parameter set. If None, a seed is generated.
+    :return: One matrix of repeat lengths per parameter set, where each row is a population.
+    """
+    return model.simulate_batches([(a.n, a.f, a.c, a.d, a.kappa, a.omega, a.i_0, b, c)
+                                   for a, b, c in zip(thetas, simulation_ns, seeds)])
 
 
 @Parameter1T0S0I.walkfunction
@@ -70,17 +85,37 @@ def get_arguments() -> Namespace:
     :return: Namespace of all values.
     """
     from argparse import ArgumentParser
+    from inspect import getfullargspec
 
     parser = ArgumentParser(description='ABC MCMC for microsatellite mutation model 1T0S0I parameter estimation.')
 
     list(map(lambda a: parser.add_argument(a[0], help=a[1], type=a[2], nargs=a[3], default=a[4], choices=a[5]), [
         ['-mdb', 'Location of the database to record to.', str, None, 'data/abc1t0s0i.db', None],
         ['-observations', 'String of tuple representation of observations.', str, None, None, None],
+        ['-observations_file', 'Observations saved as a .npy file (see ObservedMatrix), in place of -observations.',
+         str, None, None, None],
         ['-delta', 'Distance function to use.', str, None, None, ['cosine', 'euclidean']],
         ['-simulation_n', 'Number of simulations to use to obtain a distance.', int, None, None, None],
         ['-iterations_n', 'Number of iterations to run MCMC for.', int, None, None, None],
         ['-epsilon', "Maximum acceptance value for distance between [0, 1].", float, None, None, None],
         ['-flush_n', 'Number of iterations to run MCMC before flushing to disk.', int, None, None, None],
+        ['-writer_queue_n', 'If given, flush asynchronously through a queue of up to this many flushes.', int, None,
+         None, None],
+        ['-seed', 'Master seed for our RNGs. If not specified, runs are not reproducible.', int, None, None, None],
+        ['-chains_n', 'Number of chains to run together (new runs only).', int, None, 1, None],
+        ['-chunk_n', 'Simulate in chunks of this size, rejecting proposals early if possible.', int, None, None, None],
+        ['-particle_n', 'Number of particles per generation. If given, we run ABC-SMC.', int, None, None, None],
+        ['-generation_n', 'Number of ABC-SMC generations to run for.', int, None, None, None],
+        ['-alpha', 'Quantile of distances used as the next ABC-SMC epsilon.', float, None, 0.5, None],
+        ['-max_proposal_n', 'Most proposals to make per ABC-SMC generation before giving up.', int, None, None, None],
+        ['-adapt_target', 'If given, learn each proposal (adaptive Metropolis) to target this acceptance rate.', float,
+         None, None, None],
+        ['-cache_mb', 'If given, cache the distances of visited proposals using up to this many MB. Revisited '
+                      'proposals reuse their simulations, so our chains target a (biased) fixed-noise posterior.', int,
+         None, None, None],
+        ['-cache_digits', 'Significant digits of real parameters to distinguish proposals by in our cache.', int, None,
+         None, None],
+        ['-checkpoint', 'Checkpoint file to save to every flush (and resume from).', str, None, None, None],
         ['-i_0_start', 'Starting ancestor repeat length.', int, None, None, None],
         ['-n_start', 'Starting sample size (population size).', int, None, None, None],
         ['-f_start', 'Starting scaling factor for total mutation rate.', float, None, None, None],
@@ -96,42 +131,104 @@ def get_arguments() -> Namespace:
         ['-kappa_sigma', 'Step size of kappa when changing parameters.', float, None, None, None],
         ['-omega_sigma', 'Step size of omega when changing parameters.', float, None, None, None]
     ]))
+    arguments = parser.parse_args()
 
-    return parser.parse_args()
+    # ABC-SMC runs are never continued or resumed, so each must be given its prior and its dimensions up front.
+    if arguments.particle_n is not None:
+        missing = [a for a in ['simulation_n', 'generation_n'] + [b + c for c in ['_start', '_sigma'] for b in
+                                                                  getfullargspec(Parameter1T0S0I.__init__).args[1:]]
+                   if getattr(arguments, a) is None]
+        if len(missing) > 0:
+            parser.error('-particle_n requires ' + ', '.join('-' + a for a in missing) + '.')
+        if arguments.checkpoint is not None:
+            parser.error('ABC-SMC runs cannot be resumed, so -checkpoint cannot be given with -particle_n.')
+
+        # ABC-SMC runs a single population of particles, and does not use our MCMC options.
+        unused = [a for a in ['chunk_n', 'adapt_target', 'cache_mb'] if getattr(arguments, a) is not None]
+        if arguments.chains_n != 1:
+            unused = ['chains_n'] + unused
+        if len(unused) > 0:
+            parser.error(', '.join('-' + a for a in unused) + ' cannot be given with -particle_n.')
+
+    return arguments
 
 
 if __name__ == '__main__':
     from importlib import import_module
     from ast import literal_eval
+    from os.path import isfile
+    from os import remove
 
     arguments = get_arguments()  # Parse our arguments.
-    observations = literal_eval(arguments.observations)
+    observations = literal_eval(arguments.observations) if arguments.observations_file is None else \
+        kumulaau.observed.ObservedMatrix.load(arguments.observations_file)
 
-    # Determine if we are continuing an MCMC run or starting a new one.
-    is_new_run = arguments.n_start is not None
+    # A checkpoint is only removed once our chains have finished, so if one exists our last run was interrupted and we
+    # resume it (regardless of our starting point). Otherwise, we start a new run if given a starting point.
+    is_resumed = arguments.particle_n is None and arguments.checkpoint is not None and isfile(arguments.checkpoint)
+    is_new_run = arguments.n_start is not None and not is_resumed
 
     # Connect to our results database.
-    with RecordSQLite(arguments.mdb, MODEL_NAME, MODEL_SQL, is_new_run) as lumberjack:
+    with RecordSQLite(arguments.mdb, MODEL_NAME, MODEL_SQL, is_new_run, arguments.writer_queue_n) as lumberjack:
 
-        if is_new_run:  # Record our observations and experiment parameters.
-            lumberjack.record_observed(observations)
-            lumberjack.record_expr(list(vars(arguments).keys()), list(vars(arguments).values()))
+        # Each chain is recorded under its own run key (ABC-SMC records to one run). Continued runs restore every chain
+        # of our last run.
+        chains_n = arguments.chains_n if arguments.particle_n is None else 1
+        runs = [lumberjack.run_r] + [lumberjack.create_run() for _ in range(chains_n - 1)] if is_new_run \
+            else lumberjack.retrieve_runs()
+
+        if is_new_run:  # Record our chains, observations, and experiment parameters.
+            lumberjack.record_runs(runs)
+            for run_r in runs:
+                lumberjack.record_observed(observations, run_r=run_r)
+                lumberjack.record_expr(list(vars(arguments).keys()), list(vars(arguments).values()), run_r=run_r)
 
         # Construct the walk, summary, and log functions based on our given arguments.
         walk = lambda a: walk_1T0S0I(a, Parameter1T0S0I.from_namespace(arguments, lambda b: b + '_sigma'))
-        log = lumberjack.handler_factory(arguments.flush_n)
+        if arguments.adapt_target is not None:  # Each chain learns its own proposal, starting from our step sizes.
+            walk = [AdaptiveWalk(Parameter1T0S0I, Parameter1T0S0I.from_namespace(arguments, lambda b: b + '_sigma'),
+                                 arguments.adapt_target) for _ in runs]
+        logs = [lumberjack.handler_factory(arguments.flush_n, run_r) for run_r in runs]
         delta = getattr(import_module('kumulaau.distance'), arguments.delta + '_delta')
-
-        # Determine our starting point and boundaries.
-        if is_new_run:
-            theta_0 = Parameter1T0S0I.from_namespace(arguments, lambda a: a + '_start')
-            boundaries = [0, arguments.iterations_n]
-        else:
-            theta_0 = Parameter1T0S0I(**lumberjack.retrieve_last_theta())
-            offset = lumberjack.retrieve_last_result('PROPOSED_TIME')
-            boundaries = [0 + offset, arguments.iterations_n + offset]
-
-        # Run our MCMC!
-        kumulaau.abc.run(walk=walk, sample=sample_1T0S0I, delta=delta, log_handler=log,
-                         theta_0=theta_0, observed=observations, simulation_n=arguments.simulation_n,
-                         boundaries=boundaries, epsilon=arguments.epsilon)
+        cache = None if arguments.cache_mb is None else \
+            kumulaau.distance.DistanceCache(arguments.cache_mb * 2 ** 20, arguments.cache_digits)
+
+        # Run ABC-SMC if desired. Our walk step sizes are used as the spread of our prior about our starting point.
+        if arguments.particle_n is not None:
+            kumulaau.smc.run(walk=walk_1T0S0I, sample=sample_1T0S0I, delta=delta,
+                             log_handler=lumberjack.handler_factory(1, runs[0]),
+                             theta_0=Parameter1T0S0I.from_namespace(arguments, lambda a: a + '_start'),
+                             theta_sigma=Parameter1T0S0I.from_namespace(arguments, lambda a: a + '_sigma'),
+                             observed=observations, simulation_n=arguments.simulation_n,
+                             particle_n=arguments.particle_n, generation_n=arguments.generation_n,
+                             alpha=arguments.alpha, sample_batch=sample_batch_1T0S0I, seed=arguments.seed,
+                             max_proposal_n=arguments.max_proposal_n)
+
+        else:  # Otherwise, determine our starting point and boundaries for MCMC.
+            if is_new_run:
+                theta_0s = [Parameter1T0S0I.from_namespace(arguments, lambda a: a + '_start') for _ in runs]
+                boundaries = [0, arguments.iterations_n]
+            elif is_resumed:  # Our chains, iteration, and boundaries are all restored from our checkpoint.
+                theta_0s, boundaries = [None for _ in runs], [0, arguments.iterations_n]
+            else:
+                # Each chain continues from the last state of its own run, and our chains share their iteration count.
+                theta_0s = [Parameter1T0S0I(**lumberjack.retrieve_last_theta(run_r)) for run_r in runs]
+                offset = max(lumberjack.retrieve_last_result('PROPOSED_TIME', run_r=run_r) for run_r in runs)
+                boundaries = [0 + offset, arguments.iterations_n + offset]
+
+            # Run our MCMC!
+            saved_n = kumulaau.abc.run_chains(walk=walk, sample=sample_1T0S0I, delta=delta, log_handlers=logs,
+                                              theta_0s=theta_0s, observed=observations,
+                                              simulation_n=arguments.simulation_n, boundaries=boundaries,
+                                              epsilon=arguments.epsilon, sample_batch=sample_batch_1T0S0I,
+                                              seed=arguments.seed, chunk_n=arguments.chunk_n,
+                                              buffer_n=arguments.flush_n + 1, checkpoint=arguments.checkpoint,
+                                              checkpoint_n=arguments.flush_n, cache=cache)
+
+            if arguments.chunk_n is not None:  # Report the work saved by early rejection.
+                print(f'Simulations saved by early rejection: {saved_n}')
+            if cache is not None:  # Report the work saved by our cache.
+                print(f'Simulations saved by our cache: {cache.reused_n}')
+
+    if arguments.checkpoint is not None and isfile(arguments.checkpoint):
+        remove(arguments.checkpoint)  # Our chains have finished, so we no longer need our checkpoint.
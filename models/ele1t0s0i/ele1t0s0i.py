@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 from argparse import Namespace
 from numpy import ndarray
+from typing import List, Sequence
 from kumulaau import *
 
 # The model name associated with the results database.
@@ -36,13 +37,27 @@ class Parameter1T0S0I(Parameter):
             0 < self.kappa <= self.i_0 <= self.omega
 
 
-def sample_1T0S0I(theta: Parameter1T0S0I) -> ndarray:
+def sample_1T0S0I(theta: Parameter1T0S0I, seed=None) -> ndarray:
     """ Generate a list of lengths of our 1T (one total) 0S (zero splits) 0I (zero intermediates) model.
 
     :param theta: Parameter1T0S0I set to use with tree tracing.
+    :param seed: Seed for our RNG. If None, a seed is generated.
     :return: List of repeat lengths.
     """
-    return model.evolve(model.trace(theta.n, theta.f, theta.c, theta.d, theta.kappa, theta.omega), theta.i_0)
+    return model.evolve(model.trace(theta.n, theta.f, theta.c, theta.d, theta.kappa, theta.omega, seed), theta.i_0)
+
+
+def sample_batch_1T0S0I(thetas: Sequence, simulation_ns: Sequence, seeds: Sequence) -> List[ndarray]:
+    """ Generate the populations of several Parameter1T0S0I sets (e.g. the proposals of several chains) in a single
+    native call.
+
+    :param thetas: Parameter1T0S0I sets to use with tree tracing.
+    :param simulation_ns: Number of populations to generate for each parameter set.
+    :param seeds: Master seed for our RNG, for each parameter set. If None, a seed is generated.
+    :return: One matrix of repeat lengths per parameter set, where each row is a population.
+    """
+    return model.simulate_batches([(a.n, a.f, a.c, a.d, a.kappa, a.omega, a.i_0, b, c)
+                                   for a, b, c in zip(thetas, simulation_ns, seeds)])
 
 
 @Parameter1T0S0I.walkfunction
@@ -76,12 +91,26 @@ def get_arguments() -> Namespace:
     list(map(lambda a: parser.add_argument(a[0], help=a[1], type=a[2], nargs=a[3], default=a[4], choices=a[5]), [
         ['-mdb', 'Location of the database to record to.', str, None, 'data/ele1t0s0i.db', None],
         ['-observations', 'String of tuple representation of observations.', str, None, None, None],
+        ['-observations_file', 'Observations saved as a .npy file (see ObservedMatrix), in place of -observations.',
+         str, None, None, None],
         ['-delta', 'Distance function to use.', str, None, None, ['cosine', 'euclidean']],
         ['-simulation_n', 'Number of simulations to use to obtain a distance.', int, None, None, None],
         ['-iterations_n', 'Number of iterations to run MCMC for.', int, None, None, None],
         ['-r', "Exponential decay rate for weight vector used in regression (a=1).", float, None, None, None],
         ['-bin_n', "Number of bins used to construct histogram.", int, None, None, None],
         ['-flush_n', 'Number of iterations to run MCMC before flushing to disk.', int, None, None, None],
+        ['-writer_queue_n', 'If given, flush asynchronously through a queue of up to this many flushes.', int, None,
+         None, None],
+        ['-seed', 'Master seed for our RNGs. If not specified, runs are not reproducible.', int, None, None, None],
+        ['-chains_n', 'Number of chains to run together (new runs only).', int, None, 1, None],
+        ['-adapt_target', 'If given, learn each proposal (adaptive Metropolis) to target this acceptance rate.', float,
+         None, None, None],
+        ['-cache_mb', 'If given, cache the distances of visited proposals using up to this many MB. Revisited '
+                      'proposals reuse their simulations, so our chains target a (biased) fixed-noise posterior.', int,
+         None, None, None],
+        ['-cache_digits', 'Significant digits of real parameters to distinguish proposals by in our cache.', int, None,
+         None, None],
+        ['-checkpoint', 'Checkpoint file to save to every flush (and resume from).', str, None, None, None],
         ['-i_0_start', 'Starting ancestor repeat length.', int, None, None, None],
         ['-n_start', 'Starting sample size (population size).', int, None, None, None],
         ['-f_start', 'Starting scaling factor for total mutation rate.', float, None, None, None],
@@ -104,35 +133,63 @@ def get_arguments() -> Namespace:
 if __name__ == '__main__':
     from importlib import import_module
     from ast import literal_eval
+    from os.path import isfile
+    from os import remove
 
     arguments = get_arguments()  # Parse our arguments.
-    observations = literal_eval(arguments.observations)
+    observations = literal_eval(arguments.observations) if arguments.observations_file is None else \
+        kumulaau.observed.ObservedMatrix.load(arguments.observations_file)
 
-    # Determine if we are continuing an MCMC run or starting a new one.
-    is_new_run = arguments.n_start is not None
+    # A checkpoint is only removed once our chains have finished, so if one exists our last run was interrupted and we
+    # resume it (regardless of our starting point). Otherwise, we start a new run if given a starting point.
+    is_resumed = arguments.checkpoint is not None and isfile(arguments.checkpoint)
+    is_new_run = arguments.n_start is not None and not is_resumed
 
     # Connect to our results database.
-    with RecordSQLite(arguments.mdb, MODEL_NAME, MODEL_SQL, is_new_run) as lumberjack:
+    with RecordSQLite(arguments.mdb, MODEL_NAME, MODEL_SQL, is_new_run, arguments.writer_queue_n) as lumberjack:
+
+        # Each chain is recorded under its own run key. Continued runs restore every chain of our last run.
+        runs = [lumberjack.run_r] + [lumberjack.create_run() for _ in range(arguments.chains_n - 1)] if is_new_run \
+            else lumberjack.retrieve_runs()
 
-        if is_new_run:  # Record our observations and experiment parameters.
-            lumberjack.record_observed(observations)
-            lumberjack.record_expr(list(vars(arguments).keys()), list(vars(arguments).values()))
+        if is_new_run:  # Record our chains, observations, and experiment parameters.
+            lumberjack.record_runs(runs)
+            for run_r in runs:
+                lumberjack.record_observed(observations, run_r=run_r)
+                lumberjack.record_expr(list(vars(arguments).keys()), list(vars(arguments).values()), run_r=run_r)
 
         # Construct the walk, summary, and log functions based on our given arguments.
         walk = lambda a: walk_1T0S0I(a, Parameter1T0S0I.from_namespace(arguments, lambda b: b + '_sigma'))
-        log = lumberjack.handler_factory(arguments.flush_n)
+        if arguments.adapt_target is not None:  # Each chain learns its own proposal, starting from our step sizes.
+            walk = [AdaptiveWalk(Parameter1T0S0I, Parameter1T0S0I.from_namespace(arguments, lambda b: b + '_sigma'),
+                                 arguments.adapt_target) for _ in runs]
+        logs = [lumberjack.handler_factory(arguments.flush_n, run_r) for run_r in runs]
         delta = getattr(import_module('kumulaau.distance'), arguments.delta + '_delta')
+        cache = None if arguments.cache_mb is None else \
+            kumulaau.distance.DistanceCache(arguments.cache_mb * 2 ** 20, arguments.cache_digits)
 
         # Determine our starting point and boundaries.
         if is_new_run:
-            theta_0 = Parameter1T0S0I.from_namespace(arguments, lambda a: a + '_start')
+            theta_0s = [Parameter1T0S0I.from_namespace(arguments, lambda a: a + '_start') for _ in runs]
             boundaries = [0, arguments.iterations_n]
+        elif is_resumed:  # Our chains, iteration, and boundaries are all restored from our checkpoint.
+            theta_0s, boundaries = [None for _ in runs], [0, arguments.iterations_n]
         else:
-            theta_0 = Parameter1T0S0I(**lumberjack.retrieve_last_theta())
-            offset = lumberjack.retrieve_last_result('PROPOSED_TIME')
+            # Each chain continues from the last state of its own run, and our chains share their iteration count.
+            theta_0s = [Parameter1T0S0I(**lumberjack.retrieve_last_theta(run_r)) for run_r in runs]
+            offset = max(lumberjack.retrieve_last_result('PROPOSED_TIME', run_r=run_r) for run_r in runs)
             boundaries = [0 + offset, arguments.iterations_n + offset]
 
         # Run our MCMC!
-        kumulaau.ele.run(walk=walk, sample=sample_1T0S0I, delta=delta, log_handler=log,
-                         theta_0=theta_0, observed=observations, simulation_n=arguments.simulation_n,
-                         boundaries=boundaries, r=arguments.r, bin_n=arguments.bin_n)
+        kumulaau.ele.run_chains(walk=walk, sample=sample_1T0S0I, delta=delta, log_handlers=logs,
+                                theta_0s=theta_0s, observed=observations,
+                                simulation_n=arguments.simulation_n, boundaries=boundaries, r=arguments.r,
+                                bin_n=arguments.bin_n, sample_batch=sample_batch_1T0S0I, seed=arguments.seed,
+                                buffer_n=arguments.flush_n + 1, checkpoint=arguments.checkpoint,
+                                checkpoint_n=arguments.flush_n, cache=cache)
+
+        if cache is not None:  # Report the work saved by our cache.
+            print(f'Simulations saved by our cache: {cache.reused_n}')
+
+    if arguments.checkpoint is not None and isfile(arguments.checkpoint):
+        remove(arguments.checkpoint)  # Our chains have finished, so we no longer need our checkpoint.
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 from argparse import Namespace
 from numpy import ndarray
+from typing import List, Sequence, Tuple
 from kumulaau import *
 
 # The model name associated with the results database.
@@ -8,7 +9,7 @@ MODEL_NAME = "ELE4T1S2I"
 
 # The model SQL associated with model database.
 MODEL_SQL = "I_0 INT, N_B INT, N_S1 INT, N_S2 INT, N_E INT, " \
-            "F_B FLOAT, F_S1 FLOAT, F_S2 FLOAT, F_E FLOAT " \
+            "F_B FLOAT, F_S1 FLOAT, F_S2 FLOAT, F_E FLOAT, " \
             "ALPHA FLOAT, C FLOAT, D FLOAT, KAPPA INT, OMEGA INT"
 
 
@@ -56,38 +57,57 @@ class Parameter4T1S2I(Parameter):
             self.n_b < self.n_s1 + self.n_s2 < self.n_e
 
 
-def sample_4T1S2I(theta: Parameter4T1S2I) -> ndarray:
-    """ Generate a list of lengths of our 4T (four total) 1S (one splits) 2I (two intermediates) model.
+def graph_4T1S2I(theta: Parameter4T1S2I) -> Tuple[List, List]:
+    """ Describe our 4T (four total) 1S (one splits) 2I (two intermediates) model as a demographic graph. Our common
+    ancestor population (0) splits into two intermediate populations: the first (1) is founded by a fraction of our
+    common ancestors, normally distributed around alpha, and the second (2) by the rest. Both intermediate populations
+    are then joined into our end population (3).
+
+    :param theta: Parameter4T1S2I set to describe.
+    :return: The populations and sources of our model, as given to model.simulate_graph.
+    """
+    populations = [(theta.n_b, theta.f_b, theta.c, theta.d, theta.kappa, theta.omega),
+                   (theta.n_s1, theta.f_s1, theta.c, theta.d, theta.kappa, theta.omega),
+                   (theta.n_s2, theta.f_s2, theta.c, theta.d, theta.kappa, theta.omega),
+                   (theta.n_e, theta.f_e, theta.c, theta.d, theta.kappa, theta.omega)]
+    sources = [(1, 0, theta.alpha, 0.2), (2, 0, 1, 0), (3, 1, 1, 0), (3, 2, 1, 0)]
+
+    return populations, sources
+
+
+def sample_4T1S2I(theta: Parameter4T1S2I, seed=None) -> ndarray:
+    """ Generate a list of lengths of our 4T (four total) 1S (one splits) 2I (two intermediates) model. All four
+    populations are simulated in a single native call.
 
     :param theta: Parameter4T1S2I set to use with tree tracing.
+    :param seed: Master seed for our RNGs. Each population (and our split) uses its own substream. If None, seeds are
+        generated.
     :return: List of repeat lengths.
     """
-    from numpy.random import normal, shuffle
-    from numpy import concatenate
+    return model.simulate_graph(*graph_4T1S2I(theta), theta.i_0, 1, seed=seed)[0]
 
-    # Create and evolve our common ancestor tree.
-    common_ancestors = model.evolve(
-        model.trace(theta.n_b, theta.f_b, theta.c, theta.d, theta.kappa, theta.omega),
-        theta.i_0
-    )
 
-    # Determine our descendant inputs. Normally distributed around alpha.
-    split_alpha = int(round(abs(normal(theta.alpha, 0.2)) * len(common_ancestors)))
-    shuffle(common_ancestors)
+def sample_batch_4T1S2I(thetas: Sequence, simulation_ns: Sequence, seeds: Sequence) -> List[ndarray]:
+    """ Generate the end populations of several Parameter4T1S2I sets (e.g. the proposals of several chains) in a single
+    native call.
 
-    # Create the topology for our intermediate populations.
-    descendant_1_top = model.trace(theta.n_s1, theta.f_s1, theta.c, theta.d, theta.kappa, theta.omega)
-    descendant_2_top = model.trace(theta.n_s2, theta.f_s2, theta.c, theta.d, theta.kappa, theta.omega)
+    :param thetas: Parameter4T1S2I sets to use with tree tracing.
+    :param simulation_ns: Number of populations to generate for each parameter set.
+    :param seeds: Master seed for our RNGs, for each parameter set. If None, a seed is generated.
+    :return: One matrix of repeat lengths per parameter set, where each row is an end population.
+    """
+    return model.simulate_graphs([(*graph_4T1S2I(a), a.i_0, b, c) for a, b, c in zip(thetas, simulation_ns, seeds)])
 
-    # Evolve our intermediate populations.
-    descendant_1 = model.evolve(descendant_1_top, common_ancestors[0:split_alpha])
-    descendant_2 = model.evolve(descendant_2_top, common_ancestors[:-split_alpha])
 
-    # Create the topology for our end population.
-    end_top = model.trace(theta.n_e, theta.f_e, theta.c, theta.d, theta.kappa, theta.omega)
+def derive_4T1S2I(theta: Parameter4T1S2I) -> Parameter4T1S2I:
+    """ Set the parameters of a 4T1S2I parameter set that are derived from others. Our scaling factors must match
+    between S_1 and S_2, so f_s2 is determined by n_s1, f_s1, and n_s2.
 
-    # Evolve and return our end population.
-    return model.evolve(end_top, concatenate((descendant_1, descendant_2)))
+    :param theta: Parameter set to derive from.
+    :return: The same parameter set, with f_s2 derived.
+    """
+    theta.f_s2 = (theta.n_s1 * theta.f_s1) / theta.n_s2 if theta.n_s2 > 0 else 0  # Invalid anyway if n_s2 <= 0.
+    return theta
 
 
 @Parameter4T1S2I.walkfunction
@@ -135,12 +155,26 @@ def get_arguments() -> Namespace:
     list(map(lambda a: parser.add_argument(a[0], help=a[1], type=a[2], nargs=a[3], default=a[4], choices=a[5]), [
         ['-mdb', 'Location of the database to record to.', str, None, 'data/abc1t0s0i.db', None],
         ['-observations', 'String of tuple representation of observations.', str, None, None, None],
+        ['-observations_file', 'Observations saved as a .npy file (see ObservedMatrix), in place of -observations.',
+         str, None, None, None],
         ['-delta', 'Distance function to use.', str, None, None, ['cosine', 'euclidean']],
         ['-simulation_n', 'Number of simulations to use to obtain a distance.', int, None, None, None],
         ['-iterations_n', 'Number of iterations to run MCMC for.', int, None, None, None],
         ['-r', "Exponential decay rate for weight vector used in regression (a=1).", float, None, None, None],
         ['-bin_n', "Number of bins used to construct histogram.", int, None, None, None],
         ['-flush_n', 'Number of iterations to run MCMC before flushing to disk.', int, None, None, None],
+        ['-writer_queue_n', 'If given, flush asynchronously through a queue of up to this many flushes.', int, None,
+         None, None],
+        ['-seed', 'Master seed for our RNGs. If not specified, runs are not reproducible.', int, None, None, None],
+        ['-chains_n', 'Number of chains to run together (new runs only).', int, None, 1, None],
+        ['-adapt_target', 'If given, learn each proposal (adaptive Metropolis) to target this acceptance rate.', float,
+         None, None, None],
+        ['-cache_mb', 'If given, cache the distances of visited proposals using up to this many MB. Revisited '
+                      'proposals reuse their simulations, so our chains target a (biased) fixed-noise posterior.', int,
+         None, None, None],
+        ['-cache_digits', 'Significant digits of real parameters to distinguish proposals by in our cache.', int, None,
+         None, None],
+        ['-checkpoint', 'Checkpoint file to save to every flush (and resume from).', str, None, None, None],
         ['-i_0_start', 'Starting ancestor repeat length.', int, None, None, None],
         ['-n_b_start', 'Population size for common ancestor.', int, None, None, None],
         ['-n_s1_start', 'Population size for intermediate 1.', int, None, None, None],
@@ -177,35 +211,63 @@ def get_arguments() -> Namespace:
 if __name__ == '__main__':
     from importlib import import_module
     from ast import literal_eval
+    from os.path import isfile
+    from os import remove
 
     arguments = get_arguments()  # Parse our arguments.
-    observations = literal_eval(arguments.observations)
+    observations = literal_eval(arguments.observations) if arguments.observations_file is None else \
+        kumulaau.observed.ObservedMatrix.load(arguments.observations_file)
 
-    # Determine if we are continuing an MCMC run or starting a new one.
-    is_new_run = arguments.n_b_start is not None
+    # A checkpoint is only removed once our chains have finished, so if one exists our last run was interrupted and we
+    # resume it (regardless of our starting point). Otherwise, we start a new run if given a starting point.
+    is_resumed = arguments.checkpoint is not None and isfile(arguments.checkpoint)
+    is_new_run = arguments.n_b_start is not None and not is_resumed
 
     # Connect to our results database.
-    with RecordSQLite(arguments.mdb, MODEL_NAME, MODEL_SQL, is_new_run) as lumberjack:
+    with RecordSQLite(arguments.mdb, MODEL_NAME, MODEL_SQL, is_new_run, arguments.writer_queue_n) as lumberjack:
+
+        # Each chain is recorded under its own run key. Continued runs restore every chain of our last run.
+        runs = [lumberjack.run_r] + [lumberjack.create_run() for _ in range(arguments.chains_n - 1)] if is_new_run \
+            else lumberjack.retrieve_runs()
 
-        if is_new_run:  # Record our observations and experiment parameters.
-            lumberjack.record_observed(observations)
-            lumberjack.record_expr(list(vars(arguments).keys()), list(vars(arguments).values()))
+        if is_new_run:  # Record our chains, observations, and experiment parameters.
+            lumberjack.record_runs(runs)
+            for run_r in runs:
+                lumberjack.record_observed(observations, run_r=run_r)
+                lumberjack.record_expr(list(vars(arguments).keys()), list(vars(arguments).values()), run_r=run_r)
 
         # Construct the walk, summary, and log functions based on our given arguments.
         walk = lambda a: walk_4T1S2I(a, Parameter4T1S2I.from_namespace(arguments, lambda b: b + '_sigma'))
-        log = lumberjack.handler_factory(arguments.flush_n)
+        if arguments.adapt_target is not None:  # Each chain learns its own proposal, starting from our step sizes.
+            walk = [AdaptiveWalk(Parameter4T1S2I, Parameter4T1S2I.from_namespace(arguments, lambda b: b + '_sigma'),
+                                 arguments.adapt_target, transform=derive_4T1S2I) for _ in runs]
+        logs = [lumberjack.handler_factory(arguments.flush_n, run_r) for run_r in runs]
         delta = getattr(import_module('kumulaau.distance'), arguments.delta + '_delta')
+        cache = None if arguments.cache_mb is None else \
+            kumulaau.distance.DistanceCache(arguments.cache_mb * 2 ** 20, arguments.cache_digits)
 
         # Determine our starting point and boundaries.
         if is_new_run:
-            theta_0 = Parameter4T1S2I.from_namespace(arguments, lambda a: a + '_start')
+            theta_0s = [Parameter4T1S2I.from_namespace(arguments, lambda a: a + '_start') for _ in runs]
             boundaries = [0, arguments.iterations_n]
+        elif is_resumed:  # Our chains, iteration, and boundaries are all restored from our checkpoint.
+            theta_0s, boundaries = [None for _ in runs], [0, arguments.iterations_n]
         else:
-            theta_0 = Parameter4T1S2I(**lumberjack.retrieve_last_theta())
-            offset = lumberjack.retrieve_last_result('PROPOSED_TIME')
+            # Each chain continues from the last state of its own run, and our chains share their iteration count.
+            theta_0s = [Parameter4T1S2I(**lumberjack.retrieve_last_theta(run_r)) for run_r in runs]
+            offset = max(lumberjack.retrieve_last_result('PROPOSED_TIME', run_r=run_r) for run_r in runs)
             boundaries = [0 + offset, arguments.iterations_n + offset]
 
         # Run our MCMC!
-        kumulaau.ele.run(walk=walk, sample=sample_4T1S2I, delta=delta, log_handler=log,
-                         theta_0=theta_0, observed=observations, simulation_n=arguments.simulation_n,
-                         boundaries=boundaries, r=arguments.r, bin_n=arguments.bin_n)
+        kumulaau.ele.run_chains(walk=walk, sample=sample_4T1S2I, delta=delta, log_handlers=logs,
+                                theta_0s=theta_0s, observed=observations,
+                                simulation_n=arguments.simulation_n, boundaries=boundaries, r=arguments.r,
+                                bin_n=arguments.bin_n, sample_batch=sample_batch_4T1S2I, seed=arguments.seed,
+                                buffer_n=arguments.flush_n + 1, checkpoint=arguments.checkpoint,
+                                checkpoint_n=arguments.flush_n, cache=cache)
+
+        if cache is not None:  # Report the work saved by our cache.
+            print(f'Simulations saved by our cache: {cache.reused_n}')
+
+    if arguments.checkpoint is not None and isfile(arguments.checkpoint):
+        remove(arguments.checkpoint)  # Our chains have finished, so we no longer need our checkpoint.
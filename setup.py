@@ -6,6 +6,6 @@ setup(name='kumulaau',
       url='https://github.com/glennga/kumulaau',
       author='Glenn Galvizo',
       packages=['kumulaau'],
-      ext_modules=[Extension('pop', ['kumulaau/_pop.c'], libraries=["m", "gsl", "gslcblas"])],
+      ext_modules=[Extension('pop', ['kumulaau/_pop.c'], libraries=["m", "gsl", "gslcblas", "pthread"])],
       requires=['numpy', 'numba', 'matplotlib', 'scipy'],
       scripts=['data/alfred/alfred.sh'])